@@ -5,8 +5,11 @@
 #
 
 from neuromllite.utils import print_v
-from neuromllite.utils import evaluate
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.CompiledNetwork import CompiledNetwork
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.NetworkGenerator import _get_gid_arrays
+from neuromllite.NetworkGenerator import _get_incoming_connections
 
 from pyneuroml.pynml import convert_to_units
 
@@ -20,8 +23,12 @@ class ArborHandler(DefaultNetworkHandler):
 
     pops_vs_components = {}
 
-    proj_weights = {}
-    proj_delays = {}
+    # Connections of each projection as arrays of pre cell indices, post
+    # cell indices, weights and delays; these are collected in chunks while
+    # the projection is being generated
+    proj_conn_chunks = {}
+    proj_connections = {}
+    proj_pops = {}
 
     input_info = {}
 
@@ -97,6 +104,12 @@ class ArborHandler(DefaultNetworkHandler):
         exec('self.POP_%s.positions[1][%s] = %s'%(population_id,id,y))
         exec('self.POP_%s.positions[2][%s] = %s'%(population_id,id,z))"""
 
+    def handle_locations(self, population_id, component, positions, start_id=0):
+
+        for i in range(len(positions)):
+            self.pop_indices_vs_gids[population_id][start_id + i] = self.curr_gid + i
+        self.curr_gid += len(positions)
+
     def handle_projection(
         self,
         projName,
@@ -131,18 +144,8 @@ class ArborHandler(DefaultNetworkHandler):
             + synInfo
         )
 
-        self.proj_weights[projName] = np.zeros(
-            (
-                len(self.pop_indices_vs_gids[prePop]),
-                len(self.pop_indices_vs_gids[postPop]),
-            )
-        )
-        self.proj_delays[projName] = np.zeros(
-            (
-                len(self.pop_indices_vs_gids[prePop]),
-                len(self.pop_indices_vs_gids[postPop]),
-            )
-        )
+        self.proj_conn_chunks[projName] = []
+        self.proj_pops[projName] = (prePop, postPop)
 
         """
         exec('self.projection__%s_conns = []'%(projName))"""
@@ -184,8 +187,48 @@ class ArborHandler(DefaultNetworkHandler):
             )
         )
 
-        self.proj_weights[projName][preCellId][postCellId] = weight
-        self.proj_delays[projName][preCellId][postCellId] = delay
+        self.proj_conn_chunks[projName].append(
+            ([preCellId], [postCellId], [weight], [delay])
+        )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+
+        print_v(
+            "Connections %i to %i of: %s (%s -> %s, syn: %s)"
+            % (
+                start_id,
+                start_id + len(preCellIds) - 1,
+                projName,
+                prePop,
+                postPop,
+                synapseType,
+            )
+        )
+
+        num = len(preCellIds)
+        self.proj_conn_chunks[projName].append(
+            (
+                np.asarray(preCellIds, dtype=int),
+                np.asarray(postCellIds, dtype=int),
+                np.broadcast_to(weights, (num,)),
+                np.broadcast_to(delays, (num,)),
+            )
+        )
 
     #
     #  Should be overridden to handle end of network connection
@@ -194,6 +237,12 @@ class ArborHandler(DefaultNetworkHandler):
         self, projName, prePop, postPop, synapse=None, type="projection"
     ):
 
+        chunks = self.proj_conn_chunks.pop(projName)
+        self.proj_connections[projName] = tuple(
+            np.concatenate([chunk[i] for chunk in chunks]) if chunks else np.zeros(0)
+            for i in range(4)
+        )
+
         print_v(
             "Projection finalising: "
             + projName
@@ -201,7 +250,7 @@ class ArborHandler(DefaultNetworkHandler):
             + prePop
             + " to "
             + postPop
-            + " completed"
+            + " completed with %i connections" % len(self.proj_connections[projName][0])
         )
         """
         #exec('print(self.projection__%s_conns)'%projName)
@@ -266,6 +315,24 @@ class ArborHandler(DefaultNetworkHandler):
         #pulse.inject_into(pop_pre)
         #exec('self.populations["pop0"][0].inject(pulse)')"""
 
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+
+        population_id, component = self.input_info[inputListId]
+
+        print_v(
+            "Inputs: %s[%i:%i] (%s), pop: %s, %i inputs"
+            % (
+                inputListId,
+                start_id,
+                start_id + len(cellIds),
+                component,
+                population_id,
+                len(cellIds),
+            )
+        )
+
     #
     #  Should be overridden to to connect each input to the target cell
     #
@@ -273,16 +340,34 @@ class ArborHandler(DefaultNetworkHandler):
         print_v("Input: %s completed" % inputName)
 
     def finalise_document(self):
-        print_v("Building recipe with: %s" % self.pop_indices_vs_gids)
-        print_v("Weights: %s" % self.proj_weights)
-        print_v("Delays: %s" % self.proj_delays)
+        print_v(
+            "Building recipe with %i cells in populations: %s"
+            % (self.curr_gid, list(self.pop_indices_vs_gids.keys()))
+        )
+        for projName in self.proj_connections:
+            print_v(
+                "Projection %s: %i connections"
+                % (projName, len(self.proj_connections[projName][0]))
+            )
+
+        pop_ids, gid_pop_indices, gid_cell_indices, pop_gids = _get_gid_arrays(
+            self.pop_indices_vs_gids, self.curr_gid
+        )
 
         self.neuroML_arbor_recipe = NeuroML_Arbor_Recipe(
             self.nl_network,
-            self.pop_indices_vs_gids,
             self.pops_vs_components,
-            self.proj_weights,
-            self.proj_delays,
+            pop_ids,
+            gid_pop_indices,
+            gid_cell_indices,
+            pop_gids,
+            _get_incoming_connections(
+                self.nl_network,
+                self.proj_pops,
+                self.proj_connections,
+                pop_gids,
+                self.curr_gid,
+            ),
         )
 
 
@@ -292,7 +377,7 @@ def create_arbor_cell(cell, nl_network, gid):
 
         default_tree = arbor.segment_tree()
         radius = (
-            evaluate(cell.parameters["radius"], nl_network.parameters)
+            get_parameter_table(nl_network).evaluate(cell.parameters["radius"])
             if "radius" in cell.parameters
             else 3
         )
@@ -311,7 +396,7 @@ def create_arbor_cell(cell, nl_network, gid):
         decor = arbor.decor()
 
         v_init = (
-            evaluate(cell.parameters["v_init"], nl_network.parameters)
+            get_parameter_table(nl_network).evaluate(cell.parameters["v_init"])
             if "v_init" in cell.parameters
             else -70
         )
@@ -344,14 +429,23 @@ def create_arbor_cell(cell, nl_network, gid):
 
 
 # Create a NeuroML recipe
+#
+#   The population and index of each gid, and the incoming connections of each
+#   (see _get_incoming_connections in NetworkGenerator) are precomputed in
+#   arrays, so that the callbacks Arbor makes for each gid don't need to search
+#   for them.
+#   Arbor makes these callbacks for every gid, from each of its threads, so
+#   they don't print anything
 class NeuroML_Arbor_Recipe(arbor.recipe):
     def __init__(
         self,
         nl_network,
-        pop_indices_vs_gids,
         pops_vs_components,
-        proj_weights,
-        proj_delays,
+        pop_ids,
+        gid_pop_indices,
+        gid_cell_indices,
+        pop_gids,
+        incoming_connections,
     ):
         # The base C++ class constructor must be called first, to ensure that
         # all memory in the C++ class is initialized correctly.
@@ -359,33 +453,30 @@ class NeuroML_Arbor_Recipe(arbor.recipe):
         self.props = arbor.neuron_cable_properties()
         self.cat = arbor.default_catalogue()
         self.props.register(self.cat)
-        self.pop_indices_vs_gids = pop_indices_vs_gids
         self.pops_vs_components = pops_vs_components
         self.nl_network = nl_network
-        self.proj_weights = proj_weights
-        self.proj_delays = proj_delays
+        self.compiled_network = CompiledNetwork(nl_network)
+        self.pop_ids = pop_ids
+        self.gid_pop_indices = gid_pop_indices
+        self.gid_cell_indices = gid_cell_indices
+        self.pop_gids = pop_gids
+        (
+            self.incoming_indptr,
+            self.incoming_sources,
+            self.incoming_weights,
+            self.incoming_delays,
+        ) = incoming_connections
 
     def get_pop_index(self, gid):
-        # Todo: optimise...
-        for pop_id in self.pop_indices_vs_gids:
-            for index in self.pop_indices_vs_gids[pop_id]:
-                if self.pop_indices_vs_gids[pop_id][index] == gid:
-                    return pop_id, index
+        return self.pop_ids[self.gid_pop_indices[gid]], int(self.gid_cell_indices[gid])
 
     def get_gid(self, pop_id, index):
-        return self.pop_indices_vs_gids[pop_id][index]
+        return int(self.pop_gids[pop_id][index])
 
     # (6) The num_cells method that returns the total number of cells in the model
     # must be implemented.
     def num_cells(self):
-        ncells = sum(
-            [
-                len(self.pop_indices_vs_gids[pop_id])
-                for pop_id in self.pop_indices_vs_gids
-            ]
-        )
-        print_v("Getting num cells: %s" % (ncells))
-        return ncells
+        return len(self.gid_pop_indices)
 
     # (7) The cell_description method returns a cell
     def cell_description(self, gid):
@@ -393,73 +484,37 @@ class NeuroML_Arbor_Recipe(arbor.recipe):
         comp = self.pops_vs_components[pop_id]
 
         return create_arbor_cell(
-            self.nl_network.get_child(comp, "cells"), self.nl_network, gid
+            self.compiled_network.get_cell(comp), self.nl_network, gid
         )
 
     # The kind method returns the type of cell with gid.
-    # Note: this must agree with the type returned by cell_description.
+    # Note: this must agree with the type returned by cell_description, and
+    # create_arbor_cell only creates cable cells (so only a partition_hint for
+    # cable cells is needed when the simulation is run)
     def cell_kind(self, gid):
-        cell_kind = arbor.cell_kind.cable
-        print_v("Getting cell_kind: %s" % (cell_kind))
-        return cell_kind
+        return arbor.cell_kind.cable
 
     # (8) Make a ring network. For each gid, provide a list of incoming connections.
     def connections_on(self, gid):
-        # Todo: optimise!!
-        pop_id, index = self.get_pop_index(gid)
-        conns = []
-        for proj in self.nl_network.projections:
-            if pop_id == proj.postsynaptic:
-                w = self.proj_weights[proj.id]
-                in_w = w.T[index]
-                d = self.proj_delays[proj.id]
-                in_d = d.T[index]
-                print_v(
-                    "Incoming connections for gid %i (%s[%s]), w: %s; d: %s"
-                    % (gid, pop_id, index, in_w, in_d)
-                )
-                for src_index in range(len(in_w)):
-                    if in_w[src_index] > 0:
-                        src_gid = self.get_gid(proj.presynaptic, src_index)
-                        conns.append(
-                            arbor.connection(
-                                (src_gid, 0), (gid, 0), in_w[src_index], in_d[src_index]
-                            )
-                        )
-
-        print_v(
-            "Making connections for gid %i (%s[%s]): %s" % (gid, pop_id, index, conns)
-        )
-        return conns
+        start, end = self.incoming_indptr[gid], self.incoming_indptr[gid + 1]
+        return [
+            arbor.connection(
+                (int(self.incoming_sources[i]), 0),
+                (gid, 0),
+                float(self.incoming_weights[i]),
+                float(self.incoming_delays[i]),
+            )
+            for i in range(start, end)
+        ]
 
     def num_targets(self, gid):
-        tot_in = len(self.connections_on(gid))
-        print_v("num_targets for %i: %s" % (gid, tot_in))
-
         return 1
 
     def num_sources(self, gid):
-        # Todo: optimise!!
-        pop_id, index = self.get_pop_index(gid)
-        tot_out = 0
-        for proj in self.nl_network.projections:
-            if pop_id == proj.presynaptic:
-                w = self.proj_weights[proj.id]
-                out_w = w[index]
-                print_v(
-                    "Outgoing connections for gid %i (%s[%s]), w: %s"
-                    % (gid, pop_id, index, out_w)
-                )
-                for c in out_w:
-                    if c > 0:
-                        tot_out += 1
-
-        print_v("num_sources for %i: %s" % (gid, tot_out))
         return 1
 
     # (9) Attach a generator to the first cell in the ring.
     def event_generators(self, gid):
-        print_v("Getting event_generators for: %s" % (gid))
         if gid == 0:
             sched = arbor.explicit_schedule([1])
             return [arbor.event_generator((0, 0), 0.1, sched)]
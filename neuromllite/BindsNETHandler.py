@@ -5,6 +5,8 @@
 #
 
 from neuromllite.utils import print_v
+from neuromllite.CompiledNetwork import CompiledNetwork
+from neuromllite.ConnectivityHandler import SparseConnectivity
 from neuromllite.utils import evaluate
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
 
@@ -13,6 +15,7 @@ from pyneuroml.pynml import convert_to_units
 import numpy as np
 
 import bindsnet
+import torch
 
 
 class BindsNETHandler(DefaultNetworkHandler):
@@ -20,8 +23,11 @@ class BindsNETHandler(DefaultNetworkHandler):
     pops_vs_components = {}
     pops_vs_bn_layers = {}
 
-    proj_weights = {}
-    proj_delays = {}
+    # Connections of each projection as arrays of pre cell indices, post
+    # cell indices, weights and delays; these are collected in chunks while
+    # the projection is being generated
+    proj_conn_chunks = {}
+    proj_connections = {}
 
     input_info = {}
 
@@ -35,12 +41,30 @@ class BindsNETHandler(DefaultNetworkHandler):
 
     pop_indices_vs_gids = {}
 
-    def __init__(self, nl_network):
+    # Pre and post populations of each projection
+    proj_pops = {}
+    proj_bn_connections = {}
+
+    def __init__(self, nl_network, batch_size=1, dense_fraction=0.1, dt=1.0):
+        """
+        batch_size is the number of trials which will be run together in the
+        BindsNET network, with the inputs from _get_batch_inputs in
+        NetworkGenerator (independent Poisson spikes in each). The weights of
+        a projection are held in a sparse tensor if fewer than dense_fraction
+        of its cell pairs are connected, otherwise in a dense one. dt is the
+        time step (ms) of the simulation
+        """
         print_v("Initiating BindsNET...")
         self.nl_network = nl_network
+        self.compiled_network = CompiledNetwork(nl_network)
         self.curr_gid = 0
+        self.batch_size = batch_size
+        self.dense_fraction = dense_fraction
+
+        # Chunks of the cell ids and weights of each input
+        self.input_chunks = {}
 
-        self.bn_network = bindsnet.network.Network(dt=1.0)
+        self.bn_network = bindsnet.network.Network(dt=dt, batch_size=batch_size)
 
     def handle_document_start(self, id, notes):
         print_v("Document: %s" % id)
@@ -91,6 +115,12 @@ class BindsNETHandler(DefaultNetworkHandler):
         exec('self.POP_%s.positions[1][%s] = %s'%(population_id,id,y))
         exec('self.POP_%s.positions[2][%s] = %s'%(population_id,id,z))"""
 
+    def handle_locations(self, population_id, component, positions, start_id=0):
+
+        for i in range(len(positions)):
+            self.pop_indices_vs_gids[population_id][start_id + i] = self.curr_gid + i
+        self.curr_gid += len(positions)
+
     def handle_projection(
         self,
         projName,
@@ -125,18 +155,8 @@ class BindsNETHandler(DefaultNetworkHandler):
             + synInfo
         )
 
-        self.proj_weights[projName] = np.zeros(
-            (
-                len(self.pop_indices_vs_gids[prePop]),
-                len(self.pop_indices_vs_gids[postPop]),
-            )
-        )
-        self.proj_delays[projName] = np.zeros(
-            (
-                len(self.pop_indices_vs_gids[prePop]),
-                len(self.pop_indices_vs_gids[postPop]),
-            )
-        )
+        self.proj_conn_chunks[projName] = []
+        self.proj_pops[projName] = (prePop, postPop)
 
         """
         exec('self.projection__%s_conns = []'%(projName))"""
@@ -178,8 +198,48 @@ class BindsNETHandler(DefaultNetworkHandler):
             )
         )
 
-        self.proj_weights[projName][preCellId][postCellId] = weight
-        self.proj_delays[projName][preCellId][postCellId] = delay
+        self.proj_conn_chunks[projName].append(
+            ([preCellId], [postCellId], [weight], [delay])
+        )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+
+        print_v(
+            "Connections %i to %i of: %s (%s -> %s, syn: %s)"
+            % (
+                start_id,
+                start_id + len(preCellIds) - 1,
+                projName,
+                prePop,
+                postPop,
+                synapseType,
+            )
+        )
+
+        num = len(preCellIds)
+        self.proj_conn_chunks[projName].append(
+            (
+                np.asarray(preCellIds, dtype=int),
+                np.asarray(postCellIds, dtype=int),
+                np.broadcast_to(weights, (num,)),
+                np.broadcast_to(delays, (num,)),
+            )
+        )
 
     #
     #  Should be overridden to handle end of network connection
@@ -188,6 +248,12 @@ class BindsNETHandler(DefaultNetworkHandler):
         self, projName, prePop, postPop, synapse=None, type="projection"
     ):
 
+        chunks = self.proj_conn_chunks.pop(projName)
+        self.proj_connections[projName] = tuple(
+            np.concatenate([chunk[i] for chunk in chunks]) if chunks else np.zeros(0)
+            for i in range(4)
+        )
+
         print_v(
             "Projection finalising: "
             + projName
@@ -195,7 +261,7 @@ class BindsNETHandler(DefaultNetworkHandler):
             + prePop
             + " to "
             + postPop
-            + " completed"
+            + " completed with %i connections" % len(self.proj_connections[projName][0])
         )
 
     #
@@ -216,6 +282,7 @@ class BindsNETHandler(DefaultNetworkHandler):
             return
 
         self.input_info[inputListId] = (population_id, component)
+        self.input_chunks[inputListId] = []
 
     #
     #  Should be overridden to to connect each input to the target cell
@@ -230,6 +297,31 @@ class BindsNETHandler(DefaultNetworkHandler):
             "Input: %s[%s] (%s), pop: %s, cellId: %i, seg: %i, fract: %f, weight: %f"
             % (inputListId, id, component, population_id, cellId, segId, fract, weight)
         )
+        self.input_chunks[inputListId].append(([cellId], [weight]))
+
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+
+        population_id, component = self.input_info[inputListId]
+
+        print_v(
+            "Inputs: %s[%i:%i] (%s), pop: %s, %i inputs"
+            % (
+                inputListId,
+                start_id,
+                start_id + len(cellIds),
+                component,
+                population_id,
+                len(cellIds),
+            )
+        )
+        self.input_chunks[inputListId].append(
+            (
+                np.asarray(cellIds, dtype=int),
+                np.broadcast_to(weights, (len(cellIds),)),
+            )
+        )
 
     #
     #  Should be overridden to to connect each input to the target cell
@@ -237,23 +329,103 @@ class BindsNETHandler(DefaultNetworkHandler):
     def finalise_input_source(self, inputName):
         print_v("Input: %s completed" % inputName)
 
+    def get_input_cells(self):
+        """
+        The cell ids and weights of each input, as arrays, for building the
+        inputs to the trials of a simulation (see _get_batch_inputs in
+        NetworkGenerator)
+        """
+        input_cells = {}
+        for inputListId, chunks in self.input_chunks.items():
+            input_cells[inputListId] = tuple(
+                np.concatenate([chunk[i] for chunk in chunks])
+                if chunks
+                else np.zeros(0, dtype=int)
+                for i in range(2)
+            )
+        return input_cells
+
     def finalise_document(self):
-        print_v("Building network with: %s" % self.pop_indices_vs_gids)
-        print_v("Weights: %s" % self.proj_weights)
-        print_v("Delays: %s" % self.proj_delays)
+        print_v(
+            "Building network with %i populations (%i cells) and %i projections"
+            % (
+                len(self.pop_indices_vs_gids),
+                self.curr_gid,
+                len(self.proj_connections),
+            )
+        )
 
         for pop in self.pop_indices_vs_gids:
             size = len(self.pop_indices_vs_gids[pop])
             comp = self.pops_vs_components[pop]
-            cell = self.nl_network.get_child(comp, "cells")
-            layer_name = "%s_bn_pop" % pop
-            cmd = "self.pops_vs_bn_layers['%s'] = bindsnet.network.nodes.%s(%s)" % (
-                pop,
-                cell.bindsnet_node,
-                size,
+            cell = self.compiled_network.get_cell(comp)
+            print_v(
+                "Creating a population %s with %s instances of %s using: %s"
+                % (pop, size, cell, cell.bindsnet_node)
             )
-            print(
-                "Creating a population %s with %s instances of %s using: <%s>"
-                % (pop, size, cell, cmd)
+            node_class = getattr(bindsnet.network.nodes, cell.bindsnet_node)
+            layer = node_class(n=size)
+            self.pops_vs_bn_layers[pop] = layer
+            self.bn_network.add_layer(layer, name=pop)
+
+        for projName in self.proj_connections:
+            prePop, postPop = self.proj_pops[projName]
+            w = self.get_weight_tensor(projName)
+            if w.is_sparse:
+                connection_class = bindsnet.network.topology.SparseConnection
+                nnz = w._nnz()
+            else:
+                connection_class = bindsnet.network.topology.Connection
+                nnz = int(torch.count_nonzero(w))
+            print_v(
+                "Creating a %s for %s (%s -> %s): %i connections, weights of shape %s with %i non-zero"
+                % (
+                    connection_class.__name__,
+                    projName,
+                    prePop,
+                    postPop,
+                    len(self.proj_connections[projName][0]),
+                    tuple(w.shape),
+                    nnz,
+                )
             )
-            exec(cmd)
+            connection = connection_class(
+                source=self.pops_vs_bn_layers[prePop],
+                target=self.pops_vs_bn_layers[postPop],
+                w=w,
+            )
+            self.proj_bn_connections[projName] = connection
+            self.bn_network.add_connection(connection, source=prePop, target=postPop)
+
+    def get_weight_tensor(self, projName):
+        """
+        The weights of the connections of the projection as a torch tensor of
+        shape (pre size, post size), summing the weights of connections
+        between the same pair of cells. This is a sparse (COO) tensor if few
+        of the pairs are connected
+        """
+        prePop, postPop = self.proj_pops[projName]
+        shape = (
+            len(self.pop_indices_vs_gids[prePop]),
+            len(self.pop_indices_vs_gids[postPop]),
+        )
+        pre, post, weights, delays = self.proj_connections[projName]
+
+        if np.any(np.asarray(delays, dtype=float) != 0):
+            print_v(
+                "Warning: delays of connections in %s are not supported in BindsNET"
+                % projName
+            )
+
+        connectivity = SparseConnectivity(*shape)
+        connectivity.add(pre, post, weights, weights, 0)
+        if connectivity.density < self.dense_fraction:
+            indices = np.vstack((connectivity.pre_cell_ids, connectivity.post_cell_ids))
+            w = torch.sparse_coo_tensor(
+                torch.from_numpy(indices),
+                torch.from_numpy(connectivity.weights.astype(np.float32)),
+                size=shape,
+            ).coalesce()
+        else:
+            w = torch.from_numpy(connectivity.to_dense().astype(np.float32))
+        return w
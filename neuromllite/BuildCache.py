@@ -0,0 +1,166 @@
+#
+#
+#   An on-disk cache of the cell locations of populations and the
+#   connectivity of projections generated for a network, so that elements
+#   which haven't changed between builds can be reused rather than regenerated
+#
+#
+
+from neuromllite.utils import print_v
+
+import numpy as np
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+# Increment when a change to the generation code means previously cached
+# elements can no longer be reused
+CACHE_FORMAT_VERSION = 1
+
+
+def _get_referenced_parameters(text, parameters):
+    """
+    The network parameters used, directly or through other parameters, in the
+    text of an element (e.g. the JSON for a projection)
+    """
+    referenced = {}
+    if not parameters:
+        return referenced
+
+    to_check = [text]
+    while to_check:
+        for name in re.findall(r"[A-Za-z_]\w*", str(to_check.pop())):
+            if name in parameters and name not in referenced:
+                referenced[name] = parameters[name]
+                to_check.append(parameters[name])
+
+    return referenced
+
+
+class BuildCache:
+    """
+    Cache of the locations and connections generated for the populations and
+    projections of a network, stored as compressed numpy files in cache_dir.
+
+    Each element is stored under a hash of its specification, the parameters
+    of the network it uses, the network seed and the block size, along with
+    the keys of anything else it depends on (e.g. the populations a
+    projection connects), so editing one element (or a parameter it uses)
+    only changes its key and those of the elements which depend on it.
+    """
+
+    def __init__(self, cache_dir, nl_model, seed, block_size):
+        self.cache_dir = cache_dir
+        self.nl_model = nl_model
+        self.seed = seed
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self, kind, element, *depends):
+        """
+        Get the key for an element (e.g. a Population or Projection) of kind,
+        which also depends on the other elements or values in depends
+        """
+        spec = element.to_json() if hasattr(element, "to_json") else str(element)
+        depends = [d.to_json() if hasattr(d, "to_json") else d for d in depends]
+        description = json.dumps(
+            {
+                "version": CACHE_FORMAT_VERSION,
+                "kind": kind,
+                "spec": spec,
+                "depends": depends,
+                "parameters": _get_referenced_parameters(
+                    spec + json.dumps(depends, default=str), self.nl_model.parameters
+                ),
+                "seed": self.seed,
+                "block_size": self.block_size,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return "%s_%s_%s" % (
+            kind,
+            element.id,
+            hashlib.sha256(description.encode()).hexdigest()[:32],
+        )
+
+    def _get_file_name(self, key):
+        return os.path.join(self.cache_dir, "%s.npz" % key)
+
+    def contains(self, key):
+        return os.path.isfile(self._get_file_name(key))
+
+    def _load(self, key):
+        file_name = self._get_file_name(key)
+        if not self.contains(key):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        print_v("Using cached %s" % file_name)
+        with np.load(file_name) as data:
+            return {name: data[name] for name in data.files}
+
+    def _save(self, key, **arrays):
+        # Write to a temporary file first, so that an interrupted build (or
+        # another process building the same network) never leaves a partial
+        # file under the key
+        fd, temp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temp_name, self._get_file_name(key))
+
+    def load_locations(self, key):
+        """
+        Get the cached locations of the cells of a population, or None
+        """
+        data = self._load(key)
+        return data["locations"] if data is not None else None
+
+    def save_locations(self, key, locations):
+        self._save(key, locations=locations)
+
+    def load_connections(self, key):
+        """
+        Get the cached blocks of connections (pre_indices, post_indices,
+        delays, weights) of a projection, in the blocks they were generated
+        in, or None
+        """
+        data = self._load(key)
+        if data is None:
+            return None
+
+        ends = np.cumsum(data["block_sizes"])
+        return [
+            tuple(
+                data[f][end - num : end] for f in ["pre", "post", "delays", "weights"]
+            )
+            for num, end in zip(data["block_sizes"], ends)
+        ]
+
+    def save_connections(self, key, blocks):
+        """
+        Pass through the blocks of connections of a projection, saving them
+        all under key once the last one has been generated
+        """
+        saved = []
+        for block in blocks:
+            num = len(block[0])
+            saved.append([np.broadcast_to(field, (num,)) for field in block])
+            yield block
+
+        self._save(
+            key,
+            block_sizes=np.array([len(b[0]) for b in saved], dtype=np.int64),
+            **{
+                f: np.concatenate([b[i] for b in saved]) if saved else np.zeros(0)
+                for i, f in enumerate(["pre", "post", "delays", "weights"])
+            }
+        )
@@ -0,0 +1,142 @@
+#
+#
+#   A compiled form of a NeuroMLlite Network, with the elements indexed by id
+#   and the sizes of populations evaluated once, for use while the network is
+#   being generated or handled
+#
+#
+
+from neuromllite.ExpressionCompiler import ExpressionCache
+from neuromllite.ParameterTable import get_parameter_table
+
+import numpy as np
+
+from types import MappingProxyType
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def _get_index(elements):
+    return MappingProxyType({e.id: i for i, e in enumerate(elements)})
+
+
+class CompiledNetwork:
+    """
+    Read only, array backed form of a NeuroMLlite Network, resolved once so
+    that looking up elements by id doesn't need a scan of the network's
+    lists (as Network.get_child does).
+
+    Holds:
+        cell_index, synapse_index, region_index, population_index,
+        projection_index, input_source_index: id -> index of each element
+            in its list in the network
+        population_sizes: the evaluated size of each population, in order
+        population_offsets: the global id (gid) of the first cell in each
+            population, with the cells of all populations numbered in order
+        num_cells: the total number of cells
+        cell_objects, synapse_objects: the NeuroML2 objects for the cells
+            and synapses (see NetworkGenerator._get_component_objects),
+            resolved relative to base_dir when first used
+
+    The network shouldn't be changed after it's compiled; compile it again
+    to use the changes.
+    """
+
+    def __init__(self, network, base_dir=None):
+        self.network = network
+        self.id = network.id
+        self.base_dir = base_dir
+
+        self.cells = tuple(network.cells)
+        self.synapses = tuple(network.synapses)
+        self.regions = tuple(network.regions)
+        self.populations = tuple(network.populations)
+        self.projections = tuple(network.projections)
+        self.input_sources = tuple(network.input_sources)
+
+        self.cell_index = _get_index(self.cells)
+        self.synapse_index = _get_index(self.synapses)
+        self.region_index = _get_index(self.regions)
+        self.population_index = _get_index(self.populations)
+        self.projection_index = _get_index(self.projections)
+        self.input_source_index = _get_index(self.input_sources)
+
+        expressions = ExpressionCache(get_parameter_table(network).get_values())
+        self.population_sizes = _read_only(
+            np.array(
+                [int(expressions.evaluate(p.size)) for p in self.populations],
+                dtype=np.int64,
+            )
+        )
+        offsets = np.zeros(len(self.populations) + 1, dtype=np.int64)
+        np.cumsum(self.population_sizes, out=offsets[1:])
+        self.num_cells = int(offsets[-1])
+        self.population_offsets = _read_only(offsets[:-1])
+
+        self._component_objects = None
+
+    def _get(self, elements, index, id):
+        i = index.get(id)
+        return elements[i] if i is not None else None
+
+    def get_cell(self, id):
+        return self._get(self.cells, self.cell_index, id)
+
+    def get_synapse(self, id):
+        return self._get(self.synapses, self.synapse_index, id)
+
+    def get_region(self, id):
+        return self._get(self.regions, self.region_index, id)
+
+    def get_population(self, id):
+        return self._get(self.populations, self.population_index, id)
+
+    def get_projection(self, id):
+        return self._get(self.projections, self.projection_index, id)
+
+    def get_input_source(self, id):
+        return self._get(self.input_sources, self.input_source_index, id)
+
+    def get_population_size(self, population_id):
+        return int(self.population_sizes[self.population_index[population_id]])
+
+    def get_gid(self, population_id, index):
+        """
+        Global id of cell index (or an array of indices) in the population
+        """
+        return self.population_offsets[self.population_index[population_id]] + index
+
+    def get_population_and_index(self, gid):
+        """
+        The id of the population and the index in it of the cell with the
+        global id gid
+        """
+        i = int(np.searchsorted(self.population_offsets, gid, side="right")) - 1
+        # Skip back over any empty populations starting at the same gid
+        while self.population_sizes[i] == 0:
+            i -= 1
+        return self.populations[i].id, int(gid - self.population_offsets[i])
+
+    def _get_component_objects(self):
+        if self._component_objects is None:
+            from neuromllite.NetworkGenerator import _get_component_objects
+
+            cell_objects, synapse_objects = _get_component_objects(
+                self.network, self.base_dir
+            )
+            self._component_objects = (
+                MappingProxyType(cell_objects),
+                MappingProxyType(synapse_objects),
+            )
+        return self._component_objects
+
+    @property
+    def cell_objects(self):
+        return self._get_component_objects()[0]
+
+    @property
+    def synapse_objects(self):
+        return self._get_component_objects()[1]
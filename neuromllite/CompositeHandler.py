@@ -0,0 +1,259 @@
+#
+#
+#   A handler which passes everything it is given on to a number of other
+#   handlers, so that a network only needs to be generated once for all of
+#   them (e.g. to export it to NeuroML2 and draw graphs/matrices of it)
+#
+#
+
+from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.utils import print_v
+
+
+class CompositeHandler(DefaultNetworkHandler):
+    """
+    Passes each event (populations, locations, projections, connections,
+    inputs, etc.) on to each of child_handlers in turn. Batches of locations,
+    connections and inputs are passed to the bulk methods (handle_locations,
+    handle_connections, handle_inputs) of the children which have them, and
+    one at a time to the others.
+
+    Individual connections are generated if any of the children need them;
+    only if none do are the totals for each projection passed on (see
+    DefaultNetworkHandler.needs_individual_connections).
+
+    property_overrides can give, for the child at each index of
+    child_handlers, a dict of the properties to pass to it for some of the
+    populations instead of those generated (e.g. {0: {"pop0": {}}} to give
+    the first child no properties for pop0).
+    """
+
+    def __init__(self, child_handlers, property_overrides=None):
+        print_v(
+            "Initiating CompositeHandler for: %s"
+            % ", ".join([h.__class__.__name__ for h in child_handlers])
+        )
+        self.child_handlers = list(child_handlers)
+        self.property_overrides = property_overrides if property_overrides else {}
+
+    def _forward(self, method, *args, **kwargs):
+        for handler in self.child_handlers:
+            getattr(handler, method)(*args, **kwargs)
+
+    def _forward_bulk(self, method, *args, **kwargs):
+        for handler in self.child_handlers:
+            if hasattr(handler, method):
+                getattr(handler, method)(*args, **kwargs)
+            else:
+                # e.g. handlers from libNeuroML, which don't have bulk methods
+                getattr(DefaultNetworkHandler, method)(handler, *args, **kwargs)
+
+    def _forward_optional(self, method, *args, **kwargs):
+        for handler in self.child_handlers:
+            if hasattr(handler, method):
+                getattr(handler, method)(*args, **kwargs)
+
+    def handle_document_start(self, id, notes):
+        self._forward("handle_document_start", id, notes)
+
+    def finalise_document(self):
+        self._forward_optional("finalise_document")
+
+    def handle_network(self, network_id, notes, temperature=None):
+        self._forward("handle_network", network_id, notes, temperature=temperature)
+
+    def handle_population(
+        self,
+        population_id,
+        component,
+        size=-1,
+        component_obj=None,
+        properties={},
+        notes=None,
+    ):
+        kwargs = {"notes": notes} if notes else {}
+        for i, handler in enumerate(self.child_handlers):
+            overrides = self.property_overrides.get(i, {})
+            handler.handle_population(
+                population_id,
+                component,
+                size,
+                component_obj,
+                properties=overrides.get(population_id, properties),
+                **kwargs
+            )
+
+    def handle_location(self, id, population_id, component, x, y, z):
+        self._forward("handle_location", id, population_id, component, x, y, z)
+
+    def handle_locations(self, population_id, component, positions, start_id=0):
+        self._forward_bulk(
+            "handle_locations",
+            population_id,
+            component,
+            positions,
+            start_id=start_id,
+        )
+
+    def finalise_population(self, population_id):
+        self._forward_optional("finalise_population", population_id)
+
+    def handle_projection(
+        self,
+        projName,
+        prePop,
+        postPop,
+        synapse,
+        hasWeights=False,
+        hasDelays=False,
+        type="projection",
+        synapse_obj=None,
+        pre_synapse_obj=None,
+    ):
+        self._forward(
+            "handle_projection",
+            projName,
+            prePop,
+            postPop,
+            synapse,
+            hasWeights=hasWeights,
+            hasDelays=hasDelays,
+            type=type,
+            synapse_obj=synapse_obj,
+            pre_synapse_obj=pre_synapse_obj,
+        )
+
+    def handle_connection(
+        self,
+        projName,
+        id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellId,
+        postCellId,
+        preSegId=0,
+        preFract=0.5,
+        postSegId=0,
+        postFract=0.5,
+        delay=0,
+        weight=1,
+    ):
+        self._forward(
+            "handle_connection",
+            projName,
+            id,
+            prePop,
+            postPop,
+            synapseType,
+            preCellId,
+            postCellId,
+            preSegId=preSegId,
+            preFract=preFract,
+            postSegId=postSegId,
+            postFract=postFract,
+            delay=delay,
+            weight=weight,
+        )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+        self._forward_bulk(
+            "handle_connections",
+            projName,
+            start_id,
+            prePop,
+            postPop,
+            synapseType,
+            preCellIds,
+            postCellIds,
+            preSegIds=preSegIds,
+            preFracts=preFracts,
+            postSegIds=postSegIds,
+            postFracts=postFracts,
+            delays=delays,
+            weights=weights,
+        )
+
+    def needs_individual_connections(self):
+        return any(
+            not hasattr(handler, "needs_individual_connections")
+            or handler.needs_individual_connections()
+            for handler in self.child_handlers
+        )
+
+    def handle_connection_totals(
+        self, projName, prePop, postPop, synapseType, num_connections, total_weight
+    ):
+        self._forward(
+            "handle_connection_totals",
+            projName,
+            prePop,
+            postPop,
+            synapseType,
+            num_connections,
+            total_weight,
+        )
+
+    def finalise_projection(
+        self, projName, prePop, postPop, synapse=None, type="projection"
+    ):
+        kwargs = {"type": type} if type != "projection" else {}
+        self._forward(
+            "finalise_projection", projName, prePop, postPop, synapse, **kwargs
+        )
+
+    def handle_input_list(
+        self, inputListId, population_id, component, size, input_comp_obj=None
+    ):
+        self._forward(
+            "handle_input_list",
+            inputListId,
+            population_id,
+            component,
+            size,
+            input_comp_obj=input_comp_obj,
+        )
+
+    def handle_single_input(
+        self, inputListId, id, cellId, segId=0, fract=0.5, weight=1
+    ):
+        self._forward(
+            "handle_single_input",
+            inputListId,
+            id,
+            cellId,
+            segId=segId,
+            fract=fract,
+            weight=weight,
+        )
+
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+        self._forward_bulk(
+            "handle_inputs",
+            inputListId,
+            start_id,
+            cellIds,
+            segIds=segIds,
+            fracts=fracts,
+            weights=weights,
+        )
+
+    def finalise_input_source(self, inputName):
+        self._forward("finalise_input_source", inputName)
@@ -0,0 +1,449 @@
+#
+#
+#   Functions for generating the connectivity of projections as arrays of
+#   cell indices, using numpy random number generators
+#
+#
+
+import itertools
+
+import numpy as np
+
+# Maximum number of (pre, post) cell pairs sampled at once. Larger values use
+# more memory, but the connections generated do not depend on this value.
+DEFAULT_BLOCK_SIZE = 1000000
+
+# Default number of connections in each chunk when streaming connections
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def get_rows_per_block(num_cols, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Number of rows of a num_rows x num_cols array of candidate pairs which can
+    be processed at once while keeping within block_size pairs (at least 1)
+    """
+    return max(1, int(block_size) // max(1, num_cols))
+
+
+def random_connectivity_blocks(
+    rng, num_pre, num_post, probability, block_size=DEFAULT_BLOCK_SIZE
+):
+    """
+    Generate the connections of a projection where each pre/post cell pair is
+    connected independently with the given probability.
+
+    The pairs are considered in the order (pre 0, post 0), (pre 0, post 1), ...
+    (pre 1, post 0), ..., taking one uniform sample from rng for each pair in
+    that order. As numpy Generators fill arrays sequentially from their
+    stream, the connections generated for a given rng state are independent
+    of block_size.
+
+    probability can be a number or a function which takes the shape of the
+    block (rows, num_post) and returns an array of probabilities for it.
+
+    Yields tuples of arrays (pre_indices, post_indices), sorted by pre index
+    then post index, covering at most block_size candidate pairs each.
+    """
+    rows_per_block = get_rows_per_block(num_post, block_size)
+
+    for start in range(0, num_pre, rows_per_block):
+        end = min(num_pre, start + rows_per_block)
+        shape = (end - start, num_post)
+        flips = rng.random(shape)
+        p = probability(shape) if callable(probability) else probability
+        pre_indices, post_indices = np.nonzero(flips < p)
+        yield pre_indices + start, post_indices
+
+
+def random_connectivity_count(rng, num_pre, num_post, probability):
+    """
+    The number of connections of a projection where each pre/post cell pair
+    is connected independently with the (constant) probability, drawn from
+    the same (binomial) distribution as the number generated by
+    random_connectivity_blocks, but without sampling each pair
+    """
+    probability = min(1.0, max(0.0, float(probability)))
+    return int(rng.binomial(num_pre * num_post, probability))
+
+
+# Offsets of a cube of a uniform grid and its 26 neighbours
+_NEIGHBOUR_OFFSETS = np.array(list(itertools.product([-1, 0, 1], repeat=3)))
+
+
+def _get_grid_keys(grid_cells, grid_shape):
+    """
+    Index of each of the (x, y, z) grid cubes in a grid of the given shape
+    """
+    x, y, z = grid_cells[:, 0], grid_cells[:, 1], grid_cells[:, 2]
+    return (x * grid_shape[1] + y) * grid_shape[2] + z
+
+
+def distance_dependent_connectivity_blocks(
+    rng,
+    pre_positions,
+    post_positions,
+    cutoff,
+    probability=1,
+    exclude_self=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of a projection where each pair of pre/post cells
+    at most cutoff apart is connected with a probability which can depend on
+    the distance between them.
+
+    The post cells are indexed in a uniform grid of cubes with side cutoff, so
+    only pairs of cells in neighbouring cubes are considered, rather than all
+    num_pre x num_post pairs. Candidate pairs within cutoff are considered in
+    the order (pre 0, post i), (pre 0, post j > i), ... (pre 1, ...), taking
+    one uniform sample from rng for each, so the connections generated for a
+    given rng state are independent of block_size.
+
+    probability can be a number or a function which takes an array of
+    distances and returns an array of probabilities for them. If exclude_self
+    is True, cells with the same pre and post index are not connected (for
+    projections from a population to itself).
+
+    Yields tuples of arrays (pre_indices, post_indices, distances), sorted by
+    pre index then post index, from up to block_size candidate pairs each.
+    """
+    pre_positions = np.reshape(np.asarray(pre_positions, dtype=float), (-1, 3))
+    post_positions = np.reshape(np.asarray(post_positions, dtype=float), (-1, 3))
+    num_pre = len(pre_positions)
+    if num_pre == 0 or len(post_positions) == 0 or not cutoff > 0:
+        return
+
+    origin = post_positions.min(axis=0)
+    post_grid_cells = np.floor((post_positions - origin) / cutoff).astype(np.int64)
+    grid_shape = post_grid_cells.max(axis=0) + 1
+    if np.prod(grid_shape.astype(float)) >= 2**62:
+        raise Exception(
+            "Cutoff %s is too small for a grid over the postsynaptic cells (%s cubes)"
+            % (cutoff, grid_shape)
+        )
+
+    post_keys = _get_grid_keys(post_grid_cells, grid_shape)
+    order = np.argsort(post_keys, kind="stable")
+    sorted_keys = post_keys[order]
+
+    # The range in order of the post cells in each of the cubes around each pre cell
+    pre_grid_cells = np.floor((pre_positions - origin) / cutoff).astype(np.int64)
+    starts = np.zeros((num_pre, len(_NEIGHBOUR_OFFSETS)), dtype=np.int64)
+    counts = np.zeros((num_pre, len(_NEIGHBOUR_OFFSETS)), dtype=np.int64)
+
+    for i, offset in enumerate(_NEIGHBOUR_OFFSETS):
+        grid_cells = pre_grid_cells + offset
+        valid = np.all((grid_cells >= 0) & (grid_cells < grid_shape), axis=1)
+        keys = _get_grid_keys(np.where(valid[:, None], grid_cells, 0), grid_shape)
+        starts[:, i] = np.searchsorted(sorted_keys, keys, "left")
+        ends = np.searchsorted(sorted_keys, keys, "right")
+        counts[:, i] = np.where(valid, ends - starts[:, i], 0)
+
+    candidates_per_pre = counts.sum(axis=1)
+    cumulative_candidates = np.cumsum(candidates_per_pre)
+
+    start = 0
+    while start < num_pre:
+        done = cumulative_candidates[start - 1] if start > 0 else 0
+        end = np.searchsorted(cumulative_candidates, done + block_size, "right")
+        end = min(num_pre, max(start + 1, end))
+
+        block_counts = counts[start:end].ravel()
+        block_starts = starts[start:end].ravel()
+        total = block_counts.sum()
+        first = np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+
+        pre_indices = np.repeat(np.arange(start, end), candidates_per_pre[start:end])
+        post_indices = order[
+            np.repeat(block_starts, block_counts) + np.arange(total) - first
+        ]
+        distances = np.linalg.norm(
+            pre_positions[pre_indices] - post_positions[post_indices], axis=1
+        )
+
+        near = distances <= cutoff
+        if exclude_self:
+            near &= pre_indices != post_indices
+        pre_indices = pre_indices[near]
+        post_indices = post_indices[near]
+        distances = distances[near]
+
+        in_order = np.lexsort((post_indices, pre_indices))
+        pre_indices = pre_indices[in_order]
+        post_indices = post_indices[in_order]
+        distances = distances[in_order]
+
+        flips = rng.random(len(pre_indices))
+        p = probability(distances) if callable(probability) else probability
+        connected = flips < p
+        yield pre_indices[connected], post_indices[connected], distances[connected]
+
+        start = end
+
+
+def _sample_fixed_number(
+    rng, num_candidates, exclude, num, with_replacement=True, redraw_rng=None
+):
+    """
+    Sample num indices in range(num_candidates) for each row of exclude, an
+    array with an index for each row which should not be sampled in it (or -1
+    for none), returning an array of shape (len(exclude), num), sorted along
+    each row.
+
+    Without replacement, each row is a uniformly random set of num distinct
+    indices: the first num distinct values of a fixed number of samples drawn
+    for each row, or, if num is a large fraction of the candidates, the first
+    num of a random ordering. A fixed number of samples is taken from rng for
+    each row, in order, so the rows sampled for a given rng state don't
+    depend on how they're split into blocks; the few rows which need more
+    samples are completed in order from redraw_rng (by default rng).
+    """
+    num_rows = len(exclude)
+    num_available = num_candidates - (exclude >= 0)
+    if num > 0 and np.any(num_available < (num if not with_replacement else 1)):
+        raise Exception(
+            "Can't choose %i connections from %i cells%s"
+            % (
+                num,
+                num_available.min(),
+                "" if with_replacement else " without replacement",
+            )
+        )
+
+    if with_replacement or num == 0:
+        indices = rng.integers(0, num_available[:, None], (num_rows, num))
+
+    elif 4 * num > num_candidates:
+        keys = rng.random((num_rows, num_candidates))
+        keys[exclude >= 0, exclude[exclude >= 0]] = np.inf
+        indices = np.argpartition(keys, num - 1, axis=1)[:, :num]
+        indices.sort(axis=1)
+        return indices
+
+    else:
+        draws = rng.integers(0, num_available[:, None], (num_rows, num + num // 4 + 8))
+
+        # The first occurrence of each value in each row, in order of drawing
+        order = np.argsort(draws, axis=1, kind="stable")
+        sorted_draws = np.take_along_axis(draws, order, axis=1)
+        first_in_sorted = np.ones(draws.shape, dtype=bool)
+        first_in_sorted[:, 1:] = sorted_draws[:, 1:] != sorted_draws[:, :-1]
+        first = np.empty(draws.shape, dtype=bool)
+        np.put_along_axis(first, order, first_in_sorted, axis=1)
+
+        chosen = first & (np.cumsum(first, axis=1) <= num)
+        complete = chosen.sum(axis=1) == num
+        indices = np.empty((num_rows, num), dtype=draws.dtype)
+        indices[complete] = draws[chosen & complete[:, None]].reshape(-1, num)
+
+        redraw_rng = redraw_rng if redraw_rng is not None else rng
+        for row in np.nonzero(~complete)[0]:
+            values = draws[row][first[row]].tolist()
+            found = set(values)
+            while len(values) < num:
+                value = int(redraw_rng.integers(0, num_available[row]))
+                if value not in found:
+                    found.add(value)
+                    values.append(value)
+            indices[row] = values
+
+    # Skip over the excluded index in each row
+    indices += (exclude[:, None] >= 0) & (indices >= exclude[:, None])
+    indices.sort(axis=1)
+    return indices
+
+
+def fixed_number_connectivity_count(
+    num_rows, num_cols, num_per_row, exclude_self=False, with_replacement=True
+):
+    """
+    The number of connections made by choosing num_per_row columns for each
+    of num_rows rows (e.g. by convergent_connectivity_blocks, with a row for
+    each post cell), checking that they can be chosen
+    """
+    num_per_row = int(num_per_row)
+    if num_rows > 0 and num_per_row > 0:
+        num_available = num_cols - (1 if exclude_self and num_cols > 0 else 0)
+        if num_available < (num_per_row if not with_replacement else 1):
+            raise Exception(
+                "Can't choose %i connections from %i cells%s"
+                % (
+                    num_per_row,
+                    num_available,
+                    "" if with_replacement else " without replacement",
+                )
+            )
+    return num_rows * num_per_row
+
+
+def _fixed_number_blocks(
+    rng,
+    num_rows,
+    num_cols,
+    num_per_row,
+    exclude_self=False,
+    with_replacement=True,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Yield tuples of arrays (row_indices, col_indices), choosing num_per_row
+    columns for each row in turn, in blocks of rows with at most block_size
+    connections
+    """
+    num_per_row = int(num_per_row)
+    rows_per_block = get_rows_per_block(num_per_row, block_size)
+    # Seeded once, so rows completed from it are the same for any block_size
+    redraw_rng = np.random.default_rng(rng.integers(2**63))
+
+    for start in range(0, num_rows, rows_per_block):
+        end = min(num_rows, start + rows_per_block)
+        rows = np.arange(start, end)
+        exclude = np.full(len(rows), -1)
+        if exclude_self:
+            exclude[rows < num_cols] = rows[rows < num_cols]
+        cols = _sample_fixed_number(
+            rng, num_cols, exclude, num_per_row, with_replacement, redraw_rng
+        )
+        yield np.repeat(rows, num_per_row), cols.ravel()
+
+
+def convergent_connectivity_blocks(
+    rng,
+    num_pre,
+    num_post,
+    num_per_post,
+    exclude_self=False,
+    with_replacement=True,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of a projection where each post cell receives
+    num_per_post connections from randomly chosen pre cells, with or without
+    replacement (i.e. allowing repeated pre/post pairs or not). If
+    exclude_self is True, cells with the same pre and post index are not
+    connected (for projections from a population to itself).
+
+    Yields tuples of arrays (pre_indices, post_indices), sorted by post index
+    then pre index, with at most block_size connections each.
+    """
+    for post_indices, pre_indices in _fixed_number_blocks(
+        rng, num_post, num_pre, num_per_post, exclude_self, with_replacement, block_size
+    ):
+        yield pre_indices, post_indices
+
+
+def divergent_connectivity_blocks(
+    rng,
+    num_pre,
+    num_post,
+    num_per_pre,
+    exclude_self=False,
+    with_replacement=True,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of a projection where each pre cell makes
+    num_per_pre connections to randomly chosen post cells, with or without
+    replacement. If exclude_self is True, cells with the same pre and post
+    index are not connected.
+
+    Yields tuples of arrays (pre_indices, post_indices), sorted by pre index
+    then post index, with at most block_size connections each.
+    """
+    for pre_indices, post_indices in _fixed_number_blocks(
+        rng, num_pre, num_post, num_per_pre, exclude_self, with_replacement, block_size
+    ):
+        yield pre_indices, post_indices
+
+
+def total_number_connectivity_count(
+    num_pre, num_post, number, exclude_self=False, with_replacement=True
+):
+    """
+    The number of connections of a projection with number connections in
+    total (see total_number_connectivity_blocks), checking that they can be
+    chosen
+    """
+    number = int(number)
+    num_cols = num_post - 1 if exclude_self else num_post
+    num_pairs = num_pre * max(0, num_cols)
+    if num_pairs < (number if not with_replacement else min(1, number)):
+        raise Exception(
+            "Can't choose %i connections from %i pairs of cells%s"
+            % (number, num_pairs, "" if with_replacement else " without replacement")
+        )
+    return number
+
+
+def total_number_connectivity_blocks(
+    rng,
+    num_pre,
+    num_post,
+    number,
+    exclude_self=False,
+    with_replacement=True,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of a projection with number connections between
+    randomly chosen pre/post cell pairs, with or without replacement. If
+    exclude_self is True, cells with the same pre and post index are not
+    connected.
+
+    Yields tuples of arrays (pre_indices, post_indices), sorted by pre index
+    then post index, with at most block_size connections each.
+    """
+    number = total_number_connectivity_count(
+        num_pre, num_post, number, exclude_self, with_replacement
+    )
+    # Pairs are numbered pre * num_cols + col, where for exclude_self the
+    # post index is col, or col + 1 for col >= pre
+    num_cols = num_post - 1 if exclude_self else num_post
+    num_pairs = num_pre * max(0, num_cols)
+
+    if number == 0:
+        return
+    if with_replacement:
+        pairs = np.sort(rng.integers(0, num_pairs, number))
+    else:
+        pairs = np.sort(rng.choice(num_pairs, number, replace=False))
+
+    for start in range(0, number, max(1, int(block_size))):
+        block = pairs[start : start + max(1, int(block_size))]
+        pre_indices, post_indices = np.divmod(block, num_cols)
+        if exclude_self:
+            post_indices += post_indices >= pre_indices
+        yield pre_indices, post_indices
+
+
+def rechunk_connections(blocks, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Regroup blocks of connections (pre_indices, post_indices, delays, weights)
+    of any size into chunks of exactly chunk_size connections (apart from the
+    last one, which may be smaller).
+
+    delays and weights in the blocks can be single values; in the chunks
+    yielded, all four are arrays of the same length. At most one block plus
+    one chunk of connections are held in memory at a time.
+    """
+    buffered = []
+    num_buffered = 0
+
+    for block in blocks:
+        num = len(block[0])
+        if num == 0:
+            continue
+        buffered.append([np.broadcast_to(field, (num,)) for field in block])
+        num_buffered += num
+
+        if num_buffered >= chunk_size:
+            fields = [np.concatenate([b[i] for b in buffered]) for i in range(4)]
+            start = 0
+            while num_buffered - start >= chunk_size:
+                yield tuple(f[start : start + chunk_size] for f in fields)
+                start += chunk_size
+            buffered = [[f[start:] for f in fields]]
+            num_buffered -= start
+
+    if num_buffered > 0:
+        yield tuple(np.concatenate([b[i] for b in buffered]) for i in range(4))
@@ -8,6 +8,134 @@ from neuromllite.utils import print_v
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
 from pyneuroml.pynml import convert_to_units
 
+import numpy as np
+
+
+class SparseConnectivity:
+    """
+    The connections of a projection between individual cells, accumulated in
+    coordinate (COO) form as they're handled (singly or in batches), rather
+    than in dense pre_size x post_size arrays, which for large populations
+    wouldn't fit in memory.
+
+    When first read, the connections between each pair of cells are combined:
+    their weights, scaled weights and numbers are summed, and the delay of the
+    last one is used. The combined values are in compressed sparse row (CSR)
+    order: those for the connections from pre cell i are in the slice
+    indptr[i]:indptr[i + 1] of post_cell_ids, weights, scaled_weights,
+    conn_numbers and delays. to_dense() gives any of them as a dense array.
+    """
+
+    VALUES = ["weights", "scaled_weights", "conn_numbers", "delays"]
+
+    def __init__(self, pre_size, post_size):
+        self.pre_size = pre_size
+        self.post_size = post_size
+        self._chunks = []
+        self._combined = None
+
+    def add(self, pre_cell_ids, post_cell_ids, weights, scaled_weights, delays):
+        pre_cell_ids = np.asarray(pre_cell_ids, dtype=np.int64).reshape(-1)
+        num = len(pre_cell_ids)
+        self._chunks.append(
+            (
+                pre_cell_ids,
+                np.asarray(post_cell_ids, dtype=np.int64).reshape(-1),
+                np.array(np.broadcast_to(weights, (num,)), dtype=float),
+                np.array(np.broadcast_to(scaled_weights, (num,)), dtype=float),
+                np.array(np.broadcast_to(delays, (num,)), dtype=float),
+            )
+        )
+        self._combined = None
+
+    def _combine(self):
+        if self._combined is not None:
+            return self._combined
+
+        if self._chunks:
+            pre, post, weights, scaled_weights, delays = [
+                np.concatenate(a) for a in zip(*self._chunks)
+            ]
+            # Keep the concatenated arrays, rather than many small chunks
+            self._chunks = [(pre, post, weights, scaled_weights, delays)]
+        else:
+            pre, post = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            weights = scaled_weights = delays = np.zeros(0)
+
+        keys, inverse = np.unique(pre * self.post_size + post, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        num_pairs = len(keys)
+        # The sums are in the order the connections were added
+        combined = {
+            "weights": np.bincount(inverse, weights, minlength=num_pairs),
+            "scaled_weights": np.bincount(inverse, scaled_weights, minlength=num_pairs),
+            "conn_numbers": np.bincount(inverse, minlength=num_pairs),
+        }
+        last = np.zeros(num_pairs, dtype=np.int64)
+        np.maximum.at(last, inverse, np.arange(len(inverse)))
+        combined["delays"] = delays[last]
+
+        combined["pre_cell_ids"] = keys // self.post_size
+        combined["post_cell_ids"] = keys % self.post_size
+        combined["indptr"] = np.searchsorted(
+            combined["pre_cell_ids"], np.arange(self.pre_size + 1)
+        )
+        self._combined = combined
+        return combined
+
+    @property
+    def num_pairs(self):
+        """Number of pairs of cells with at least one connection"""
+        return len(self._combine()["pre_cell_ids"])
+
+    @property
+    def density(self):
+        """Fraction of the pre_size x post_size pairs of cells which are connected"""
+        num = self.pre_size * self.post_size
+        return self.num_pairs / num if num > 0 else 0.0
+
+    @property
+    def pre_cell_ids(self):
+        return self._combine()["pre_cell_ids"]
+
+    @property
+    def post_cell_ids(self):
+        return self._combine()["post_cell_ids"]
+
+    @property
+    def indptr(self):
+        return self._combine()["indptr"]
+
+    @property
+    def weights(self):
+        return self._combine()["weights"]
+
+    @property
+    def scaled_weights(self):
+        return self._combine()["scaled_weights"]
+
+    @property
+    def conn_numbers(self):
+        return self._combine()["conn_numbers"]
+
+    @property
+    def delays(self):
+        return self._combine()["delays"]
+
+    def to_dense(self, values="weights"):
+        """
+        Dense pre_size x post_size array of one of VALUES, with 0 for pairs
+        of cells which aren't connected
+        """
+        if not values in self.VALUES:
+            raise Exception(
+                "Unknown values: %s; expected one of %s" % (values, self.VALUES)
+            )
+        combined = self._combine()
+        dense = np.zeros((self.pre_size, self.post_size))
+        dense[combined["pre_cell_ids"], combined["post_cell_ids"]] = combined[values]
+        return dense
+
 
 class ConnectivityHandler(DefaultNetworkHandler):
 
@@ -31,10 +159,8 @@ class ConnectivityHandler(DefaultNetworkHandler):
     proj_conns = {}
     proj_tot_weight = {}
     proj_syn_objs = {}
-    proj_individual_weights = {}
-    proj_individual_scaled_weights = {}
-    proj_individual_conn_numbers = {}
-    proj_delays = {}
+    # SparseConnectivity of each projection, at cell level
+    proj_cell_connectivity = {}
 
     syn_conds_used = {}
 
@@ -46,6 +172,38 @@ class ConnectivityHandler(DefaultNetworkHandler):
     def handle_document_start(self, id, notes):
 
         print_v("Document: %s" % id)
+        self._init_state()
+
+    def _init_state(self):
+        """
+        Give this handler its own dicts for the elements of the network, rather
+        than the class attributes above, e.g. so that several can be used at
+        once in a CompositeHandler
+        """
+        self.positions = {}
+
+        self.pop_sizes = {}
+        self.pop_colors = {}
+        self.pop_types = {}
+        self.pop_nml_component_objs = {}
+
+        self.proj_weights = {}
+        self.proj_shapes = {}
+        self.proj_lines = {}
+        self.proj_pre_pops = {}
+        self.proj_post_pops = {}
+        self.proj_types = {}
+        self.proj_conns = {}
+        self.proj_tot_weight = {}
+        self.proj_syn_objs = {}
+        self.proj_cell_connectivity = {}
+
+        self.syn_conds_used = {}
+
+        self.sizes_ils = {}
+        self.pops_ils = {}
+        self.weights_ils = {}
+        self.input_comp_obj_ils = {}
 
     def handle_network(self, network_id, notes, temperature=None):
 
@@ -87,6 +245,15 @@ class ConnectivityHandler(DefaultNetworkHandler):
     def get_size_post_pop(self, projName):
         return self.pop_sizes[self.proj_post_pops[projName]]
 
+    def init_cell_connectivity(self, projName, prePop, postPop):
+        """
+        Start accumulating the connections of a projection between individual
+        cells, in a SparseConnectivity (only used at cell level)
+        """
+        self.proj_cell_connectivity[projName] = SparseConnectivity(
+            self.pop_sizes[prePop], self.pop_sizes[postPop]
+        )
+
     def get_reversal_potential_mV(self, synapse_obj):
 
         if hasattr(synapse_obj, "erev"):
@@ -158,6 +325,10 @@ class ConnectivityHandler(DefaultNetworkHandler):
 
         pass
 
+    def handle_locations(self, population_id, component, positions, start_id=0):
+
+        pass
+
     def handle_connection(
         self,
         projName,
@@ -179,17 +350,55 @@ class ConnectivityHandler(DefaultNetworkHandler):
         self.proj_conns[projName] += 1
         self.proj_tot_weight[projName] += weight
         if self.is_cell_level():
-            self.proj_individual_weights[projName][preCellId][postCellId] += weight
-            self.proj_individual_scaled_weights[projName][preCellId][
-                postCellId
-            ] += self._scale_individual_weight(weight, projName)
-            self.proj_individual_conn_numbers[projName][preCellId][postCellId] += 1
-            """
-            print_v("   - Now total weight between these cells is %s (scaled: %s) from %i individual conns" % \
-                       (self.proj_individual_weights[projName][preCellId][postCellId],
-                       self.proj_individual_scaled_weights[projName][preCellId][postCellId],
-                       self.proj_individual_conn_numbers[projName][preCellId][postCellId]))"""
-            self.proj_delays[projName][preCellId][postCellId] = delay
+            self.proj_cell_connectivity[projName].add(
+                preCellId,
+                postCellId,
+                weight,
+                self._scale_individual_weight(weight, projName),
+                delay,
+            )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1.0,
+    ):
+
+        num = len(preCellIds)
+        weights = np.broadcast_to(weights, (num,))
+        self.proj_conns[projName] += num
+        self.proj_tot_weight[projName] += weights.sum().item()
+        if self.is_cell_level():
+            # The scaling of individual weights is linear in the weight
+            self.proj_cell_connectivity[projName].add(
+                preCellIds,
+                postCellIds,
+                weights,
+                weights * self._scale_individual_weight(1.0, projName),
+                delays,
+            )
+
+    # Only the totals for each projection are needed at population level
+    def needs_individual_connections(self):
+        return self.is_cell_level()
+
+    def handle_connection_totals(
+        self, projName, prePop, postPop, synapseType, num_connections, total_weight
+    ):
+
+        self.proj_conns[projName] += num_connections
+        self.proj_tot_weight[projName] += total_weight
 
     def finalise_projection(
         self, projName, prePop, postPop, synapse=None, type="projection"
@@ -218,3 +427,13 @@ class ConnectivityHandler(DefaultNetworkHandler):
         if self.include_ext_inputs:
             self.sizes_ils[inputListId] += 1
             self.weights_ils[inputListId] += weight
+
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+        if self.include_ext_inputs:
+            num = len(cellIds)
+            self.sizes_ils[inputListId] += num
+            self.weights_ils[inputListId] += (
+                np.broadcast_to(weights, (num,)).sum().item()
+            )
@@ -19,6 +19,16 @@
 
 from neuromllite.utils import print_v
 
+import numpy as np
+
+
+def _as_lists(num, *values):
+    """
+    Broadcast each of the values (a single number or an array of num numbers)
+    to a list of num Python numbers
+    """
+    return [np.broadcast_to(value, (num,)).tolist() for value in values]
+
 
 class DefaultNetworkHandler:
 
@@ -138,6 +148,15 @@ class DefaultNetworkHandler:
     def handle_location(self, id, population_id, component, x, y, z):
         self.print_location_information(id, population_id, component, x, y, z)
 
+    #
+    #  Can be overridden to create many cell instances at once. positions is an
+    #  array of shape (n, 3) and the cells have ids start_id, ..., start_id+n-1.
+    #  By default handle_location is called for each cell
+    #
+    def handle_locations(self, population_id, component, positions, start_id=0):
+        for i, (x, y, z) in enumerate(np.asarray(positions).tolist()):
+            self.handle_location(start_id + i, population_id, component, x, y, z)
+
     def finalise_population(self, population_id):
 
         pass
@@ -217,6 +236,83 @@ class DefaultNetworkHandler:
                 )
             )
 
+    #
+    #  Can be overridden to handle many network connections at once. The
+    #  connections have ids start_id, start_id+1, ... and preCellIds,
+    #  postCellIds are arrays of cell indices; each of the other arguments can
+    #  be an array of the same length or a single value used for all of them.
+    #  By default handle_connection is called for each connection
+    #
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+        num = len(preCellIds)
+        for i, conn in enumerate(
+            zip(
+                *_as_lists(
+                    num,
+                    preCellIds,
+                    postCellIds,
+                    preSegIds,
+                    preFracts,
+                    postSegIds,
+                    postFracts,
+                    delays,
+                    weights,
+                )
+            )
+        ):
+            pre, post, preSeg, preFract, postSeg, postFract, delay, weight = conn
+            self.handle_connection(
+                projName,
+                start_id + i,
+                prePop,
+                postPop,
+                synapseType,
+                pre,
+                post,
+                preSegId=preSeg,
+                preFract=preFract,
+                postSegId=postSeg,
+                postFract=postFract,
+                delay=delay,
+                weight=weight,
+            )
+
+    #
+    #  Can be overridden to return False for handlers which only use the
+    #  number of connections and total weight of each projection, which are
+    #  then passed to handle_connection_totals instead of the connections
+    #
+    def needs_individual_connections(self):
+
+        return True
+
+    #
+    #  Should be overridden by handlers which don't need individual connections
+    #
+    def handle_connection_totals(
+        self, projName, prePop, postPop, synapseType, num_connections, total_weight
+    ):
+
+        print_v(
+            "  %s connections in %s (%s -> %s, syn: %s), total weight: %s"
+            % (num_connections, projName, prePop, postPop, synapseType, total_weight)
+        )
+
     #
     #  Should be overridden to handle end of network connection
     #
@@ -261,6 +357,29 @@ class DefaultNetworkHandler:
             % (inputListId, id, cellId, segId, fract, weight)
         )
 
+    #
+    #  Can be overridden to connect many inputs at once. The inputs have ids
+    #  start_id, start_id+1, ... and cellIds is an array of cell indices; each
+    #  of the other arguments can be an array of the same length or a single
+    #  value used for all of them.
+    #  By default handle_single_input is called for each input
+    #
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+        num = len(cellIds)
+        for i, (cellId, segId, fract, weight) in enumerate(
+            zip(*_as_lists(num, cellIds, segIds, fracts, weights))
+        ):
+            self.handle_single_input(
+                inputListId,
+                start_id + i,
+                cellId,
+                segId=segId,
+                fract=fract,
+                weight=weight,
+            )
+
     #
     #  Should be overridden to to connect each input to the target cell
     #
@@ -0,0 +1,207 @@
+#
+#
+#   Classes for compiling the expressions (EvaluableExpression) used for the
+#   sizes, weights, delays, probabilities etc. in a network, so that each is
+#   parsed once per build and can be evaluated for many connections at once
+#
+#
+
+from modelspec.utils import evaluate
+
+import ast
+import math
+import types
+
+import numpy as np
+
+CONSTANT = "constant"
+PARAMETER = "parameter"
+VARIABLE = "variable"
+RANDOM = "random"
+
+# Functions which draw random numbers, in expressions like "normal(2, 0.5)"
+RANDOM_FUNCTIONS = ["random", "normal", "uniform", "lognormal"]
+
+# Names which evaluate() may have added to a dict of parameters
+_NON_PARAMETERS = ["__builtins__", "rng", "math", "numpy"]
+
+# Versions of the contents of math which also work elementwise on arrays
+_array_math = types.SimpleNamespace(
+    **{
+        name: getattr(np, name, getattr(math, name))
+        for name in dir(math)
+        if not name.startswith("_")
+    }
+)
+
+
+def _get_random_functions(rng, size=None):
+    """
+    The functions available for random numbers in expressions, using the
+    numpy Generator rng and returning arrays of the given size (or single
+    values for size=None)
+    """
+    return {
+        "random": lambda: rng.random(size),
+        "normal": lambda mean=0.0, sd=1.0: rng.normal(mean, sd, size),
+        "uniform": lambda low=0.0, high=1.0: rng.uniform(low, high, size),
+        "lognormal": lambda mean=0.0, sigma=1.0: rng.lognormal(mean, sigma, size),
+    }
+
+
+class CompiledExpression:
+    """
+    An expression (a number, a parameter name or a string like
+    "weight * random()") parsed once for the given parameters and classified
+    as CONSTANT (e.g. 2, "3 * 0.5"), PARAMETER (depends only on the
+    parameters, e.g. "2 * weight"), VARIABLE (depends on one of the names in
+    variables, whose values are given when it's evaluated, e.g. the distance
+    "r" in "math.exp(-r/100)") or RANDOM (uses random(), normal(mean, sd),
+    uniform(low, high) or lognormal(mean, sigma)).
+
+    Constant and parameter expressions are evaluated once; the others are
+    evaluated with a numpy random number Generator, either for a single value
+    or for an array of values in one call.
+    """
+
+    def __init__(self, expr, parameters=None, variables=()):
+        self.expr = expr
+        self.parameters = parameters
+        self.variables = tuple(variables)
+        self.kind, self.code = self._compile(expr)
+
+        if self.code is not None:
+            self.value = None
+            self.namespace = {
+                p: parameters[p]
+                for p in (parameters if parameters else {})
+                if p not in _NON_PARAMETERS
+            }
+            self.namespace["numpy"] = np
+        else:
+            self.value = evaluate(expr, parameters)
+
+    def _compile(self, expr):
+
+        if not isinstance(expr, str):
+            return CONSTANT, None
+
+        parameters = self.parameters if self.parameters else {}
+        if expr in parameters:
+            # As in evaluate(), the value of the parameter is used
+            kind, code = self._compile(parameters[expr])
+            return PARAMETER if kind == CONSTANT else kind, code
+
+        try:
+            tree = ast.parse(expr.strip(), mode="eval")
+        except SyntaxError:
+            return CONSTANT, None
+
+        names = set()
+        functions = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                names.add(node.id)
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                functions.add(node.func.id)
+
+        if functions.intersection(RANDOM_FUNCTIONS):
+            return RANDOM, compile(tree, "<expression: %s>" % expr, "eval")
+        if names.intersection(self.variables):
+            return VARIABLE, compile(tree, "<expression: %s>" % expr, "eval")
+        if names.intersection(parameters):
+            return PARAMETER, None
+        return CONSTANT, None
+
+    @property
+    def is_random(self):
+        return self.kind == RANDOM
+
+    @property
+    def is_constant(self):
+        """
+        Does the expression have the same value each time it's evaluated?
+        """
+        return self.code is None
+
+    def evaluate(self, rng=None, variables={}):
+        """
+        Evaluate the expression for a single value, with variables giving the
+        values of any of the names in self.variables. rng can also be a
+        random.Random, in which case the expression is passed to evaluate(),
+        as by previous versions of NeuroMLlite
+        """
+        if self.is_constant:
+            return self.value
+
+        if self.is_random and not isinstance(rng, np.random.Generator):
+            if variables:
+                parameters = dict(self.parameters if self.parameters else {})
+                parameters.update(variables)
+                return evaluate(self.expr, parameters, rng)
+            return evaluate(self.expr, self.parameters, rng)
+
+        namespace = dict(
+            self.namespace, math=math, **_get_random_functions(rng), **variables
+        )
+        value = eval(self.code, namespace)
+        if isinstance(value, float) and int(value) == value:
+            return int(value)
+        return value
+
+    def evaluate_array(self, rng, num, variables={}):
+        """
+        Evaluate the expression for num values, returning an array; variables
+        gives arrays of num values for any of the names in self.variables.
+        Expressions are evaluated elementwise over these arrays and arrays of
+        random numbers drawn from the numpy Generator rng, falling back to
+        evaluating each value in turn if the expression can't be applied to
+        arrays.
+        """
+        if self.is_constant:
+            return np.array(np.broadcast_to(self.value, (num,)))
+
+        namespace = dict(
+            self.namespace,
+            math=_array_math,
+            **_get_random_functions(rng, num),
+            **variables
+        )
+        try:
+            value = eval(self.code, namespace)
+            return np.array(np.broadcast_to(value, (num,)))
+        except (TypeError, ValueError):
+            return np.array(
+                [
+                    self.evaluate(rng, {v: variables[v][i] for v in variables})
+                    for i in range(num)
+                ]
+            )
+
+
+class ExpressionCache:
+    """
+    The compiled versions of the expressions used in building a network with
+    the given parameters, so that each is only parsed once
+    """
+
+    def __init__(self, parameters=None):
+        self.parameters = parameters
+        self.expressions = {}
+
+    def get(self, expr, variables=()):
+        key = (type(expr), expr, tuple(variables))
+        try:
+            if not key in self.expressions:
+                self.expressions[key] = CompiledExpression(
+                    expr, self.parameters, variables
+                )
+            return self.expressions[key]
+        except TypeError:  # e.g. lists can't be dict keys
+            return CompiledExpression(expr, self.parameters, variables)
+
+    def evaluate(self, expr, rng=None, variables={}):
+        return self.get(expr, tuple(variables)).evaluate(rng, variables)
+
+    def evaluate_array(self, expr, rng, num, variables={}):
+        return self.get(expr, tuple(variables)).evaluate_array(rng, num, variables)
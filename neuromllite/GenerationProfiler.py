@@ -0,0 +1,157 @@
+#
+#
+#   A profiler for generate_network, recording how long each population,
+#   projection and input takes to generate, how much of that time is spent
+#   in the handler's methods and the peak memory used
+#
+#
+
+from neuromllite.utils import print_v
+
+import json
+import time
+import tracemalloc
+
+
+class _ProfiledHandler:
+    """
+    Wraps a handler, passing on all attribute access to it, but timing and
+    counting the calls to its handle_* and finalise_* methods
+    """
+
+    def __init__(self, handler, profiler):
+        object.__setattr__(self, "_handler", handler)
+        object.__setattr__(self, "_profiler", profiler)
+
+    def __getattr__(self, name):
+        value = getattr(self._handler, name)
+        if callable(value) and name.startswith(("handle_", "finalise_")):
+            return self._profiler._wrap_method(name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._handler, name, value)
+
+
+class GenerationProfiler:
+    """
+    Pass to generate_network (or generate_and_run, with profile=True) to
+    record, for each phase of the generation (setup, then each population,
+    projection and input, then finalising the document):
+
+        wall_time: total time taken (s)
+        handler_time: time spent in the handler's handle_*/finalise_* methods
+        generation_time: the rest, i.e. evaluating expressions, sampling, etc.
+        handler_calls: number of calls to each of the handler's methods
+        peak_memory: peak memory allocated during the phase (bytes), if
+            trace_memory is True (which slows down generation). Before
+            Python 3.9, this is the peak since the generation started
+
+    The report is saved as JSON to report_file, if given, when the
+    generation finishes.
+    """
+
+    def __init__(self, report_file=None, trace_memory=True):
+        self.report_file = report_file
+        self.trace_memory = trace_memory
+        self.phases = []
+        self.current = None
+        self.started_tracing = False
+        self.network_id = None
+        self.handler_class = None
+        self.total_time = 0
+
+    def wrap_handler(self, handler):
+        self.handler_class = handler.__class__.__name__
+        return _ProfiledHandler(handler, self)
+
+    def _wrap_method(self, name, method):
+        def profiled(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if self.current is not None:
+                    self.current["handler_time"] += time.perf_counter() - start
+                    calls = self.current["handler_calls"]
+                    calls[name] = calls.get(name, 0) + 1
+
+        return profiled
+
+    def start_phase(self, kind, id=None):
+        """
+        Start recording the generation of element id of the given kind (e.g.
+        population, projection, input), ending the current phase, if any
+        """
+        self.end_phase()
+        self.current = {
+            "kind": kind,
+            "id": id,
+            "wall_time": 0,
+            "handler_time": 0,
+            "generation_time": 0,
+            "handler_calls": {},
+        }
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            if hasattr(tracemalloc, "reset_peak"):  # Python >= 3.9
+                tracemalloc.reset_peak()
+
+        self.start_time = time.perf_counter()
+
+    def end_phase(self):
+        phase = self.current
+        if phase is None:
+            return
+
+        phase["wall_time"] = time.perf_counter() - self.start_time
+        phase["generation_time"] = phase["wall_time"] - phase["handler_time"]
+        if self.trace_memory:
+            phase["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(phase)
+        self.total_time += phase["wall_time"]
+        self.current = None
+
+    def finish(self):
+        """
+        Called at the end of generate_network; saves the report, if required
+        """
+        self.end_phase()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+        if self.report_file:
+            with open(self.report_file, "w") as f:
+                json.dump(self.get_report(), f, indent=4)
+            print_v("Written generation profile to %s" % self.report_file)
+
+    def get_report(self):
+        return {
+            "network": self.network_id,
+            "handler": self.handler_class,
+            "total_time": self.total_time,
+            "phases": self.phases,
+        }
+
+    def print_summary(self, num=10):
+        """
+        Print the num slowest phases
+        """
+        print_v(
+            "Generated %s with %s in %.3fs"
+            % (self.network_id, self.handler_class, self.total_time)
+        )
+        for phase in sorted(self.phases, key=lambda p: -p["wall_time"])[:num]:
+            print_v(
+                "  %s %s: %.3fs (%.3fs in handler, %s calls)"
+                % (
+                    phase["kind"],
+                    phase["id"] if phase["id"] else "",
+                    phase["wall_time"],
+                    phase["handler_time"],
+                    sum(phase["handler_calls"].values()),
+                )
+            )
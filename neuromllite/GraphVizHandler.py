@@ -5,10 +5,11 @@
 #
 
 from neuromllite.utils import print_v
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.CompiledNetwork import CompiledNetwork
 from neuromllite.utils import is_spiking_input_nml_cell
 from neuromllite.ConnectivityHandler import ConnectivityHandler
 from neuromllite.NetworkGenerator import _get_rng_for_network
-from neuromllite.utils import evaluate
 
 from pyneuroml.pynml import convert_to_units
 
@@ -53,9 +54,18 @@ class GraphVizHandler(ConnectivityHandler):
         min_weight_to_show=0,
         output_format="png",
         view_on_render=True,
+        collapse_pop_size=100,
     ):
+        """
+        At cell level (level <= 0), populations with more than
+        collapse_pop_size cells are shown as a single node, with the
+        connections to/from their cells combined, so graphs of large networks
+        stay small enough to lay out. With collapse_pop_size=None all the
+        cells are shown
+        """
 
         self.nl_network = nl_network
+        self.compiled_network = CompiledNetwork(nl_network) if nl_network else None
         self.level = level
         self.engine = engine
         self.include_ext_inputs = include_ext_inputs
@@ -68,6 +78,7 @@ class GraphVizHandler(ConnectivityHandler):
         self.show_cont_conns = show_cont_conns
         self.output_format = output_format
         self.view_on_render = view_on_render
+        self.collapse_pop_size = collapse_pop_size
 
         self.rng, seed = _get_rng_for_network(self.nl_network)
 
@@ -93,6 +104,7 @@ class GraphVizHandler(ConnectivityHandler):
         print_v("*    show_elect_conns:        %s" % self.show_elect_conns)
         print_v("*    show_cont_conns:         %s" % self.show_cont_conns)
         print_v("*    output_format:           %s" % self.output_format)
+        print_v("*    collapse_pop_size:       %s" % self.collapse_pop_size)
         print_v("*")
         print_v("* Used values: ")
         syns = sorted(self.syn_conds_used.keys())
@@ -121,6 +133,81 @@ class GraphVizHandler(ConnectivityHandler):
 
         return fweight, lweight
 
+    def _is_collapsed(self, population_id):
+        return (
+            self.is_cell_level()
+            and self.collapse_pop_size is not None
+            and self.pop_sizes[population_id] > self.collapse_pop_size
+        )
+
+    def _add_cell_nodes(self, graph, population_id, size):
+        if self._is_collapsed(population_id):
+            graph.node(
+                population_id,
+                label="<%s<br/><i>%s cells</i>>" % (population_id, size),
+                peripheries="2",
+            )
+        else:
+            for i in range(size):
+                cell_info = self.get_cell_identifier(population_id, i)
+                graph.node(cell_info, label=cell_info)
+
+    def _get_cell_edges(self, projName):
+        """
+        The edges for the connections of a projection between pairs of cells
+        (from its SparseConnectivity): the pre and post node of each, with
+        the summed weights, scaled weights and numbers of connections and the
+        delay. For collapsed populations, the edges to/from all of their cells
+        are combined into edges to/from the population's node (without delays)
+        """
+        connectivity = self.proj_cell_connectivity[projName]
+        pre_pop = self.proj_pre_pops[projName]
+        post_pop = self.proj_post_pops[projName]
+        pre_collapsed = self._is_collapsed(pre_pop)
+        post_collapsed = self._is_collapsed(post_pop)
+
+        pre = connectivity.pre_cell_ids
+        post = connectivity.post_cell_ids
+        if pre_collapsed or post_collapsed:
+            if pre_collapsed:
+                pre = np.zeros_like(pre)
+            if post_collapsed:
+                post = np.zeros_like(post)
+            post_size = connectivity.post_size
+            keys, inverse = np.unique(pre * post_size + post, return_inverse=True)
+            inverse = inverse.reshape(-1)
+
+            def combine(values):
+                return np.bincount(inverse, values, minlength=len(keys))
+
+            edges = {
+                "pre": keys // post_size,
+                "post": keys % post_size,
+                "weights": combine(connectivity.weights),
+                "scaled_weights": combine(connectivity.scaled_weights),
+                "conn_numbers": combine(connectivity.conn_numbers).astype(int),
+                "delays": None,
+            }
+        else:
+            edges = {
+                "pre": pre,
+                "post": post,
+                "weights": connectivity.weights,
+                "scaled_weights": connectivity.scaled_weights,
+                "conn_numbers": connectivity.conn_numbers,
+                "delays": connectivity.delays,
+            }
+
+        edges["pre_nodes"] = [
+            pre_pop if pre_collapsed else self.get_cell_identifier(pre_pop, i)
+            for i in edges["pre"]
+        ]
+        edges["post_nodes"] = [
+            post_pop if post_collapsed else self.get_cell_identifier(post_pop, i)
+            for i in edges["post"]
+        ]
+        return edges
+
     def finalise_document(self):
 
         max_abs_weight = {}
@@ -138,17 +225,15 @@ class GraphVizHandler(ConnectivityHandler):
 
         if self.is_cell_level() and self.level <= -1:
 
+            cell_edges = {}
             for projName in self.proj_weights:
-                # ws = self.proj_individual_weights[projName]
-                ws = self.proj_individual_scaled_weights[projName]
+                cell_edges[projName] = self._get_cell_edges(projName)
+                ws = cell_edges[projName]["scaled_weights"]
+                ws = ws[np.nonzero(ws)]
                 t = self.proj_types[projName]
-                if np.max(ws) > 0:
-                    max_abs_weight[t] = max(
-                        max_abs_weight[t], np.max(ws[np.nonzero(ws)])
-                    )
-                    min_abs_weight[t] = min(
-                        min_abs_weight[t], np.min(ws[np.nonzero(ws)])
-                    )
+                if len(ws) > 0 and np.max(ws) > 0:
+                    max_abs_weight[t] = max(max_abs_weight[t], np.max(ws))
+                    min_abs_weight[t] = min(min_abs_weight[t], np.min(ws))
 
             for projName in self.proj_weights:
 
@@ -169,12 +254,13 @@ class GraphVizHandler(ConnectivityHandler):
                     gbase_nS, gbase = self._get_gbase_nS(
                         projName, return_orig_string_also=True
                     )
+                    edges = cell_edges[projName]
 
                     pclass = self._get_proj_class(proj_type)
                     sign = -1 if "inhibitory" in proj_type else 1
 
                     print_v(
-                        "GRAPH PROJ: %s (%s (%i) -> %s (%i), %s): w %s; wtot: %s; sign: %s; cond: %s nS (%s); all: %s -> %s"
+                        "GRAPH PROJ: %s (%s (%i) -> %s (%i), %s): w %s; wtot: %s; sign: %s; cond: %s nS (%s); all: %s -> %s; %i edges"
                         % (
                             projName,
                             pre_pop,
@@ -189,94 +275,83 @@ class GraphVizHandler(ConnectivityHandler):
                             gbase,
                             max_abs_weight,
                             min_abs_weight,
+                            np.count_nonzero(edges["scaled_weights"]),
                         )
                     )
 
-                    for pre_i in range(num_pre):
-                        for post_i in range(num_post):
-                            pre_pop_i = self.get_cell_identifier(pre_pop, pre_i)
-                            post_pop_i = self.get_cell_identifier(post_pop, post_i)
-
-                            w = self.proj_individual_scaled_weights[projName][pre_i][
-                                post_i
-                            ]
-                            w_unscaled = self.proj_individual_weights[projName][pre_i][
-                                post_i
-                            ]
+                    # Only the connected pairs of cells (or collapsed populations)
+                    for k in range(len(edges["pre_nodes"])):
+                        pre_pop_i = edges["pre_nodes"][k]
+                        post_pop_i = edges["post_nodes"][k]
 
-                            num_indiv_conns = self.proj_individual_conn_numbers[
-                                projName
-                            ][pre_i][post_i]
+                        w = edges["scaled_weights"][k]
+                        w_unscaled = edges["weights"][k]
+                        num_indiv_conns = edges["conn_numbers"][k]
 
-                            if w != 0:
+                        if w != 0:
 
-                                weight_used = w
+                            weight_used = w
 
-                                cond_scale = None
-                                if self.scale_by_post_pop_cond:
-                                    cond_scale = gbase_nS if gbase_nS != None else 1.0
-
-                                print_v(
-                                    " - conn %s -> %s: %s (%s)"
-                                    % (pre_pop_i, post_pop_i, w, weight_used)
-                                )
+                            cond_scale = None
+                            if self.scale_by_post_pop_cond:
+                                cond_scale = gbase_nS if gbase_nS != None else 1.0
 
-                                fweight, lweight = self.get_weight_fraction_and_line(
-                                    weight_used,
-                                    max_abs_weight[proj_type],
-                                    min_abs_weight[proj_type],
-                                )
+                            fweight, lweight = self.get_weight_fraction_and_line(
+                                weight_used,
+                                max_abs_weight[proj_type],
+                                min_abs_weight[proj_type],
+                            )
 
-                                self.graph.attr(
-                                    "edge",
-                                    style=self.proj_lines[projName],
-                                    arrowhead=self.proj_shapes[projName],
-                                    arrowsize="%s" % (min(1, lweight)),
-                                    penwidth="%s" % (lweight),
-                                    color=self.pop_colors[self.proj_pre_pops[projName]],
-                                    fontcolor=self.pop_colors[
-                                        self.proj_pre_pops[projName]
-                                    ],
-                                )
+                            self.graph.attr(
+                                "edge",
+                                style=self.proj_lines[projName],
+                                arrowhead=self.proj_shapes[projName],
+                                arrowsize="%s" % (min(1, lweight)),
+                                penwidth="%s" % (lweight),
+                                color=self.pop_colors[self.proj_pre_pops[projName]],
+                                fontcolor=self.pop_colors[self.proj_pre_pops[projName]],
+                            )
 
-                                label = "<"
-                                label += "w: %s <br/> " % self.format_float(w_unscaled)
-                                label += "num: %i <br/> " % num_indiv_conns
-
-                                if num_indiv_conns != 1:
-                                    wc = float(w_unscaled) / num_indiv_conns
-                                    label += "w/conn: %s <br/> " % self.format_float(wc)
-                                    if w != w_unscaled:
-                                        label += "%s*%s*%snS = %snS<br/> " % (
-                                            self.format_float(wc),
-                                            num_indiv_conns,
-                                            self.format_float(cond_scale),
-                                            self.format_float(weight_used),
-                                        )
-                                else:
-                                    label += "%s*%snS = %snS<br/> " % (
-                                        self.format_float(w),
+                            label = "<"
+                            label += "w: %s <br/> " % self.format_float(w_unscaled)
+                            label += "num: %i <br/> " % num_indiv_conns
+
+                            if num_indiv_conns != 1:
+                                wc = float(w_unscaled) / num_indiv_conns
+                                label += "w/conn: %s <br/> " % self.format_float(wc)
+                                if w != w_unscaled:
+                                    label += "%s*%s*%snS = %snS<br/> " % (
+                                        self.format_float(wc),
+                                        num_indiv_conns,
                                         self.format_float(cond_scale),
                                         self.format_float(weight_used),
                                     )
-
-                                label += "scaled: %s<br/> " % (
-                                    self.format_float(weight_used)
+                            else:
+                                label += "%s*%snS = %snS<br/> " % (
+                                    self.format_float(w),
+                                    self.format_float(cond_scale),
+                                    self.format_float(weight_used),
                                 )
 
-                                label += "f: %s <br/> " % fweight
-                                label += "l: %s <br/> " % lweight
+                            label += "scaled: %s<br/> " % (
+                                self.format_float(weight_used)
+                            )
 
-                                delay = self.proj_delays[projName][pre_i][post_i]
-                                if delay != 0:
-                                    label += "d: %sms <br/> " % self.format_float(delay)
+                            label += "f: %s <br/> " % fweight
+                            label += "l: %s <br/> " % lweight
 
-                                if not label[-1] == ">":
-                                    label += ">"
-                                if self.level <= -2:
-                                    self.graph.edge(pre_pop_i, post_pop_i, label=label)
-                                else:
-                                    self.graph.edge(pre_pop_i, post_pop_i)
+                            delay = (
+                                edges["delays"][k] if edges["delays"] is not None else 0
+                            )
+                            if delay != 0:
+                                label += "d: %sms <br/> " % self.format_float(delay)
+
+                            if not label[-1] == ">":
+                                label += ">"
+                            if self.level <= -2:
+                                self.graph.edge(pre_pop_i, post_pop_i, label=label)
+                            else:
+                                self.graph.edge(pre_pop_i, post_pop_i)
 
         else:
 
@@ -400,8 +475,8 @@ class GraphVizHandler(ConnectivityHandler):
                                     )
 
                                 if self.nl_network:
-                                    proj = self.nl_network.get_child(
-                                        projName, "projections"
+                                    proj = self.compiled_network.get_projection(
+                                        projName
                                     )
                                     if proj and proj.random_connectivity:
                                         label += (
@@ -601,9 +676,7 @@ class GraphVizHandler(ConnectivityHandler):
                 )
 
                 if self.is_cell_level():
-                    for i in range(size):
-                        cell_info = self.get_cell_identifier(population_id, i)
-                        c.node(cell_info, label=cell_info)
+                    self._add_cell_nodes(c, population_id, size)
                 else:
                     c.node(population_id, label=label)
 
@@ -613,9 +686,7 @@ class GraphVizHandler(ConnectivityHandler):
             )
 
             if self.is_cell_level():
-                for i in range(size):
-                    cell_info = self.get_cell_identifier(population_id, i)
-                    self.graph.node(cell_info, label=cell_info)
+                self._add_cell_nodes(self.graph, population_id, size)
             else:
                 self.graph.node(population_id, label=label)
 
@@ -666,7 +737,7 @@ class GraphVizHandler(ConnectivityHandler):
                 shape = self.INH_CONN_ARROW_SHAPE
 
         if self.nl_network:
-            syn = self.nl_network.get_child(synapse, "synapses")
+            syn = self.compiled_network.get_synapse(synapse)
             if syn:
                 if syn.parameters:
                     if (
@@ -675,11 +746,11 @@ class GraphVizHandler(ConnectivityHandler):
                     ):
                         shape = self.INH_CONN_ARROW_SHAPE
 
-            proj = self.nl_network.get_child(projName, "projections")
+            proj = self.compiled_network.get_projection(projName)
             if proj:
                 if proj.weight:
-                    proj_weight = evaluate(
-                        proj.weight, self.nl_network.parameters, self.rng
+                    proj_weight = get_parameter_table(self.nl_network).evaluate(
+                        proj.weight, self.rng
                     )
                     if proj_weight < 0:
                         shape = self.INH_CONN_ARROW_SHAPE
@@ -692,16 +763,7 @@ class GraphVizHandler(ConnectivityHandler):
         self.proj_tot_weight[projName] = 0
 
         if self.is_cell_level():
-            pre_size = self.pop_sizes[prePop]
-            post_size = self.pop_sizes[postPop]
-            self.proj_individual_weights[projName] = np.zeros((pre_size, post_size))
-            self.proj_individual_conn_numbers[projName] = np.zeros(
-                (pre_size, post_size)
-            )
-            self.proj_individual_scaled_weights[projName] = np.zeros(
-                (pre_size, post_size)
-            )
-            self.proj_delays[projName] = np.zeros((pre_size, post_size))
+            self.init_cell_connectivity(projName, prePop, postPop)
 
     def finalise_projection(
         self, projName, prePop, postPop, synapse=None, type="projection"
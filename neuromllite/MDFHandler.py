@@ -5,7 +5,10 @@
 #
 
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.DefaultNetworkHandler import _as_lists
 from neuromllite.utils import print_v
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.CompiledNetwork import CompiledNetwork
 from modelspec.utils import save_to_json_file
 from modelspec.utils import save_to_yaml_file
 from modelspec.utils import locate_file
@@ -19,6 +22,7 @@ class MDFHandler(DefaultNetworkHandler):
     def __init__(self, nl_network):
         print_v("Initiating PsyNeuLink handler")
         self.nl_network = nl_network
+        self.compiled_network = CompiledNetwork(nl_network)
 
     def handle_document_start(self, id, notes):
 
@@ -97,7 +101,7 @@ class MDFHandler(DefaultNetworkHandler):
                 node_id = "%s_%i" % (population_id, i)
                 node = {}
 
-                comp = self.nl_network.get_child(component, "cells")
+                comp = self.compiled_network.get_cell(component)
                 base_dir = "./"  # for now...
 
                 node["parameters"] = {}
@@ -117,8 +121,8 @@ class MDFHandler(DefaultNetworkHandler):
                         for p in comp.parameters:
                             lems_comp.set_parameter(
                                 p,
-                                evaluate(
-                                    comp.parameters[p], self.nl_network.parameters
+                                get_parameter_table(self.nl_network).evaluate(
+                                    comp.parameters[p]
                                 ),
                             )
 
@@ -319,6 +323,37 @@ class MDFHandler(DefaultNetworkHandler):
             )
         )
 
+        self._add_edge(prePop, postPop, preCellId, postCellId, weight)
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+
+        num = len(preCellIds)
+        print_v(
+            "Connections %i to %i of: %s (%s -> %s, syn: %s)"
+            % (start_id, start_id + num - 1, projName, prePop, postPop, synapseType)
+        )
+        for preCellId, postCellId, weight in zip(
+            *_as_lists(num, preCellIds, postCellIds, weights)
+        ):
+            self._add_edge(prePop, postPop, preCellId, postCellId, weight)
+
+    def _add_edge(self, prePop, postPop, preCellId, postCellId, weight):
+
         pre_node_id = "%s_%i" % (prePop, preCellId)
         post_node_id = "%s_%i" % (postPop, postCellId)
         edge_id = "Edge %s to %s" % (pre_node_id, post_node_id)
@@ -362,6 +397,15 @@ class MDFHandler(DefaultNetworkHandler):
             % (inputListId, id, cellId, segId, fract, weight)
         )
 
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+
+        print_v(
+            "Inputs: %s[%i:%i], %i inputs"
+            % (inputListId, start_id, start_id + len(cellIds), len(cellIds))
+        )
+
     #
     #  Should be overridden to to connect each input to the target cell
     #
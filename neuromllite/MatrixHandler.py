@@ -5,12 +5,75 @@
 #
 
 from neuromllite.utils import print_v
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.CompiledNetwork import CompiledNetwork
 from neuromllite.ConnectivityHandler import ConnectivityHandler
 
-from neuromllite.utils import evaluate
 from neuromllite.NetworkGenerator import _get_rng_for_network
 
 import numpy as np
+import re
+
+
+def downsample_matrix(matrix, factor=2):
+    """
+    Sum the values in each factor x factor block of matrix (padded with
+    zeros to a multiple of factor)
+    """
+    n0, n1 = matrix.shape
+    m0, m1 = -(-n0 // factor), -(-n1 // factor)
+    padded = np.zeros((m0 * factor, m1 * factor))
+    padded[:n0, :n1] = matrix
+    return padded.reshape(m0, factor, m1, factor).sum(axis=(1, 3))
+
+
+def get_matrix_pyramid(matrix, factor=2, min_size=64):
+    """
+    The matrix, followed by versions of it downsampled by factor again and
+    again until they're no larger than min_size x min_size
+    """
+    pyramid = [matrix]
+    while max(pyramid[-1].shape) > min_size:
+        pyramid.append(downsample_matrix(pyramid[-1], factor))
+    return pyramid
+
+
+def _get_matrix_key(name):
+    # e.g. "Chemical conns (number of conns)" -> "chemical_conns_number_of_conns"
+    return re.sub(r"[^0-9a-zA-Z]+", "_", name).strip("_").lower()
+
+
+def load_matrix(filename, name, resolution="cells", level=0):
+    """
+    Load one of the matrices saved by MatrixHandler.save_matrices, without
+    loading the others. resolution is cells (or populations, for matrices
+    generated at population level), populations or groups; level is the
+    level of the pyramid for cells. Returns the matrix and the labels of its
+    rows/columns (for downsampled matrices, those of the first row/column
+    in each block)
+    """
+    key = _get_matrix_key(name)
+    if resolution == "cells":
+        path = "%s/cells/%i" % (key, level)
+    else:
+        path = "%s/%s" % (key, resolution)
+
+    if filename.endswith(".npz"):
+        with np.load(filename) as f:
+            matrix = f[path]
+            labels = f["labels/%s" % resolution]
+            factor = int(f["factor"])
+    else:
+        import h5py
+
+        with h5py.File(filename, "r") as f:
+            matrix = f[path][()]
+            labels = f["labels/%s" % resolution].asstr()[()]
+            factor = int(f["factor"][()])
+
+    if resolution == "cells":
+        labels = labels[:: factor**level]
+    return matrix, [str(l) for l in labels]
 
 
 class MatrixHandler(ConnectivityHandler):
@@ -19,10 +82,36 @@ class MatrixHandler(ConnectivityHandler):
 
     weight_arrays_to_show = {}
 
-    def __init__(self, level=10, nl_network=None):
+    def __init__(
+        self,
+        level=10,
+        nl_network=None,
+        bin_size=None,
+        save_to=None,
+        groups=None,
+        show=True,
+    ):
+        """
+        At cell level (level <= 0), bin_size can be used to show the cells of
+        each population in bins of that many cells, with the weights of the
+        connections between the cells of two bins summed.
+
+        If save_to is given, the matrices are saved to that file (see
+        save_matrices), summed over the groups of populations in groups (dict
+        of group id -> list of population ids). With show=False they're not
+        plotted
+        """
 
         self.nl_network = nl_network
+        self.compiled_network = CompiledNetwork(nl_network) if nl_network else None
         self.level = level
+        self.bin_size = bin_size
+        self.save_to = save_to
+        self.groups = groups
+        self.show = show
+
+        self.colormaps_used = []
+        self.weight_arrays_to_show = {}
 
         self.rng, seed = _get_rng_for_network(self.nl_network)
 
@@ -35,6 +124,7 @@ class MatrixHandler(ConnectivityHandler):
         print_v("* Settings for MatrixHandler: ")
         print_v("*    level:                   %s" % self.level)
         print_v("*    is_cell_level:           %s" % self.is_cell_level())
+        print_v("*    bin_size:                %s" % self.bin_size)
         print_v("*    CUTOFF_INH_SYN_MV:       %s" % self.CUTOFF_INH_SYN_MV)
         # print_v('*    include_inputs:          %s'%self.include_inputs)
         # print_v('*    scale_by_post_pop_size:  %s'%self.scale_by_post_pop_size)
@@ -61,27 +151,130 @@ class MatrixHandler(ConnectivityHandler):
         label = template % ("%s conns" % p)
         return label
 
-    def finalise_document(self):
+    def _get_bin_size(self):
+        return self.bin_size if self.is_cell_level() and self.bin_size else 1
 
+    def _get_entries(self, pops):
+        """
+        The rows/columns of the matrices: the populations, or at cell level
+        the cells (or bins of cells) of each population, in order. Returns
+        the label and color of each and the row of the first one for each
+        population
+        """
         entries = []
-        # print_v('Finals: %s -> %s'%(self.proj_pre_pops, self.proj_post_pops))
-        all_pops = []
-        for v in self.proj_pre_pops.values():
-            all_pops.append(v)
-        for v in self.proj_post_pops.values():
-            all_pops.append(v)
+        entry_colors = []
+        pop_offsets = {}
 
-        for pop in all_pops:
+        if not self.is_cell_level():
+            for pop in sorted(pops):
+                pop_offsets[pop] = len(entries)
+                entries.append(pop)
+                entry_colors.append(self.pop_colors[pop])
+            return entries, entry_colors, pop_offsets
+
+        bin_size = self._get_bin_size()
+        pops = [p for p in pops if self.pop_sizes[p] > 0]
+        for pop in sorted(pops, key=lambda p: self.get_cell_identifier(p, 0)):
+            size = self.pop_sizes[pop]
+            pop_offsets[pop] = len(entries)
+            for start in range(0, size, bin_size):
+                end = min(start + bin_size, size) - 1
+                first = self.get_cell_identifier(pop, start)
+                entries.append(first if end == start else "%s-%i" % (first, end))
+                entry_colors.append(self.pop_colors[first])
+
+        return entries, entry_colors, pop_offsets
+
+    def _get_all_pops(self):
+        return set(self.proj_pre_pops.values()) | set(self.proj_post_pops.values())
+
+    def save_matrices(self, filename, groups=None, factor=2, min_size=64):
+        """
+        Save the matrices in weight_arrays_to_show to filename (.npz, or .h5
+        or .hdf5 using h5py), so they can be looked at again without
+        generating the network, each at these resolutions:
+
+            <name>/cells/<level>: at cell level, the matrix (over cells, or
+                bins of cells), followed by versions of it downsampled by
+                factor until they're no larger than min_size (see
+                get_matrix_pyramid). At population level, just the matrix
+            <name>/populations: summed over the cells of each population
+            <name>/groups: summed over groups of populations (dict of group
+                id -> list of population ids; other populations are in groups
+                on their own)
+
+        where name is the name of the matrix in lower case, with underscores
+        for other characters (e.g. chemical_conns_number_of_conns). The labels
+        of the rows/columns are in labels/cells, labels/populations and
+        labels/groups. Use load_matrix to read one back
+        """
+        entries, entry_colors, pop_offsets = self._get_entries(self._get_all_pops())
+        pops = sorted(pop_offsets, key=lambda p: pop_offsets[p])
+        starts = [pop_offsets[p] for p in pops]
+
+        group_ids = []
+        pop_groups = {}
+        for group_id in sorted(groups) if groups else []:
+            for pop in groups[group_id]:
+                pop_groups[pop] = group_id
+        for pop in pops:
+            group_id = pop_groups.get(pop, pop)
+            if not group_id in group_ids:
+                group_ids.append(group_id)
+        in_group = np.zeros((len(pops), len(group_ids)))
+        for i, pop in enumerate(pops):
+            in_group[i, group_ids.index(pop_groups.get(pop, pop))] = 1
+
+        arrays = {
+            "names": np.array(sorted(self.weight_arrays_to_show), dtype=str),
+            "labels/cells": np.array(entries, dtype=str),
+            "labels/populations": np.array(pops, dtype=str),
+            "labels/groups": np.array(group_ids, dtype=str),
+            "factor": np.array(factor),
+        }
+        for name in sorted(self.weight_arrays_to_show):
+            matrix = self.weight_arrays_to_show[name]
+            key = _get_matrix_key(name)
             if self.is_cell_level():
-                for i in range(self.pop_sizes[pop]):
-                    pi = self.get_cell_identifier(pop, i)  # '%s_%i'%(pop,i)
-                    if not pi in entries:
-                        entries.append(pi)
+                for level, m in enumerate(get_matrix_pyramid(matrix, factor, min_size)):
+                    arrays["%s/cells/%i" % (key, level)] = m
+                pop_matrix = np.add.reduceat(
+                    np.add.reduceat(matrix, starts, axis=0), starts, axis=1
+                )
             else:
-                if not pop in entries:
-                    entries.append(pop)
+                arrays["%s/cells/0" % key] = matrix
+                pop_matrix = matrix
+            arrays["%s/populations" % key] = pop_matrix
+            arrays["%s/groups" % key] = in_group.T @ pop_matrix @ in_group
+
+        print_v("Saving %i matrices to: %s" % (len(arrays["names"]), filename))
+        if filename.endswith(".npz"):
+            np.savez_compressed(filename, **arrays)
+
+        elif filename.endswith(".h5") or filename.endswith(".hdf5"):
+            import h5py
+
+            with h5py.File(filename, "w") as f:
+                for path, array in arrays.items():
+                    if array.dtype.kind == "U":
+                        f.create_dataset(
+                            path, data=array.astype(object), dtype=h5py.string_dtype()
+                        )
+                    elif array.ndim == 0:
+                        f.create_dataset(path, data=array)
+                    else:
+                        f.create_dataset(path, data=array, compression="gzip")
+        else:
+            raise Exception(
+                "Unknown format for saving matrices: %s (use .npz, .h5 or .hdf5)"
+                % filename
+            )
+
+    def finalise_document(self):
 
-        entries = sorted(entries)
+        # print_v('Finals: %s -> %s'%(self.proj_pre_pops, self.proj_post_pops))
+        entries, entry_colors, pop_offsets = self._get_entries(self._get_all_pops())
+        bin_size = self._get_bin_size()
 
         matrix_per_cell = "%s (total weight between cell pair)"
         matrix_per_cell_cond = "%s (total conn weight*syn cond)"
@@ -175,40 +368,41 @@ class MatrixHandler(ConnectivityHandler):
 
             if self.is_cell_level():
 
-                for pre_i in range(self.pop_sizes[pre_pop]):
-                    for post_i in range(self.pop_sizes[post_pop]):
-                        pre_pop_i = entries.index(
-                            self.get_cell_identifier(pre_pop, pre_i)
-                        )
-                        post_pop_i = entries.index(
-                            self.get_cell_identifier(post_pop, post_i)
-                        )
+                # Add the connected pairs of cells (or bins) of the projection
+                # to the rows/columns for its populations
+                connectivity = self.proj_cell_connectivity[projName]
+                indices = (
+                    pop_offsets[pre_pop] + connectivity.pre_cell_ids // bin_size,
+                    pop_offsets[post_pop] + connectivity.post_cell_ids // bin_size,
+                )
 
+                np.add.at(
+                    self.weight_arrays_to_show[
+                        self._get_conn_label(matrix_per_cell, pclass)
+                    ],
+                    indices,
+                    connectivity.weights,
+                )
+                if projName in self.proj_syn_objs:
+                    w_scaled = connectivity.scaled_weights
+                    np.add.at(
                         self.weight_arrays_to_show[
-                            self._get_conn_label(matrix_per_cell, pclass)
-                        ][pre_pop_i][post_pop_i] += self.proj_individual_weights[
-                            projName
-                        ][
-                            pre_i
-                        ][
-                            post_i
-                        ]
-                        if projName in self.proj_syn_objs:
-                            w_scaled = self.proj_individual_scaled_weights[projName][
-                                pre_i
-                            ][post_i]
-                            self.weight_arrays_to_show[
-                                self._get_conn_label(matrix_per_cell_cond, pclass)
-                            ][pre_pop_i][post_pop_i] += w_scaled
-                            self.weight_arrays_to_show[
-                                self._get_conn_label(
-                                    matrix_per_cell_cond_signed, pclass
-                                )
-                            ][pre_pop_i][post_pop_i] += (w_scaled * sign)
+                            self._get_conn_label(matrix_per_cell_cond, pclass)
+                        ],
+                        indices,
+                        w_scaled,
+                    )
+                    np.add.at(
+                        self.weight_arrays_to_show[
+                            self._get_conn_label(matrix_per_cell_cond_signed, pclass)
+                        ],
+                        indices,
+                        w_scaled * sign,
+                    )
 
             else:
-                pre_pop_i = entries.index(pre_pop)
-                post_pop_i = entries.index(post_pop)
+                pre_pop_i = pop_offsets[pre_pop]
+                post_pop_i = pop_offsets[post_pop]
 
                 self.weight_arrays_to_show[
                     self._get_conn_label(matrix_total_conns, pclass)
@@ -239,6 +433,11 @@ class MatrixHandler(ConnectivityHandler):
                         self._get_conn_label(matrix_total_signed_conns_per_cell, pclass)
                     ][pre_pop_i][post_pop_i] += (sign * tot_scaled)
 
+        if self.save_to:
+            self.save_matrices(self.save_to, groups=self.groups)
+        if not self.show:
+            return
+
         import matplotlib.pyplot as plt
         import matplotlib
 
@@ -330,7 +529,7 @@ class MatrixHandler(ConnectivityHandler):
                     lwidth = 7
                     offset = -1 * lwidth * len(entries) / 500.0
 
-                    if self.pop_colors[entries[i]]:
+                    if entry_colors[i]:
                         from matplotlib import lines
 
                         x, y = [[-0.5 + offset, -0.5 + offset], [i - 0.5, i + 0.5]]
@@ -338,7 +537,7 @@ class MatrixHandler(ConnectivityHandler):
                             x,
                             y,
                             lw=lwidth,
-                            color=self.pop_colors[entries[i]],
+                            color=entry_colors[i],
                             alpha=alpha,
                         )
                         line.set_solid_capstyle("butt")
@@ -353,7 +552,7 @@ class MatrixHandler(ConnectivityHandler):
                             x,
                             y,
                             lw=lwidth,
-                            color=self.pop_colors[entries[i]],
+                            color=entry_colors[i],
                             alpha=alpha,
                         )
                         line.set_solid_capstyle("butt")
@@ -466,7 +665,7 @@ class MatrixHandler(ConnectivityHandler):
                 proj_type = "inhibitory"
 
         if self.nl_network:
-            syn = self.nl_network.get_child(synapse, "synapses")
+            syn = self.compiled_network.get_synapse(synapse)
             if syn:
                 if syn.parameters:
                     if (
@@ -475,11 +674,11 @@ class MatrixHandler(ConnectivityHandler):
                     ):
                         proj_type = "inhibitory"
 
-            proj = self.nl_network.get_child(projName, "projections")
+            proj = self.compiled_network.get_projection(projName)
             if proj:
                 if proj.weight:
-                    proj_weight = evaluate(
-                        proj.weight, self.nl_network.parameters, self.rng
+                    proj_weight = get_parameter_table(self.nl_network).evaluate(
+                        proj.weight, self.rng
                     )
                     if proj_weight < 0:
                         proj_type = "inhibitory"
@@ -494,16 +693,7 @@ class MatrixHandler(ConnectivityHandler):
         self.proj_tot_weight[projName] = 0
 
         if self.is_cell_level():
-            pre_size = self.pop_sizes[prePop]
-            post_size = self.pop_sizes[postPop]
-            self.proj_individual_weights[projName] = np.zeros((pre_size, post_size))
-            self.proj_individual_conn_numbers[projName] = np.zeros(
-                (pre_size, post_size)
-            )
-            self.proj_individual_scaled_weights[projName] = np.zeros(
-                (pre_size, post_size)
-            )
-            self.proj_delays[projName] = np.zeros((pre_size, post_size))
+            self.init_cell_connectivity(projName, prePop, postPop)
 
         print_v(
             "New projection: %s, %s->%s, weights? %s, type: %s"
@@ -6,9 +6,29 @@ from modelspec.utils import parse_list_like
 from neuromllite.utils import load_network
 from neuromllite.utils import print_v
 from neuromllite.utils import get_pops_vs_cell_indices_seg_ids
-
+from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.ConnectionGenerator import DEFAULT_BLOCK_SIZE
+from neuromllite.ConnectionGenerator import DEFAULT_CHUNK_SIZE
+from neuromllite.ConnectionGenerator import rechunk_connections
+from neuromllite.ExpressionCompiler import ExpressionCache
+from neuromllite.BuildCache import BuildCache
+from neuromllite.GenerationProfiler import GenerationProfiler
+from neuromllite.CompiledNetwork import CompiledNetwork
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.ConnectionGenerator import random_connectivity_blocks
+from neuromllite.ConnectionGenerator import distance_dependent_connectivity_blocks
+from neuromllite.ConnectionGenerator import convergent_connectivity_blocks
+from neuromllite.ConnectionGenerator import divergent_connectivity_blocks
+from neuromllite.ConnectionGenerator import total_number_connectivity_blocks
+from neuromllite.ConnectionGenerator import random_connectivity_count
+from neuromllite.ConnectionGenerator import fixed_number_connectivity_count
+from neuromllite.ConnectionGenerator import total_number_connectivity_count
+
+
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+import hashlib
 import os
 import random
 
@@ -32,6 +52,587 @@ def _get_rng_for_network(nl_model):
     return rng, seed
 
 
+def _get_rng_for_element(seed, kind, element_id):
+    """
+    Get an independent numpy random number generator for one element (e.g.
+    population, projection or input) of a network generated with seed.
+
+    The stream is derived with numpy's SeedSequence from the network seed and
+    a hash of the kind and id of the element, so it does not depend on any
+    other element of the network, or on the order in which they are generated
+    """
+    digest = hashlib.sha256(("%s:%s" % (kind, element_id)).encode()).digest()
+    spawn_key = tuple(
+        int.from_bytes(digest[i : i + 4], "little") for i in range(0, 16, 4)
+    )
+
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+def _get_projection_streams(rng):
+    """
+    Get independent numpy random number generators for the connectivity,
+    random probabilities, delays and weights of a projection, derived from
+    the projection's own generator rng (see _get_rng_for_element).
+
+    Each kind of value is drawn from its own stream in the order of the
+    candidate pairs or connections, so as numpy Generators fill arrays
+    sequentially, none of them depend on how the connections are split into
+    blocks (e.g. weights drawn for each block don't shift where the
+    connectivity samples of the next block fall in the stream)
+    """
+    seed_seq = rng.bit_generator.seed_seq
+    return tuple(
+        np.random.default_rng(
+            np.random.SeedSequence(
+                seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (i,)
+            )
+        )
+        for i in range(4)
+    )
+
+
+def _get_population_locations(network, population, size, seed):
+    """
+    Get the locations of the cells of a population of the given size in the
+    CompiledNetwork network as an array of shape (size, 3). Cells in a
+    random_layout are placed using the population's own random number
+    generator, derived from the network seed, or, if a random.Random is given
+    in place of the seed (legacy_generation), with that. Populations without
+    a layout have all cells at (0, 0, 0)
+    """
+    locations = np.zeros((size, 3))
+
+    if population.random_layout:
+        region = network.get_region(population.random_layout.region)
+        # One x, y, z triple per cell, in order
+        if isinstance(seed, random.Random):
+            samples = np.reshape([seed.random() for i in range(size * 3)], (size, 3))
+        else:
+            pop_rng = _get_rng_for_element(seed, "population", population.id)
+            samples = pop_rng.random((size, 3))
+        locations = samples * (region.width, region.height, region.depth)
+        locations += (region.x, region.y, region.z)
+
+    if population.single_location:
+        loc = population.single_location.location
+        locations[:] = (loc.x, loc.y, loc.z)
+
+    if population.relative_layout:
+        print_v("Generating population with layout: %s" % population.relative_layout)
+        region = network.get_region(population.relative_layout.region)
+        locations[:] = (
+            population.relative_layout.x + region.x,
+            population.relative_layout.y + region.y,
+            population.relative_layout.z + region.z,
+        )
+
+    return locations
+
+
+def _evaluate_for_connections(expressions, expr, default, rng, num, variables={}):
+    """
+    Evaluate an expression (e.g. weight, delay) for num connections with the
+    ExpressionCache expressions, returning an array of num values; variables
+    can give arrays of values for each connection, e.g. the distance r
+    """
+    if not expr:
+        return np.array(np.broadcast_to(default, (num,)))
+
+    return expressions.evaluate_array(expr, rng, num, variables)
+
+
+def _evaluate_projection_delay_weight(proj, expressions, rng):
+    """
+    Evaluate the delay and weight of a projection, in that order, with the
+    ExpressionCache expressions, using rng for any random numbers
+    """
+    delay = expressions.evaluate(proj.delay, rng) if proj.delay else 0
+    weight = expressions.evaluate(proj.weight, rng) if proj.weight else 1
+
+    return delay, weight
+
+
+def _generate_projection_connections(
+    proj,
+    expressions,
+    pre_locations,
+    post_locations,
+    rng,
+    delay,
+    weight,
+    legacy_generation=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of the projection proj between populations with
+    cells at pre_locations and post_locations, evaluating expressions with the
+    ExpressionCache expressions and continuing with rng after the delay and
+    weight of the projection have been evaluated (see
+    _evaluate_projection_delay_weight). Unless legacy_generation is True, the
+    connectivity, random probabilities, delays and weights are drawn from
+    separate streams derived from rng (see _get_projection_streams), so the
+    connections don't depend on block_size.
+
+    Yields tuples (pre_indices, post_indices, delays, weights) of blocks of
+    connections, in the order they should be passed to the handler
+    """
+    num_pre = len(pre_locations)
+    num_post = len(post_locations)
+
+    if not legacy_generation:
+        conn_rng, prob_rng, delay_rng, weight_rng = _get_projection_streams(rng)
+
+    if proj.random_connectivity and not legacy_generation:
+        probability = expressions.get(proj.random_connectivity.probability)
+        if probability.is_random:
+            probability = lambda shape, p=probability: np.reshape(
+                p.evaluate_array(prob_rng, shape[0] * shape[1]), shape
+            )
+        else:
+            probability = probability.evaluate()
+
+        for pre_indices, post_indices in random_connectivity_blocks(
+            conn_rng, num_pre, num_post, probability, block_size=block_size
+        ):
+            num = len(pre_indices)
+            delays = _evaluate_for_connections(
+                expressions, proj.delay, 0, delay_rng, num
+            )
+            weights = _evaluate_for_connections(
+                expressions, proj.weight, 1, weight_rng, num
+            )
+            yield pre_indices, post_indices, delays, weights
+
+    elif proj.random_connectivity:
+        for pre_i in range(num_pre):
+            post_indices = []
+            delays = []
+            weights = []
+            for post_i in range(num_post):
+                flip = rng.random()
+                # print("Is cell %i conn to %i, prob %s - %s"%(pre_i, post_i, flip, proj.random_connectivity.probability))
+                if flip < expressions.evaluate(
+                    proj.random_connectivity.probability, rng
+                ):
+                    delay, weight = _evaluate_projection_delay_weight(
+                        proj, expressions, rng
+                    )
+                    post_indices.append(post_i)
+                    delays.append(delay)
+                    weights.append(weight)
+
+            yield [pre_i] * len(post_indices), post_indices, delays, weights
+
+    elif proj.distance_dependent_connectivity:
+        if legacy_generation:
+            raise Exception(
+                "Distance dependent connectivity (in %s) can't be used with legacy_generation"
+                % proj.id
+            )
+        connectivity = proj.distance_dependent_connectivity
+
+        probability = 1
+        if connectivity.probability is not None:
+            probability = expressions.get(connectivity.probability, ("r",))
+            if probability.is_constant:
+                probability = probability.evaluate()
+            else:
+                probability = lambda r, p=probability: p.evaluate_array(
+                    prob_rng, len(r), {"r": r}
+                )
+
+        for (
+            pre_indices,
+            post_indices,
+            distances,
+        ) in distance_dependent_connectivity_blocks(
+            conn_rng,
+            pre_locations,
+            post_locations,
+            expressions.evaluate(connectivity.cutoff),
+            probability,
+            exclude_self=proj.presynaptic == proj.postsynaptic,
+            block_size=block_size,
+        ):
+            num = len(pre_indices)
+            r = {"r": distances}
+            delays = _evaluate_for_connections(
+                expressions, proj.delay, 0, delay_rng, num, r
+            )
+            weights = _evaluate_for_connections(
+                expressions, proj.weight, 1, weight_rng, num, r
+            )
+            yield pre_indices, post_indices, delays, weights
+
+    if (
+        proj.convergent_connectivity
+        and proj.convergent_connectivity.with_replacement is not False
+        and legacy_generation
+    ):
+        connectivity = proj.convergent_connectivity
+        exclude_self = (
+            proj.presynaptic == proj.postsynaptic
+            and not connectivity.allow_self_connections
+        )
+
+        pre_indices = []
+        post_indices = []
+        for post_i in range(num_post):
+            for count in range(int(connectivity.num_per_post)):
+                found = False
+                while not found:
+                    pre_i = int(rng.random() * num_pre)
+                    if exclude_self and pre_i == post_i:
+                        found = False
+                    else:
+                        found = True
+
+                pre_indices.append(pre_i)
+                post_indices.append(post_i)
+
+        yield pre_indices, post_indices, delay, weight
+
+    elif (
+        proj.convergent_connectivity
+        or proj.divergent_connectivity
+        or proj.total_number_connectivity
+    ):
+        if proj.convergent_connectivity:
+            connectivity = proj.convergent_connectivity
+            blocks = convergent_connectivity_blocks
+            number = connectivity.num_per_post
+        elif proj.divergent_connectivity:
+            connectivity = proj.divergent_connectivity
+            blocks = divergent_connectivity_blocks
+            number = connectivity.num_per_pre
+        else:
+            connectivity = proj.total_number_connectivity
+            blocks = total_number_connectivity_blocks
+            number = connectivity.number
+
+        if legacy_generation:
+            raise Exception(
+                "Connectivity without replacement or of a fixed number per pre cell or in total (in %s) can't be used with legacy_generation"
+                % proj.id
+            )
+
+        for pre_indices, post_indices in blocks(
+            conn_rng,
+            num_pre,
+            num_post,
+            number,
+            exclude_self=proj.presynaptic == proj.postsynaptic
+            and not connectivity.allow_self_connections,
+            with_replacement=connectivity.with_replacement is not False,
+            block_size=block_size,
+        ):
+            yield pre_indices, post_indices, delay, weight
+
+    elif proj.one_to_one_connector:
+        indices = np.arange(min(num_pre, num_post))
+        yield indices, indices, delay, weight
+
+
+def _can_generate_projection_totals(proj, expressions):
+    """
+    Can the number of connections and total weight of the projection be
+    generated without generating each connection (see
+    _generate_projection_totals)?
+    """
+    if proj.random_connectivity:
+        return expressions.get(proj.random_connectivity.probability).is_constant
+
+    return bool(
+        proj.convergent_connectivity
+        or proj.divergent_connectivity
+        or proj.total_number_connectivity
+        or proj.one_to_one_connector
+    )
+
+
+def _generate_projection_totals(
+    proj,
+    expressions,
+    num_pre,
+    num_post,
+    rng,
+    weight,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the number of connections and total weight of the projection
+    proj between populations of num_pre and num_post cells, for handlers
+    which don't need the individual connections. These come from the same
+    distributions as those of the connections _generate_projection_connections
+    would generate (but aren't the same samples). Only for projections where
+    _can_generate_projection_totals is True.
+
+    Returns a tuple (num_connections, total_weight)
+    """
+    exclude_self = proj.presynaptic == proj.postsynaptic
+    conn_rng, prob_rng, delay_rng, weight_rng = _get_projection_streams(rng)
+
+    if proj.random_connectivity:
+        num = random_connectivity_count(
+            conn_rng,
+            num_pre,
+            num_post,
+            expressions.evaluate(proj.random_connectivity.probability),
+        )
+        if not proj.weight or expressions.get(proj.weight).is_constant:
+            return num, num * weight
+
+        # Weights are drawn for each connection, but only summed
+        total_weight = 0
+        for start in range(0, num, max(1, int(block_size))):
+            block = min(num - start, max(1, int(block_size)))
+            total_weight += (
+                expressions.evaluate_array(proj.weight, weight_rng, block).sum().item()
+            )
+        return num, total_weight
+
+    if proj.convergent_connectivity:
+        connectivity = proj.convergent_connectivity
+        num = fixed_number_connectivity_count(
+            num_post,
+            num_pre,
+            connectivity.num_per_post,
+            exclude_self and not connectivity.allow_self_connections,
+            connectivity.with_replacement is not False,
+        )
+    elif proj.divergent_connectivity:
+        connectivity = proj.divergent_connectivity
+        num = fixed_number_connectivity_count(
+            num_pre,
+            num_post,
+            connectivity.num_per_pre,
+            exclude_self and not connectivity.allow_self_connections,
+            connectivity.with_replacement is not False,
+        )
+    elif proj.total_number_connectivity:
+        connectivity = proj.total_number_connectivity
+        num = total_number_connectivity_count(
+            num_pre,
+            num_post,
+            connectivity.number,
+            exclude_self and not connectivity.allow_self_connections,
+            connectivity.with_replacement is not False,
+        )
+    else:
+        num = min(num_pre, num_post)
+
+    return num, num * weight
+
+
+def _sum_connection_blocks(blocks):
+    """
+    The number of connections and total weight of blocks of connections
+    (pre_indices, post_indices, delays, weights)
+    """
+    num_connections = 0
+    total_weight = 0
+    for pre_indices, post_indices, delays, weights in blocks:
+        num = len(pre_indices)
+        num_connections += num
+        total_weight += np.broadcast_to(weights, (num,)).sum().item()
+
+    return num_connections, total_weight
+
+
+def _generate_inputs(input, expressions, num_cells, rng):
+    """
+    Choose the cells of a population of num_cells cells which receive an
+    input, using rng (a numpy Generator, or a random.Random for
+    legacy_generation), returning arrays of the cell index and segment id of
+    each individual input, along with their weights (a single value unless
+    the weight is random)
+    """
+    if input.number_per_cell and input.segment_ids:
+        raise Exception(
+            "On input: %s, only one of number_per_cell or segment_ids is allowed"
+            % input.id
+        )
+
+    if input.number_per_cell:
+        number_per_cell = expressions.evaluate(input.number_per_cell)
+        seg_ids = [0] * number_per_cell
+    elif input.segment_ids:
+        seg_ids = parse_list_like(input.segment_ids)
+    else:
+        seg_ids = [0]
+
+    if isinstance(rng, random.Random):
+        flips = np.array([rng.random() for i in range(num_cells)])
+    else:
+        flips = rng.random(num_cells)
+    cell_ids = np.repeat(np.nonzero(flips * 100.0 < input.percentage)[0], len(seg_ids))
+    seg_ids = np.tile(
+        np.array(seg_ids, dtype=int), len(cell_ids) // max(1, len(seg_ids))
+    )
+
+    weight = expressions.get(input.weight if input.weight else 1)
+    if not weight.is_random:
+        weights = weight.evaluate()
+    elif isinstance(rng, random.Random):
+        # As in previous versions, random weights don't use the network's rng
+        weights = np.array([expressions.evaluate(input.weight) for i in cell_ids])
+    else:
+        weights = weight.evaluate_array(rng, len(cell_ids))
+
+    return cell_ids, seg_ids, weights
+
+
+def _get_picklable_parameters(parameters):
+    """
+    Copy of the network parameters without the modules, random number
+    generators, etc. which evaluate() may have added to them
+    """
+    if parameters is None:
+        return None
+    return {
+        p: parameters[p]
+        for p in parameters
+        if p not in ["__builtins__", "rng", "math", "numpy"]
+    }
+
+
+def _generate_projection_in_worker(
+    proj, parameters, pre_locations, post_locations, seed, block_size
+):
+    """
+    Generate all of the connections of a projection in a worker process, with
+    the projection's own random number generator, returning the list of blocks
+    which _generate_projection_connections yields in the serial case
+    """
+    rng = _get_rng_for_element(seed, "projection", proj.id)
+    expressions = ExpressionCache(parameters)
+    delay, weight = _evaluate_projection_delay_weight(proj, expressions, rng)
+    if weight == 0:
+        return []
+
+    return list(
+        _generate_projection_connections(
+            proj,
+            expressions,
+            pre_locations,
+            post_locations,
+            rng,
+            delay,
+            weight,
+            block_size=block_size,
+        )
+    )
+
+
+def _get_component_objects(nl_model, base_dir=None):
+    """
+    Get the NeuroML2 objects for the cells and synapses of the network (read
+    from their neuroml2_source_files or created for PyNN types), as dicts of
+    cell_objects and synapse_objects by id
+    """
+    cell_objects = {}
+    synapse_objects = {}
+
+    nml2_doc_temp = _extract_pynn_components_to_neuroml(nl_model)
+
+    for c in nl_model.cells:
+
+        if c.neuroml2_source_file:
+            from pyneuroml import pynml
+
+            nml2_doc = pynml.read_neuroml2_file(
+                locate_file(c.neuroml2_source_file, base_dir), include_includes=True
+            )
+            cell_objects[c.id] = nml2_doc.get_by_id(c.id)
+
+        if c.pynn_cell:
+            cell_objects[c.id] = nml2_doc_temp.get_by_id(c.id)
+
+    for s in nl_model.synapses:
+        if s.neuroml2_source_file:
+            from pyneuroml import pynml
+
+            nml2_doc = pynml.read_neuroml2_file(
+                locate_file(s.neuroml2_source_file, base_dir), include_includes=True
+            )
+            synapse_objects[s.id] = nml2_doc.get_by_id(s.id)
+
+        if s.pynn_synapse:
+            synapse_objects[s.id] = nml2_doc_temp.get_by_id(s.id)
+
+    return cell_objects, synapse_objects
+
+
+def _handle_projection(handler, proj, synapse_objects):
+    """
+    Pass a projection of the network to the handler, with the NeuroML2
+    objects for its synapses
+    """
+    synapse_obj = (
+        synapse_objects[proj.synapse] if proj.synapse in synapse_objects else None
+    )
+    pre_synapse_obj = (
+        synapse_objects[proj.pre_synapse]
+        if proj.pre_synapse in synapse_objects
+        else None
+    )
+
+    handler.handle_projection(
+        proj.id,
+        proj.presynaptic,
+        proj.postsynaptic,
+        proj.synapse,
+        synapse_obj=synapse_obj,
+        pre_synapse_obj=pre_synapse_obj,
+        type=proj.type if proj.type else "projection",
+    )
+
+    if pre_synapse_obj is None and proj.pre_synapse == "silentSyn_%s" % proj.id:
+        # Including the handlers inside a CompositeHandler
+        for h in getattr(handler, "child_handlers", [handler]):
+            if hasattr(h, "nml_doc"):
+                for ss in h.nml_doc.silent_synapses:
+                    if ss.id == "silentSyn_%s" % proj.id:
+                        h.nml_doc.silent_synapses.remove(
+                            ss
+                        )  # A default silent synapse was generated by libNeuroML
+
+
+def _handle_locations(handler, *args, **kwargs):
+    """
+    Pass the locations of the cells in a population to the handler, using
+    its handle_locations method if it has one (e.g. DefaultNetworkHandler),
+    otherwise calling handle_location for each cell
+    """
+    if hasattr(handler, "handle_locations"):
+        handler.handle_locations(*args, **kwargs)
+    else:
+        DefaultNetworkHandler.handle_locations(handler, *args, **kwargs)
+
+
+def _handle_connections(handler, *args, **kwargs):
+    """
+    Pass a batch of connections to the handler, using its handle_connections
+    method if it has one, otherwise calling handle_connection for each one
+    """
+    if hasattr(handler, "handle_connections"):
+        handler.handle_connections(*args, **kwargs)
+    else:
+        DefaultNetworkHandler.handle_connections(handler, *args, **kwargs)
+
+
+def _handle_inputs(handler, *args, **kwargs):
+    """
+    Pass a batch of inputs to the handler, using its handle_inputs method if
+    it has one, otherwise calling handle_single_input for each one
+    """
+    if hasattr(handler, "handle_inputs"):
+        handler.handle_inputs(*args, **kwargs)
+    else:
+        DefaultNetworkHandler.handle_inputs(handler, *args, **kwargs)
+
+
 def generate_network(
     nl_model,
     handler,
@@ -39,15 +640,64 @@ def generate_network(
     include_connections=True,
     include_inputs=True,
     base_dir=None,
+    legacy_generation=False,
+    block_size=DEFAULT_BLOCK_SIZE,
+    num_workers=1,
+    chunk_size=None,
+    cache_dir=None,
+    profiler=None,
 ):
     """
     Generate the network model as described in NeuroMLlite in a specific handler,
     e.g. NeuroMLHandler, PyNNHandler, etc.
+
+    By default, each population, projection and input has its own numpy
+    random number generator, derived from the network seed and the id of the
+    element (see _get_rng_for_element), so adding, removing or reordering
+    elements doesn't change how the others are generated. Connectivity is
+    sampled with numpy in blocks of at most block_size pre/post cell pairs;
+    the connections generated do not depend on block_size.
+    Set legacy_generation=True to reproduce exactly the networks generated
+    by previous versions of NeuroMLlite, which sampled everything in turn
+    with a single random.Random instance.
+
+    With num_workers > 1, the connectivity of the projections is generated in
+    that many worker processes. The connections are passed to the handler in
+    the main process in the same order, and are identical to those generated
+    with num_workers=1.
+
+    If chunk_size is set, connections and inputs are passed to the handler
+    (through handle_connections and handle_inputs, see DefaultNetworkHandler)
+    in chunks of chunk_size, so handlers which write out or compress each
+    chunk as it arrives only need memory for one chunk at a time (plus one
+    block). Note
+    that with num_workers > 1, all the connections of a projection are
+    returned from the worker at once.
+
+    If cache_dir is set, the locations of the cells in each population and
+    the connections of each projection are saved there (see BuildCache), and
+    reused in later calls if the element, the parameters it uses and the
+    seed are unchanged, so only edited elements are regenerated.
+
+    If the handler's needs_individual_connections() returns False (e.g. for
+    graphs/matrices of connectivity between populations), only the number of
+    connections and total weight of each projection are passed to its
+    handle_connection_totals. Where possible (see
+    _can_generate_projection_totals), these are drawn directly from their
+    distributions, without generating each connection, so they are not the
+    totals of the connections which would otherwise be generated.
+
+    A GenerationProfiler can be passed as profiler to record the time taken
+    to generate each population, projection and input, and how much of it is
+    spent in the handler.
     """
 
     pop_locations = {}
-    cell_objects = {}
-    synapse_objects = {}
+
+    if profiler:
+        profiler.network_id = nl_model.id
+        handler = profiler.wrap_handler(handler)
+        profiler.start_phase("setup")
 
     print_v(
         "Starting net generation for %s%s..."
@@ -55,6 +705,16 @@ def generate_network(
     )
 
     rng, seed = _get_rng_for_network(nl_model)
+    expressions = ExpressionCache(get_parameter_table(nl_model).get_values())
+
+    cache = None
+    pop_cache_keys = {}
+    if cache_dir and (legacy_generation or nl_model.network_reader):
+        print_v(
+            "Cached generation can't be used with legacy_generation or a network_reader; ignoring cache_dir..."
+        )
+    elif cache_dir:
+        cache = BuildCache(cache_dir, nl_model, seed, block_size)
 
     if nl_model.network_reader:
 
@@ -84,36 +744,15 @@ def generate_network(
         temperature = "%sdegC" % nl_model.temperature if nl_model.temperature else None
         handler.handle_network(nl_model.id, nl_model.notes, temperature=temperature)
 
-    nml2_doc_temp = _extract_pynn_components_to_neuroml(nl_model)
-
-    for c in nl_model.cells:
-
-        if c.neuroml2_source_file:
-            from pyneuroml import pynml
-
-            nml2_doc = pynml.read_neuroml2_file(
-                locate_file(c.neuroml2_source_file, base_dir), include_includes=True
-            )
-            cell_objects[c.id] = nml2_doc.get_by_id(c.id)
-
-        if c.pynn_cell:
-            cell_objects[c.id] = nml2_doc_temp.get_by_id(c.id)
-
-    for s in nl_model.synapses:
-        if s.neuroml2_source_file:
-            from pyneuroml import pynml
-
-            nml2_doc = pynml.read_neuroml2_file(
-                locate_file(s.neuroml2_source_file, base_dir), include_includes=True
-            )
-            synapse_objects[s.id] = nml2_doc.get_by_id(s.id)
-
-        if s.pynn_synapse:
-            synapse_objects[s.id] = nml2_doc_temp.get_by_id(s.id)
+    network = CompiledNetwork(nl_model, base_dir)
+    cell_objects = network.cell_objects
+    synapse_objects = network.synapse_objects
 
-    for p in nl_model.populations:
+    for p in network.populations:
+        if profiler:
+            profiler.start_phase("population", p.id)
 
-        size = evaluate(p.size, nl_model.parameters)
+        size = network.get_population_size(p.id)
         properties = p.properties if p.properties else {}
 
         if p.random_layout:
@@ -152,192 +791,189 @@ def generate_network(
                 properties=properties,
             )
 
-        pop_locations[p.id] = np.zeros((size, 3))
-
-        for i in range(size):
-            if p.random_layout:
-                region = nl_model.get_child(p.random_layout.region, "regions")
-
-                x = region.x + rng.random() * region.width
-                y = region.y + rng.random() * region.height
-                z = region.z + rng.random() * region.depth
-                pop_locations[p.id][i] = (x, y, z)
-
-                handler.handle_location(i, p.id, p.component, x, y, z)
-
-            if p.single_location:
-                loc = p.single_location.location
-                x = loc.x
-                y = loc.y
-                z = loc.z
-                pop_locations[p.id][i] = (x, y, z)
+        locations = None
+        if cache:
+            region = p.random_layout or p.relative_layout
+            key = cache.get_key(
+                "population",
+                p,
+                size,
+                network.get_region(region.region) if region else None,
+            )
+            pop_cache_keys[p.id] = key
+            locations = cache.load_locations(key)
 
-                handler.handle_location(i, p.id, p.component, x, y, z)
+        if locations is None:
+            locations = _get_population_locations(
+                network, p, size, rng if legacy_generation else seed
+            )
+            if cache:
+                cache.save_locations(key, locations)
+        pop_locations[p.id] = locations
 
-            if p.relative_layout:
-                print_v("Generating population with layout: %s" % p.relative_layout)
-                region = nl_model.get_child(p.relative_layout.region, "regions")
-                x = p.relative_layout.x + region.x
-                y = p.relative_layout.y + region.y
-                z = p.relative_layout.z + region.z
-                pop_locations[p.id][i] = (x, y, z)
-                handler.handle_location(i, p.id, p.component, x, y, z)
+        if p.random_layout or p.single_location or p.relative_layout:
+            _handle_locations(handler, p.id, p.component, pop_locations[p.id])
 
         if hasattr(handler, "finalise_population"):
             handler.finalise_population(p.id)
 
     if include_connections:
-        for p in nl_model.projections:
+        if profiler:
+            profiler.start_phase("projection_setup")
+
+        proj_cache_keys = {}
+        cached = set()
+        if cache:
+            for p in nl_model.projections:
+                proj_cache_keys[p.id] = cache.get_key(
+                    "projection",
+                    p,
+                    pop_cache_keys[p.presynaptic],
+                    pop_cache_keys[p.postsynaptic],
+                )
+                if cache.contains(proj_cache_keys[p.id]):
+                    cached.add(p.id)
+
+        # Handlers which only use the number of connections and total weight
+        # of each projection (e.g. population level graphs) are passed these,
+        # generated without generating each connection where possible
+        totals_only = hasattr(handler, "needs_individual_connections") and (
+            not handler.needs_individual_connections()
+        )
+        use_totals = set()
+        if totals_only and not legacy_generation:
+            for p in nl_model.projections:
+                if p.id not in cached and _can_generate_projection_totals(
+                    p, expressions
+                ):
+                    use_totals.add(p.id)
+
+        executor = None
+        to_submit = []
+        if num_workers > 1 and legacy_generation:
+            print_v(
+                "Projections can't be generated in parallel with legacy_generation; generating them serially..."
+            )
+        elif num_workers > 1:
+            print_v("Generating projections with %i worker processes..." % num_workers)
+            executor = ProcessPoolExecutor(max_workers=num_workers)
+            parameters = _get_picklable_parameters(expressions.parameters)
+            to_submit = [
+                p
+                for p in nl_model.projections
+                if p.id not in cached and p.id not in use_totals
+            ]
 
-            type = p.type if p.type else "projection"
+        # The projections generated in the workers are handled in order, with
+        # at most max_in_flight of them being generated (or waiting to be
+        # handled) at once, so their connections aren't all held in memory
+        max_in_flight = 2 * num_workers
+        futures = {}
+        try:
+            for p in nl_model.projections:
+                while to_submit and len(futures) < max_in_flight:
+                    q = to_submit.pop(0)
+                    futures[q.id] = executor.submit(
+                        _generate_projection_in_worker,
+                        q,
+                        parameters,
+                        pop_locations[q.presynaptic],
+                        pop_locations[q.postsynaptic],
+                        seed,
+                        block_size,
+                    )
+                future = futures.pop(p.id, None)
 
-            synapse_obj = (
-                synapse_objects[p.synapse] if p.synapse in synapse_objects else None
-            )
-            pre_synapse_obj = (
-                synapse_objects[p.pre_synapse]
-                if p.pre_synapse in synapse_objects
-                else None
-            )
+                if profiler:
+                    profiler.start_phase("projection", p.id)
 
-            delay = evaluate(p.delay, nl_model.parameters, rng) if p.delay else 0
-            weight = evaluate(p.weight, nl_model.parameters, rng) if p.weight else 1
-
-            if weight != 0:
-                handler.handle_projection(
-                    p.id,
-                    p.presynaptic,
-                    p.postsynaptic,
-                    p.synapse,
-                    synapse_obj=synapse_obj,
-                    pre_synapse_obj=pre_synapse_obj,
-                    type=type,
-                )
+                if legacy_generation:
+                    proj_rng = rng
+                else:
+                    proj_rng = _get_rng_for_element(seed, "projection", p.id)
 
-                if pre_synapse_obj is None and p.pre_synapse == "silentSyn_%s" % p.id:
-                    if hasattr(handler, "nml_doc"):
-                        for ss in handler.nml_doc.silent_synapses:
-                            if ss.id == "silentSyn_%s" % p.id:
-                                handler.nml_doc.silent_synapses.remove(
-                                    ss
-                                )  # A default silent synapse was generated by libNeuroML
-
-                conn_count = 0
-                if p.random_connectivity:
-                    for pre_i in range(len(pop_locations[p.presynaptic])):
-                        for post_i in range(len(pop_locations[p.postsynaptic])):
-                            flip = rng.random()
-                            # print("Is cell %i conn to %i, prob %s - %s"%(pre_i, post_i, flip, p.random_connectivity.probability))
-                            if flip < evaluate(
-                                p.random_connectivity.probability,
-                                nl_model.parameters,
-                                rng,
-                            ):
-
-                                delay = (
-                                    evaluate(p.delay, nl_model.parameters, rng)
-                                    if p.delay
-                                    else 0
-                                )
-                                weight = (
-                                    evaluate(p.weight, nl_model.parameters, rng)
-                                    if p.weight
-                                    else 1
-                                )
-                                # print_v("Adding connection %i with weight: %s, delay: %s"%(conn_count, weight, delay))
-                                handler.handle_connection(
-                                    p.id,
-                                    conn_count,
-                                    p.presynaptic,
-                                    p.postsynaptic,
-                                    p.synapse,
-                                    pre_i,
-                                    post_i,
-                                    preSegId=0,
-                                    preFract=0.5,
-                                    postSegId=0,
-                                    postFract=0.5,
-                                    delay=delay,
-                                    weight=weight,
-                                )
-                                conn_count += 1
+                delay, weight = _evaluate_projection_delay_weight(
+                    p, expressions, proj_rng
+                )
 
-                if p.convergent_connectivity:
+                if weight != 0:
+                    _handle_projection(handler, p, synapse_objects)
 
-                    for post_i in range(len(pop_locations[p.postsynaptic])):
+                    if p.id in use_totals:
+                        blocks = None
+                    elif p.id in cached:
+                        blocks = cache.load_connections(proj_cache_keys[p.id])
+                    elif future is not None:
+                        blocks = future.result()
+                    else:
+                        blocks = _generate_projection_connections(
+                            p,
+                            expressions,
+                            pop_locations[p.presynaptic],
+                            pop_locations[p.postsynaptic],
+                            proj_rng,
+                            delay,
+                            weight,
+                            legacy_generation=legacy_generation,
+                            block_size=block_size,
+                        )
 
-                        for count in range(int(p.convergent_connectivity.num_per_post)):
-                            found = False
-                            while not found:
-                                pre_i = int(
-                                    rng.random() * len(pop_locations[p.presynaptic])
-                                )
-                                if p.presynaptic == p.postsynaptic and pre_i == post_i:
-                                    found = False
-                                else:
-                                    found = True
-
-                            print_v(
-                                "Adding connection %i (%i->%i; %i to %s of post) with weight: %s, delay: %s"
-                                % (
-                                    conn_count,
-                                    pre_i,
-                                    post_i,
-                                    count,
-                                    p.convergent_connectivity.num_per_post,
-                                    weight,
-                                    delay,
-                                )
+                    if cache and p.id not in cached and blocks is not None:
+                        blocks = cache.save_connections(proj_cache_keys[p.id], blocks)
+
+                    if totals_only:
+                        if blocks is None:
+                            totals = _generate_projection_totals(
+                                p,
+                                expressions,
+                                len(pop_locations[p.presynaptic]),
+                                len(pop_locations[p.postsynaptic]),
+                                proj_rng,
+                                weight,
+                                block_size=block_size,
                             )
-                            handler.handle_connection(
+                        else:
+                            totals = _sum_connection_blocks(blocks)
+                        handler.handle_connection_totals(
+                            p.id, p.presynaptic, p.postsynaptic, p.synapse, *totals
+                        )
+                        blocks = []
+
+                    elif chunk_size:
+                        blocks = rechunk_connections(blocks, chunk_size)
+
+                    conn_count = 0
+                    for pre_indices, post_indices, delays, weights in blocks:
+                        if len(pre_indices) > 0:
+                            _handle_connections(
+                                handler,
                                 p.id,
                                 conn_count,
                                 p.presynaptic,
                                 p.postsynaptic,
                                 p.synapse,
-                                pre_i,
-                                post_i,
-                                preSegId=0,
-                                preFract=0.5,
-                                postSegId=0,
-                                postFract=0.5,
-                                delay=delay,
-                                weight=weight,
+                                pre_indices,
+                                post_indices,
+                                delays=delays,
+                                weights=weights,
                             )
-                            conn_count += 1
-
-                elif p.one_to_one_connector:
-                    for i in range(
-                        min(
-                            len(pop_locations[p.presynaptic]),
-                            len(pop_locations[p.postsynaptic]),
-                        )
-                    ):
-
-                        # print_v("Adding connection %i with weight: %s, delay: %s"%(conn_count, weight, delay))
-                        handler.handle_connection(
-                            p.id,
-                            conn_count,
-                            p.presynaptic,
-                            p.postsynaptic,
-                            p.synapse,
-                            i,
-                            i,
-                            preSegId=0,
-                            preFract=0.5,
-                            postSegId=0,
-                            postFract=0.5,
-                            delay=delay,
-                            weight=weight,
-                        )
-                        conn_count += 1
+                            conn_count += len(pre_indices)
 
-                handler.finalise_projection(
-                    p.id, p.presynaptic, p.postsynaptic, p.synapse
-                )
+                    handler.finalise_projection(
+                        p.id, p.presynaptic, p.postsynaptic, p.synapse
+                    )
+        finally:
+            if executor is not None:
+                # Any projections not handled (e.g. after an error) are
+                # cancelled if their generation hasn't started
+                for future in futures.values():
+                    future.cancel()
+                executor.shutdown(wait=True)
 
     if include_inputs:
         for input in nl_model.inputs:
+            if profiler:
+                profiler.start_phase("input", input.id)
 
             handler.handle_input_list(
                 input.id,
@@ -347,44 +983,241 @@ def generate_network(
                 input_comp_obj=None,
             )
 
-            input_count = 0
-            for i in range(len(pop_locations[input.population])):
-                flip = rng.random()
-                weight = input.weight if input.weight else 1
-                if flip * 100.0 < input.percentage:
-
-                    if input.number_per_cell and input.segment_ids:
-                        raise Exception(
-                            "On input: %s, only one of number_per_cell or segment_ids is allowed"
-                        )
+            cell_ids, seg_ids, weights = _generate_inputs(
+                input,
+                expressions,
+                len(pop_locations[input.population]),
+                rng
+                if legacy_generation
+                else _get_rng_for_element(seed, "input", input.id),
+            )
 
-                    if input.number_per_cell:
-                        number_per_cell = evaluate(
-                            input.number_per_cell, nl_model.parameters
-                        )
-                        seg_ids = [0] * number_per_cell
-                    elif input.segment_ids:
-                        seg_ids = parse_list_like(input.segment_ids)
-                    else:
-                        seg_ids = [0]
-
-                    for seg_id in seg_ids:
-                        handler.handle_single_input(
-                            input.id,
-                            input_count,
-                            i,
-                            segId=seg_id,
-                            weight=evaluate(weight, nl_model.parameters),
-                        )
-                        input_count += 1
+            step = chunk_size if chunk_size else max(1, len(cell_ids))
+            for start in range(0, len(cell_ids), step):
+                _handle_inputs(
+                    handler,
+                    input.id,
+                    start,
+                    cell_ids[start : start + step],
+                    segIds=seg_ids[start : start + step],
+                    weights=weights
+                    if np.ndim(weights) == 0
+                    else weights[start : start + step],
+                )
 
             handler.finalise_input_source(input.id)
 
+    if profiler:
+        profiler.start_phase("finalise")
+
     if hasattr(handler, "finalise_document"):
         handler.finalise_document()
     else:
         pass
 
+    if profiler:
+        profiler.finish()
+
+
+def iter_connections(
+    nl_model,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    """
+    Generate the connections of all of the projections in the network without
+    a handler, streaming them in chunks of at most chunk_size connections.
+
+    Yields tuples (projection_id, start_id, pre_indices, post_indices, delays,
+    weights) where the last four are arrays with one entry per connection and
+    start_id is the id of the first connection of the chunk in the projection.
+    The connections are the same, and in the same order, as those which
+    generate_network passes to a handler.
+    """
+    rng, seed = _get_rng_for_network(nl_model)
+    expressions = ExpressionCache(get_parameter_table(nl_model).get_values())
+
+    network = CompiledNetwork(nl_model)
+    pop_locations = {
+        p.id: _get_population_locations(
+            network, p, network.get_population_size(p.id), seed
+        )
+        for p in network.populations
+    }
+
+    for p in nl_model.projections:
+        proj_rng = _get_rng_for_element(seed, "projection", p.id)
+        delay, weight = _evaluate_projection_delay_weight(p, expressions, proj_rng)
+        if weight != 0:
+            blocks = _generate_projection_connections(
+                p,
+                expressions,
+                pop_locations[p.presynaptic],
+                pop_locations[p.postsynaptic],
+                proj_rng,
+                delay,
+                weight,
+                block_size=block_size,
+            )
+
+            start_id = 0
+            for chunk in rechunk_connections(blocks, chunk_size):
+                yield (p.id, start_id) + chunk
+                start_id += len(chunk[0])
+
+
+def _get_graph_handler(simulator, network):
+    """
+    Create the GraphVizHandler for simulator, e.g. graph3c (level 3, circo
+    engine), or return None if it can't be parsed
+    """
+    from neuromllite.GraphVizHandler import GraphVizHandler, engines
+
+    try:
+        if simulator[-1].isalpha():
+
+            engine = engines[simulator[-1]]
+            level = int(simulator[5:-1])
+        else:
+            engine = "dot"
+            level = int(simulator[5:])
+
+    except Exception as e:
+        print_v("Error parsing: %s: %s" % (simulator, e))
+        print_v(
+            "Graphs of the network structure can be generated at many levels of detail (1-6, required) and laid out using GraphViz engines (d - dot (default); c - circo; n - neato; f - fdp), so use: -graph3c, -graph2, -graph4f etc."
+        )
+        return None
+
+    return GraphVizHandler(level, engine=engine, nl_network=network)
+
+
+def _get_matrix_handler(simulator, network):
+    """
+    Create the MatrixHandler for simulator, e.g. matrix2 (level 2), or return
+    None if it can't be parsed. With a suffix npz or h5 (e.g. matrix-1npz),
+    the matrices are saved to <network id>_matrices.npz/.h5 instead of being
+    plotted
+    """
+    from neuromllite.MatrixHandler import MatrixHandler
+
+    save_to = None
+    for suffix in ["npz", "h5"]:
+        if simulator.endswith(suffix):
+            simulator = simulator[: -len(suffix)]
+            save_to = "%s_matrices.%s" % (network.id, suffix)
+    try:
+        level = int(simulator[6:])
+    except:
+        print_v("Error parsing: %s" % simulator)
+        print_v(
+            "Matrices of the network structure can be generated at many levels of detail (1-n, required), so use: -matrix1, -matrix2, etc."
+        )
+        return None
+
+    if save_to:
+        return MatrixHandler(level, nl_network=network, save_to=save_to, show=False)
+    return MatrixHandler(level, nl_network=network)
+
+
+def _get_abstract_populations(network):
+    """
+    The ids of the populations without positions, whose properties
+    generate_network only passes on with always_include_props=True
+    """
+    return [
+        p.id
+        for p in network.populations
+        if not p.random_layout and not p.single_location and not p.relative_layout
+    ]
+
+
+def generate_exports(
+    simulation,
+    exports,
+    network=None,
+    base_dir=None,
+    target_dir=None,
+    legacy_generation=False,
+    num_workers=1,
+    cache_dir=None,
+):
+    """
+    Generate the network for several exports (nml, nmlh5, graph[1-6 n/d/f/c]
+    or matrix[1-n], e.g. ["nml", "matrix1", "graph2"]) at once, passing it
+    to the handlers for all of them with a CompositeHandler, rather than
+    generating it for each one in turn.
+
+    NeuroML2 is generated without the properties of populations without
+    positions, but graphs and matrices use them, so the CompositeHandler
+    passes no properties for these populations to the NeuroML2 handler
+    """
+    from neuromllite.CompositeHandler import CompositeHandler
+    from neuroml.hdf5.NetworkBuilder import NetworkBuilder
+    import copy
+
+    if network == None:
+        network = load_network(simulation.network)
+
+    print_v("Generating network %s for: %s..." % (network.id, ", ".join(exports)))
+
+    # NetworkBuilders keep the elements they build in class attributes, so
+    # only one can be used at a time; it's copied for each NeuroML2 format
+    nml_formats = []
+    neuroml_handler = None
+    other_handlers = []
+    for export in exports:
+        if export in ["nml", "neuroml", "nmlh5", "neuromlh5"]:
+            nml_formats.append("hdf5" if export.endswith("h5") else "xml")
+            neuroml_handler = NetworkBuilder()
+        elif export.lower().startswith("graph"):
+            handler = _get_graph_handler(export, network)
+            if handler is None:
+                return
+            other_handlers.append(handler)
+        elif export.lower().startswith("matrix"):
+            handler = _get_matrix_handler(export, network)
+            if handler is None:
+                return
+            other_handlers.append(handler)
+        else:
+            raise Exception("Export %s can't be generated with others" % export)
+
+    handlers = other_handlers
+    property_overrides = {}
+    if neuroml_handler:
+        handlers = [neuroml_handler] + other_handlers
+        property_overrides[0] = {
+            pop_id: {} for pop_id in _get_abstract_populations(network)
+        }
+
+    generate_network(
+        network,
+        CompositeHandler(handlers, property_overrides=property_overrides)
+        if len(handlers) > 1
+        else handlers[0],
+        always_include_props=len(other_handlers) > 0,
+        base_dir=base_dir,
+        legacy_generation=legacy_generation,
+        num_workers=num_workers,
+        cache_dir=cache_dir,
+    )
+
+    for i, format in enumerate(nml_formats):
+        generate_neuroml2_from_network(
+            network,
+            format=format,
+            base_dir=base_dir,
+            target_dir=target_dir,
+            validate=True,
+            simulation=simulation,
+            neuroml_handler=neuroml_handler
+            if i == len(nml_formats) - 1
+            else copy.deepcopy(neuroml_handler),
+        )
+
+    print_v("Done with: %s" % ", ".join(exports))
+
 
 def check_to_generate_or_run(argv, sim):
     """
@@ -401,9 +1234,23 @@ def check_to_generate_or_run(argv, sim):
         print_v("No arguments found. Currently supported export formats:")
         print_v(
             "   -nml |  -nmlh5 | -jnml | -jnmlnrn | -jnmlnetpyne | -netpyne | -pynnnrn "
-            + "| -pynnnest | -pynnbrian | -pynnneuroml | -sonata | -matrix[1-2] | -graph[1-6 n/d/f/c]"
+            + "| -pynnnest | -pynnbrian | -pynnneuroml | -sonata | -matrix[1-2][npz/h5] | -graph[1-6 n/d/f/c]"
+        )
+        print_v(
+            "   (several of -nml, -nmlh5, -matrix* and -graph* can be given, e.g. -nml -matrix1 -graph2, generating the network once for all of them)"
         )
 
+    exports = [
+        a[1:]
+        for a in argv[1:]
+        if a in ["-nml", "-neuroml", "-nmlh5", "-neuromlh5"]
+        or a.startswith("-graph")
+        or a.startswith("-matrix")
+    ]
+    if len(exports) > 1:
+        generate_exports(sim, exports)
+        return
+
     if "-pynnnest" in argv:
         generate_and_run(sim, simulator="PyNN_NEST")
 
@@ -480,6 +1327,7 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
     PyNN elements (e.g. IF_cond_alpha, DCSource) and parameters, and convert
     these to the equivalent elements in a NeuroMLDocument
     """
+    parameter_table = get_parameter_table(nl_model)
 
     import copy
 
@@ -488,6 +1336,8 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
 
         nml_doc = NeuroMLDocument(id="temp")
 
+    network = CompiledNetwork(nl_model)
+
     for c in nl_model.cells:
         if c.pynn_cell:
 
@@ -496,11 +1346,11 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
 
                 cell_params = copy.deepcopy(c.parameters) if c.parameters else {}
                 for p in cell_params:
-                    cell_params[p] = evaluate(cell_params[p], nl_model.parameters)
-                for proj in nl_model.projections:
+                    cell_params[p] = parameter_table.evaluate(cell_params[p])
+                for proj in network.projections:
 
-                    synapse = nl_model.get_child(proj.synapse, "synapses")
-                    post_pop = nl_model.get_child(proj.postsynaptic, "populations")
+                    synapse = network.get_synapse(proj.synapse)
+                    post_pop = network.get_population(proj.postsynaptic)
                     if post_pop.component == c.id:
                         # print("--------- Cell %s in post pop %s of %s uses %s"%(c.id,post_pop.id, proj.id, synapse))
 
@@ -509,8 +1359,8 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
                         elif synapse.pynn_receptor_type == "inhibitory":
                             post = "_I"
                         for p in synapse.parameters:
-                            cell_params["%s%s" % (p, post)] = evaluate(
-                                synapse.parameters[p], nl_model.parameters
+                            cell_params["%s%s" % (p, post)] = parameter_table.evaluate(
+                                synapse.parameters[p]
                             )
 
                 temp_cell = eval("pyNN.neuroml.%s(**cell_params)" % c.pynn_cell)
@@ -529,9 +1379,9 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
             if s.pynn_synapse_type and s.pynn_receptor_type:
                 import neuroml
 
-                tau_syn = evaluate(s.parameters["tau_syn"], nl_model.parameters)
+                tau_syn = parameter_table.evaluate(s.parameters["tau_syn"])
                 if "e_rev" in s.parameters:
-                    e_rev = evaluate(s.parameters["e_rev"], nl_model.parameters)
+                    e_rev = parameter_table.evaluate(s.parameters["e_rev"])
                 if s.pynn_synapse_type == "cond_exp":
                     syn = neuroml.ExpCondSynapse(id=s.id, tau_syn=tau_syn, e_rev=e_rev)
                     nml_doc.exp_cond_synapses.append(syn)
@@ -554,7 +1404,7 @@ def _extract_pynn_components_to_neuroml(nl_model, nml_doc=None):
 
             input_params = copy.deepcopy(i.parameters) if i.parameters else {}
             for ip in input_params:
-                input_params[ip] = evaluate(input_params[ip], nl_model.parameters)
+                input_params[ip] = parameter_table.evaluate(input_params[ip])
             temp_input = eval("pyNN.neuroml.%s(**input_params)" % (i.pynn_input))
             # print('%s'%(['%s->%s'%(p.id,p.amplitude) for p in nml_doc.pulse_generators]))
             pg_id = temp_input.add_to_nml_doc(nml_doc, None)
@@ -576,30 +1426,49 @@ def generate_neuroml2_from_network(
     target_dir=None,
     validate=False,
     simulation=None,
+    legacy_generation=False,
+    num_workers=1,
+    cache_dir=None,
+    profiler=None,
+    neuroml_handler=None,
 ):
     """
     Generate and save NeuroML2 file (in either XML or HDF5 format) from the
-    NeuroMLlite description
+    NeuroMLlite description. If neuroml_handler is given, it's a NetworkBuilder
+    which the network has already been generated in (e.g. along with other
+    handlers in a CompositeHandler), so the network isn't generated again
     """
 
     print_v(
         "Generating NeuroML2 for %s%s..."
         % (
             nl_model.id,
-            " (base dir: %s; target dir: %s)" % (base_dir, target_dir)
-            if base_dir or target_dir
-            else "",
+            (
+                " (base dir: %s; target dir: %s)" % (base_dir, target_dir)
+                if base_dir or target_dir
+                else ""
+            ),
         )
     )
 
     import neuroml
     from neuroml.hdf5.NetworkBuilder import NetworkBuilder
 
-    neuroml_handler = NetworkBuilder()
-
-    generate_network(nl_model, neuroml_handler, base_dir=base_dir)
+    if neuroml_handler is None:
+        neuroml_handler = NetworkBuilder()
+
+        generate_network(
+            nl_model,
+            neuroml_handler,
+            base_dir=base_dir,
+            legacy_generation=legacy_generation,
+            num_workers=num_workers,
+            cache_dir=cache_dir,
+            profiler=profiler,
+        )
 
     nml_doc = neuroml_handler.get_nml_doc()
+    parameter_table = get_parameter_table(nl_model)
 
     extra_lems_components = lems.Model()
     extra_lems_file = "%s__lems.xml" % nl_model.id
@@ -631,7 +1500,7 @@ def generate_neuroml2_from_network(
                     if i.parameters is not None and len(i.parameters) > 0:
                         for p in i.parameters:
                             comp.set_parameter(
-                                p, evaluate(i.parameters[p], nl_model.parameters)
+                                p, parameter_table.evaluate(i.parameters[p])
                             )
                     extra_lems_components.add(comp)
 
@@ -682,7 +1551,7 @@ def generate_neuroml2_from_network(
                 for p in input_params:
                     exec(
                         'input.%s = "%s"'
-                        % (p, evaluate(input_params[p], nl_model.parameters))
+                        % (p, parameter_table.evaluate(input_params[p]))
                     )
 
     for c in nl_model.cells:
@@ -722,7 +1591,7 @@ def generate_neuroml2_from_network(
                     if c.parameters is not None and len(c.parameters) > 0:
                         for p in c.parameters:
                             comp.set_parameter(
-                                p, evaluate(c.parameters[p], nl_model.parameters)
+                                p, parameter_table.evaluate(c.parameters[p])
                             )
                     extra_lems_components.add(comp)
 
@@ -772,10 +1641,7 @@ def generate_neuroml2_from_network(
                 )
 
             for p in cell_params:
-                exec(
-                    'cell.%s = "%s"'
-                    % (p, evaluate(cell_params[p], nl_model.parameters))
-                )
+                exec('cell.%s = "%s"' % (p, parameter_table.evaluate(cell_params[p])))
 
     for s in nl_model.synapses:
         if nml_doc.get_by_id(s.id) == None:
@@ -801,7 +1667,7 @@ def generate_neuroml2_from_network(
                         if s.parameters is not None and len(s.parameters) > 0:
                             for p in s.parameters:
                                 comp.set_parameter(
-                                    p, evaluate(s.parameters[p], nl_model.parameters)
+                                    p, parameter_table.evaluate(s.parameters[p])
                                 )
                         extra_lems_components.add(comp)
 
@@ -967,13 +1833,30 @@ def generate_and_run(
     base_dir=None,
     target_dir=None,
     num_processors=1,
+    legacy_generation=False,
+    num_workers=1,
+    cache_dir=None,
+    profile=False,
 ):
     """
-    Generates the network in the specified simulator and runs, if appropriate
+    Generates the network in the specified simulator and runs, if appropriate.
+    With profile=True, a GenerationProfiler report for the generation of the
+    network is saved as <simulation id>.generation_profile.json in target_dir
+    (or the current directory)
     """
 
     if network == None:
         network = load_network(simulation.network)
+    parameter_table = get_parameter_table(network)
+
+    profiler = None
+    if profile:
+        profiler = GenerationProfiler(
+            report_file=os.path.join(
+                target_dir if target_dir else ".",
+                "%s.generation_profile.json" % simulation.id,
+            )
+        )
 
     print_v(
         "Generating network %s and running in simulator: %s..."
@@ -994,7 +1877,16 @@ def generate_and_run(
                     src_dir = os.path.dirname(os.path.abspath(c.neuroml2_source_file))
                     nrn_handler.executeHoc('load_file("%s/%s.hoc")' % (src_dir, c.id))
 
-            generate_network(network, nrn_handler, generate_network, base_dir)
+            generate_network(
+                network,
+                nrn_handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
+            )
             if return_results:
                 raise NotImplementedError(
                     "Reloading results not supported in Neuron yet..."
@@ -1006,7 +1898,14 @@ def generate_and_run(
 
             mdf_handler = MDFHandler(nl_network=network)
 
-            generate_network(network, mdf_handler)
+            generate_network(
+                network,
+                mdf_handler,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
+            )
 
         elif simulator.lower() == "psyneulink":
 
@@ -1014,7 +1913,14 @@ def generate_and_run(
 
             pnl_handler = PsyNeuLinkHandler(nl_network=network)
 
-            generate_network(network, pnl_handler)
+            generate_network(
+                network,
+                pnl_handler,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
+            )
             from neuromllite import __version__ as nmlliteversion
 
             run_pnl_script = """# Generated by NeuroMLlite v{1}
@@ -1107,7 +2013,14 @@ plt.show()
             sonata_handler = SonataHandler()
 
             generate_network(
-                network, sonata_handler, always_include_props=True, base_dir=base_dir
+                network,
+                sonata_handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             import pyNN.neuroml
@@ -1118,9 +2031,7 @@ plt.show()
                     cell_params = {}
                     if c.parameters:
                         for p in c.parameters:
-                            cell_params[p] = evaluate(
-                                c.parameters[p], network.parameters
-                            )
+                            cell_params[p] = parameter_table.evaluate(c.parameters[p])
 
                     temp_cell = eval("pyNN.neuroml.%s(**cell_params)" % c.pynn_cell)
 
@@ -1261,49 +2172,38 @@ plt.show()
 
         elif simulator.lower().startswith("graph"):  # Will not "run" obviously...
 
-            from neuromllite.GraphVizHandler import GraphVizHandler, engines
-
-            try:
-                if simulator[-1].isalpha():
-
-                    engine = engines[simulator[-1]]
-                    level = int(simulator[5:-1])
-                else:
-                    engine = "dot"
-                    level = int(simulator[5:])
-
-            except Exception as e:
-                print_v("Error parsing: %s: %s" % (simulator, e))
-                print_v(
-                    "Graphs of the network structure can be generated at many levels of detail (1-6, required) and laid out using GraphViz engines (d - dot (default); c - circo; n - neato; f - fdp), so use: -graph3c, -graph2, -graph4f etc."
-                )
+            handler = _get_graph_handler(simulator, network)
+            if handler is None:
                 return
 
-            handler = GraphVizHandler(level, engine=engine, nl_network=network)
-
             generate_network(
-                network, handler, always_include_props=True, base_dir=base_dir
+                network,
+                handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             print_v("Done with GraphViz...")
 
         elif simulator.lower().startswith("matrix"):  # Will not "run" obviously...
 
-            from neuromllite.MatrixHandler import MatrixHandler
-
-            try:
-                level = int(simulator[6:])
-            except:
-                print_v("Error parsing: %s" % simulator)
-                print_v(
-                    "Matrices of the network structure can be generated at many levels of detail (1-n, required), so use: -matrix1, -matrix2, etc."
-                )
+            handler = _get_matrix_handler(simulator, network)
+            if handler is None:
                 return
 
-            handler = MatrixHandler(level, nl_network=network)
-
             generate_network(
-                network, handler, always_include_props=True, base_dir=base_dir
+                network,
+                handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             print_v("Done with MatrixHandler...")
@@ -1312,15 +2212,26 @@ plt.show()
 
             from neuromllite.BindsNETHandler import BindsNETHandler
             import bindsnet
+            import torch
 
             print("\n   ********************************************************")
             print("   *** Warning: Support for BindsNET is very preliminary!! ***")
             print("   ********************************************************\n")
 
-            bindsnet_handler = BindsNETHandler(network)
+            batch_size = simulation.batch_size if simulation.batch_size else 1
+            bindsnet_handler = BindsNETHandler(
+                network, batch_size=batch_size, dt=simulation.dt
+            )
 
             generate_network(
-                network, bindsnet_handler, always_include_props=True, base_dir=base_dir
+                network,
+                bindsnet_handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             monitors_v = {}
@@ -1351,21 +2262,32 @@ plt.show()
             ]
             traces["t"] = times
 
-            bindsnet_handler.bn_network.run(inputs={}, time=simulation.duration)
+            # The inputs to each population, per time step and trial
+            pop_sizes = {
+                pop: len(bindsnet_handler.pop_indices_vs_gids[pop])
+                for pop in bindsnet_handler.pops_vs_components
+            }
+            batch_inputs = _get_batch_inputs(
+                network,
+                pop_sizes,
+                bindsnet_handler.get_input_cells(),
+                int(simulation.duration / simulation.dt),
+                simulation.dt,
+                batch_size,
+            )
+            inputs = {pop: torch.from_numpy(batch_inputs[pop]) for pop in batch_inputs}
+
+            bindsnet_handler.bn_network.run(inputs=inputs, time=simulation.duration)
 
             for pop in monitors_v:
                 vs = monitors_v[pop].get("v").numpy()
-                print("Shape of voltage results for %s: %s" % (pop, vs.shape))
-                v = vs
-                print(v)
-                traces["%s/0" % pop] = v
+                print_v("Shape of voltage results for %s: %s" % (pop, vs.shape))
+                _add_batch_traces(traces, pop, vs, batch_size)
 
             for pop in monitors_s:
                 ss = monitors_s[pop].get("s").numpy()
-                print("Shape of spike results for %s: %s" % (pop, ss.shape))
-                s = ss
-                print(s)
-                # traces['%s/0'%pop]= ss
+                print_v("Shape of spike results for %s: %s" % (pop, ss.shape))
+                _add_batch_events(events, pop, ss, simulation.dt, batch_size)
 
             print_v("Finished BindsNET simulation")
             _print_result_info(traces, events)
@@ -1385,7 +2307,14 @@ plt.show()
             arbor_handler = ArborHandler(network)
 
             generate_network(
-                network, arbor_handler, always_include_props=True, base_dir=base_dir
+                network,
+                arbor_handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             arbor_recipe = arbor_handler.neuroML_arbor_recipe
@@ -1419,86 +2348,78 @@ plt.show()
                 % (ncells, simulation.duration, simulation.dt)
             )
 
-            # arbor_model.run(tfinal=simulation.duration)
-
-            # (12) Create a default execution context, domain decomposition and simulation
-            context = arbor.context()
-            decomp = arbor.partition_load_balance(arbor_recipe, context)
+            # (12) Create an execution context with the threads to use, and a
+            # domain decomposition with a group of cells for each thread. All
+            # the cells of the recipe are cable cells (see create_arbor_cell),
+            # so the hint for these covers all of them
+            num_threads = simulation.num_threads if simulation.num_threads else 1
+            context = arbor.context(threads=num_threads)
+            hints = {}
+            group_size = _get_cpu_group_size(ncells, num_threads)
+            if group_size is not None:
+                hints[arbor.cell_kind.cable] = arbor.partition_hint(
+                    cpu_group_size=group_size
+                )
+            decomp = arbor.partition_load_balance(arbor_recipe, context, hints)
+            print_v("Running on %s with: %s" % (context, decomp))
             sim = arbor.simulation(arbor_recipe, decomp, context)
 
             # (13) Set spike generators to record
             sim.record(arbor.spike_recording.all)
 
-            # (14) Attach a sampler to the voltage probe on cell 0.
-            handles = [
-                sim.sample((gid, 0), arbor.regular_schedule(simulation.dt))
-                for gid in range(ncells)
-            ]
-            print_v("handles: %s, %s" % (handles, range(ncells)))
+            # (14) Attach samplers to the voltage probes of the cells recorded
+            trace_gids = _get_recorded_gids(
+                trace_pop_indices_seg_ids, arbor_recipe.pop_gids
+            )
+            handles = {}
+            for gid in trace_gids.values():
+                handles[gid] = sim.sample(
+                    (gid, 0), arbor.regular_schedule(simulation.dt)
+                )
+
             # (15) Run simulation
             sim.run(simulation.duration)
 
             print_v("Finished Arbor simulation")
-            # arbor_handler.sim.end()
 
             traces = {}
             events = {}
 
-            for pop_id in trace_pop_indices_seg_ids:
-                indices = trace_pop_indices_seg_ids[pop_id].keys()
-                for index in indices:
-
-                    filename = "%s.%s.%s.v.dat" % (simulation.id, pop_id, index)
-                    # all_columns = []
-                    gid = arbor_recipe.get_gid(pop_id, index)
-
-                    samples, meta = sim.samples(handles[gid])[0]
+            for (pop_id, index), gid in trace_gids.items():
 
-                    data = samples[:, 1]
-                    times = samples[:, 0]
+                filename = "%s.%s.%s.v.dat" % (simulation.id, pop_id, index)
 
-                    print_v(
-                        "Writing data for %s[%s] (gid: %s) to %s: (%s) %s"
-                        % (pop_id, index, gid, filename, meta, data)
-                    )
+                # The times and values of all the samples, in one array
+                samples, meta = sim.samples(handles[gid])[0]
 
-                    f = open(filename, "w")
-                    for ti in range(len(times)):
-                        f.write("%s\t%s\n" % (times[ti], data[ti]))
-
-                    ref = "%s[%i]" % (pop_id, index)
+                print_v(
+                    "Writing %i samples for %s[%s] (gid: %s) to %s: (%s)"
+                    % (len(samples), pop_id, index, gid, filename, meta)
+                )
+                np.savetxt(filename, samples[:, :2], fmt="%s", delimiter="\t")
+                _add_sample_trace(traces, "%s[%i]" % (pop_id, index), samples)
 
-                    vm_si = [d / 1000.0 for d in data]
-                    traces[ref] = vm_si
-                    t_si = [t / 1000.0 for t in times]
-                    traces["t"] = t_si
+            spikes = sim.spikes()
+            spike_gids = np.asarray(spikes["source"]["gid"], dtype=int)
+            spike_times = np.asarray(spikes["time"]) / 1000.0
 
             for pop_id in spike_pop_indices:
-                indices = spike_pop_indices[pop_id]
+                indices = np.array(sorted(spike_pop_indices[pop_id]), dtype=int)
 
                 filename = "%s.%s.spikes" % (simulation.id, pop_id)
-                all_columns = []
                 print_v(
                     "Writing spike data for %s %s to %s" % (pop_id, indices, filename)
                 )
-                """
-                arbor_pop = arbor_handler.populations[pop_id]
-                data =  arbor_pop.get_data('spikes', gather=False)
-                spiketrains = data.segments[0].spiketrains
-
-                ff = open(filename, 'w')
-
-                for spiketrain in spiketrains:
-                    source_id = spiketrain.annotations['source_id']
-                    source_index = spiketrain.annotations['source_index']
-                    if source_index in indices:
-                        #print_v("Writing spike data for cell %s[%s] (gid: %i): %i spikes "%(arbor_pop.label,source_index, source_id, len(spiketrain)), self.verbose)
-                        ref = '%s/%i/???'%(arbor_pop.label,source_index)
-                        events[ref] = [t.magnitude/1000. for t in spiketrain]
-                        for t in spiketrain:
-                            #ff.write('%s\t%i\n'%(t.magnitude/1000.,source_index))
-                            ff.write('%i\t%s\n'%(source_index,t.magnitude/1000.))
-                ff.close()"""
+                _add_spike_events(
+                    events,
+                    filename,
+                    pop_id,
+                    indices,
+                    spike_gids,
+                    spike_times,
+                    arbor_recipe.pop_gids[pop_id][indices],
+                    arbor_recipe.gid_cell_indices,
+                )
 
             if return_results:
                 _print_result_info(traces, events)
@@ -1513,11 +2434,12 @@ plt.show()
 
             pynn_handler = PyNNHandler(simulator_name, simulation.dt, network.id)
 
+            compiled_network = CompiledNetwork(network)
             syn_cell_params = {}
-            for proj in network.projections:
+            for proj in compiled_network.projections:
 
-                synapse = network.get_child(proj.synapse, "synapses")
-                post_pop = network.get_child(proj.postsynaptic, "populations")
+                synapse = compiled_network.get_synapse(proj.synapse)
+                post_pop = compiled_network.get_population(proj.postsynaptic)
 
                 if not post_pop.component in syn_cell_params:
                     syn_cell_params[post_pop.component] = {}
@@ -1527,9 +2449,9 @@ plt.show()
                         post = "_E"
                     elif synapse.pynn_receptor_type == "inhibitory":
                         post = "_I"
-                    syn_cell_params[post_pop.component]["%s%s" % (p, post)] = evaluate(
-                        synapse.parameters[p], network.parameters
-                    )
+                    syn_cell_params[post_pop.component][
+                        "%s%s" % (p, post)
+                    ] = parameter_table.evaluate(synapse.parameters[p])
 
             cells = {}
             for c in network.cells:
@@ -1537,9 +2459,7 @@ plt.show()
                     cell_params = {}
                     if c.parameters:
                         for p in c.parameters:
-                            cell_params[p] = evaluate(
-                                c.parameters[p], network.parameters
-                            )
+                            cell_params[p] = parameter_table.evaluate(c.parameters[p])
 
                     dont_set_here = ["tau_syn_E", "e_rev_E", "tau_syn_I", "e_rev_I"]
                     for d in dont_set_here:
@@ -1579,7 +2499,14 @@ plt.show()
                     pynn_handler.add_input_source(input_source, network)
 
             generate_network(
-                network, pynn_handler, always_include_props=True, base_dir=base_dir
+                network,
+                pynn_handler,
+                always_include_props=True,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
 
             trace_pop_indices_seg_ids = get_pops_vs_cell_indices_seg_ids(
@@ -1589,30 +2516,25 @@ plt.show()
                 simulation.recordSpikes, network
             )
 
+            # Record from a PopulationView of the cells in each population
             for pop_id in pynn_handler.populations:
                 pynn_pop = pynn_handler.populations[pop_id]
                 if pynn_pop.label in trace_pop_indices_seg_ids:
                     if pynn_pop.can_record("v"):
-                        indices = trace_pop_indices_seg_ids[pop_id].keys()
+                        indices = sorted(trace_pop_indices_seg_ids[pop_id].keys())
                         print_v("Recording v in %s in cells %s" % (indices, pop_id))
-                        for index in indices:
-                            pynn_handler.sim.record(
-                                "v",
-                                pynn_pop[index],
-                                "PP_%s_%s_%s.pkl" % (pop_id, index, "v"),
-                            )
+                        pynn_pop[indices].record(
+                            "v", to_file="PP_%s_%s.pkl" % (pop_id, "v")
+                        )
                 if pynn_pop.label in spike_pop_indices:
                     if pynn_pop.can_record("spikes"):
-                        indices = spike_pop_indices[pop_id].keys()
+                        indices = sorted(spike_pop_indices[pop_id].keys())
                         print_v(
                             "Recording spikes in %s in cells %s" % (indices, pop_id)
                         )
-                        for index in indices:
-                            pynn_handler.sim.record(
-                                "spikes",
-                                pynn_pop[index],
-                                "PP_%s_%s.pkl" % (pop_id, "spike"),
-                            )
+                        pynn_pop[indices].record(
+                            "spikes", to_file="PP_%s_%s.pkl" % (pop_id, "spike")
+                        )
 
             print_v(
                 "Starting PyNN simulation of duration %sms (dt: %sms)"
@@ -1629,10 +2551,9 @@ plt.show()
 
                 for pop_id in trace_pop_indices_seg_ids:
                     pynn_pop = pynn_handler.populations[pop_id]
-                    indices = trace_pop_indices_seg_ids[pop_id].keys()
+                    indices = list(trace_pop_indices_seg_ids[pop_id].keys())
 
                     filename = "%s.%s.v.dat" % (simulation.id, pop_id)
-                    all_columns = []
 
                     print_v(
                         "Writing data for %s %s to %s" % (pop_id, indices, filename)
@@ -1640,66 +2561,49 @@ plt.show()
 
                     data = pynn_pop.get_data("v", gather=False)
                     analogsignal = data.segments[0].analogsignals[0]
-
-                    source_ids = analogsignal.annotations["source_ids"]
-                    analogsignal_index = {}
-                    for sii, glob_id in enumerate(source_ids):
-                        index_in_pop = pynn_pop.id_to_index(glob_id)
-                        # print('Index %i in analogsignal is pynn global id %i, pop index %i'%(sii,glob_id,index_in_pop))
-                        analogsignal_index[index_in_pop] = sii
-
-                    for index in indices:
-                        ref = "%s[%i]" % (pop_id, index)
-                        ref = "%s/%i/???/v" % (pop_id, index)
-                        traces[ref] = []
-                        vm = analogsignal.transpose()[analogsignal_index[index]]
-
-                        if len(all_columns) == 0:
-                            tt = np.array(
-                                [t * simulation.dt / 1000.0 for t in range(len(vm))]
-                            )
-                            all_columns.append(tt)
-                        vm_si = np.array(vm / 1000.0)
-
-                        traces[ref] = vm_si
-                        if not "t" in traces:
-                            traces["t"] = tt
-
-                        all_columns.append(vm_si)
-
-                        times_vm = np.array(all_columns).transpose()
-
-                    np.savetxt(filename, times_vm, delimiter="\t", fmt="%s")
+                    _add_signal_traces(
+                        traces,
+                        filename,
+                        pop_id,
+                        indices,
+                        analogsignal.magnitude,
+                        analogsignal.annotations["source_ids"],
+                        pynn_pop.first_id,
+                        simulation.dt,
+                    )
 
                 for pop_id in spike_pop_indices:
                     pynn_pop = pynn_handler.populations[pop_id]
-                    indices = spike_pop_indices[pop_id]
+                    indices = np.array(sorted(spike_pop_indices[pop_id]), dtype=int)
 
                     filename = "%s.%s.spikes" % (simulation.id, pop_id)
-                    all_columns = []
                     print_v(
                         "Writing spike data for %s %s to %s"
                         % (pop_id, indices, filename)
                     )
 
+                    # The index of the cell and time of each spike, in one
+                    # array each for all the spike trains
                     data = pynn_pop.get_data("spikes", gather=False)
                     spiketrains = data.segments[0].spiketrains
-
-                    ff = open(filename, "w")
-
-                    for spiketrain in spiketrains:
-                        source_id = spiketrain.annotations["source_id"]
-                        source_index = spiketrain.annotations["source_index"]
-                        if source_index in indices:
-                            # print_v("Writing spike data for cell %s[%s] (gid: %i): %i spikes "%(pynn_pop.label,source_index, source_id, len(spiketrain)), self.verbose)
-                            ref = "%s/%i/???" % (pynn_pop.label, source_index)
-                            events[ref] = [t.magnitude / 1000.0 for t in spiketrain]
-                            for t in spiketrain:
-                                # ff.write('%s\t%i\n'%(t.magnitude/1000.,source_index))
-                                ff.write(
-                                    "%i\t%s\n" % (source_index, t.magnitude / 1000.0)
-                                )
-                    ff.close()
+                    spike_indices = np.repeat(
+                        [st.annotations["source_index"] for st in spiketrains],
+                        [len(st) for st in spiketrains],
+                    ).astype(int)
+                    spike_times = (
+                        np.concatenate([st.magnitude for st in spiketrains] + [[]])
+                        / 1000.0
+                    )
+                    _add_spike_events(
+                        events,
+                        filename,
+                        pop_id,
+                        indices,
+                        spike_indices,
+                        spike_times,
+                        indices,
+                        np.arange(pynn_pop.size),
+                    )
 
             if return_results:
                 _print_result_info(traces, events)
@@ -1728,7 +2632,15 @@ plt.show()
                 netParams, simConfig=simConfig, verbose=True
             )
 
-            generate_network(network, netpyne_handler, base_dir=base_dir)
+            generate_network(
+                network,
+                netpyne_handler,
+                base_dir=base_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
+            )
 
             netpyne_handler.finalise()
 
@@ -1946,7 +2858,14 @@ plt.show()
             lems_file_name = "LEMS_%s.xml" % simulation.id
 
             nml_file_name, nml_doc = generate_neuroml2_from_network(
-                network, simulation=simulation, base_dir=base_dir, target_dir=target_dir
+                network,
+                simulation=simulation,
+                base_dir=base_dir,
+                target_dir=target_dir,
+                legacy_generation=legacy_generation,
+                num_workers=num_workers,
+                cache_dir=cache_dir,
+                profiler=profiler,
             )
             included_files = ["PyNN.xml"]
             """ Needed?
@@ -2048,7 +2967,7 @@ plt.show()
                     for var in simulation.recordVariables:
                         to_rec = simulation.recordVariables[var]
                         if "all" in to_rec or p.id in to_rec:
-                            size = evaluate(p.size, network.parameters)
+                            size = parameter_table.evaluate(p.size)
                             for i in range(size):
                                 quantity = "%s/%i/%s/%s" % (p.id, i, p.component, var)
                                 if not p.has_positions():
@@ -2086,9 +3005,9 @@ plt.show()
                 copy_neuroml=True,
                 lems_file_generate_seed=12345,
                 report_file_name="report.%s.txt" % simulation.id,
-                simulation_seed=simulation.seed
-                if simulation.seed
-                else DEFAULT_SIMULATION_SEED,
+                simulation_seed=(
+                    simulation.seed if simulation.seed else DEFAULT_SIMULATION_SEED
+                ),
                 verbose=True,
             )
 
@@ -2160,6 +3079,269 @@ def _print_info(l):
     )
 
 
+def _get_gid_arrays(pop_indices_vs_gids, num_cells):
+    """
+    Arrays for looking up the num_cells gids of a simulation (e.g. in Arbor)
+    with pop_indices_vs_gids giving the gid of each cell of each population:
+    the ids of the populations, the index in these of the population of each
+    gid and the index of the cell in it, and for each population an array of
+    the gids of its cells
+    """
+    pop_ids = list(pop_indices_vs_gids.keys())
+    gid_pop_indices = np.zeros(num_cells, dtype=int)
+    gid_cell_indices = np.zeros(num_cells, dtype=int)
+    pop_gids = {}
+    for i, pop_id in enumerate(pop_ids):
+        indices_vs_gids = pop_indices_vs_gids[pop_id]
+        indices = np.fromiter(indices_vs_gids.keys(), dtype=int)
+        gids = np.fromiter(indices_vs_gids.values(), dtype=int)
+        gid_pop_indices[gids] = i
+        gid_cell_indices[gids] = indices
+        pop_gids[pop_id] = np.zeros(indices.max() + 1 if len(indices) else 0, dtype=int)
+        pop_gids[pop_id][indices] = gids
+    return pop_ids, gid_pop_indices, gid_cell_indices, pop_gids
+
+
+def _get_incoming_connections(
+    network, proj_pops, proj_connections, pop_gids, num_cells
+):
+    """
+    The connections (with positive weights) onto each of the num_cells gids,
+    from proj_connections (the arrays of pre cell indices, post cell indices,
+    weights and delays of each projection between the populations in
+    proj_pops), in compressed sparse column (CSC) form: those onto gid are at
+    indptr[gid]:indptr[gid + 1] in the arrays of source gids, weights and
+    delays, in the order of the projections in the network
+    """
+    sources, targets, weights, delays = [], [], [], []
+    for proj in network.projections:
+        if proj.id in proj_connections:
+            pre_pop, post_pop = proj_pops[proj.id]
+            pre, post, w, d = proj_connections[proj.id]
+            positive = w > 0
+            sources.append(pop_gids[pre_pop][pre[positive].astype(int)])
+            targets.append(pop_gids[post_pop][post[positive].astype(int)])
+            weights.append(w[positive])
+            delays.append(d[positive])
+
+    if sources:
+        sources, targets, weights, delays = [
+            np.concatenate(a) for a in (sources, targets, weights, delays)
+        ]
+    else:
+        sources = targets = np.zeros(0, dtype=int)
+        weights = delays = np.zeros(0)
+
+    order = np.argsort(targets, kind="stable")
+    indptr = np.searchsorted(targets[order], np.arange(num_cells + 1))
+    return indptr, sources[order], weights[order], delays[order]
+
+
+def _get_cpu_group_size(num_cells, num_threads):
+    """
+    The number of cells in each group of the domain decomposition of a
+    simulation (e.g. in Arbor) of num_cells cells, so there is a group for
+    each of the num_threads threads, or None with 1 thread (when the default
+    decomposition is used)
+    """
+    if num_threads <= 1:
+        return None
+    return max(1, -(-num_cells // num_threads))
+
+
+def _get_recorded_gids(pop_indices, pop_gids):
+    """
+    The gids of the recorded cells, with pop_indices giving the indices of
+    those recorded in each population (see get_pops_vs_cell_indices_seg_ids)
+    and pop_gids the gids of the cells of each population (see
+    _get_gid_arrays), as a dict of (population id, index) vs gid
+    """
+    recorded = {}
+    for pop_id in pop_indices:
+        indices = np.array(sorted(pop_indices[pop_id]), dtype=int)
+        for index, gid in zip(indices.tolist(), pop_gids[pop_id][indices].tolist()):
+            recorded[(pop_id, index)] = gid
+    return recorded
+
+
+def _add_sample_trace(traces, ref, samples):
+    """
+    Add the voltage trace of ref, from samples, an array of the times (ms)
+    and values (mV) sampled in each row (as recorded in Arbor), and the times
+    to traces, in seconds and volts
+    """
+    traces[ref] = (samples[:, 1] / 1000.0).tolist()
+    traces["t"] = (samples[:, 0] / 1000.0).tolist()
+
+
+def _split_spikes(spike_gids, spike_times, gids, gid_cell_indices):
+    """
+    The spikes of the cells with gids (e.g. the recorded cells of one
+    population), from all those emitted by spike_gids at spike_times: the
+    index of the cell (see _get_gid_arrays) and time of each of these, in the
+    order given, and a list of the spike times of each cell in gids
+    """
+    spike_gids = np.asarray(spike_gids, dtype=int)
+    spike_times = np.asarray(spike_times)
+    gids = np.asarray(gids, dtype=int)
+
+    # The position in gids of the cell emitting each spike, or -1
+    positions = np.full(len(gid_cell_indices), -1)
+    positions[gids] = np.arange(len(gids))
+    keys = positions[spike_gids]
+    recorded = keys >= 0
+    keys = keys[recorded]
+    cell_indices = gid_cell_indices[spike_gids[recorded]]
+    times = spike_times[recorded]
+
+    order = np.argsort(keys, kind="stable")
+    counts = np.bincount(keys, minlength=len(gids))
+    cell_times = np.split(times[order], np.cumsum(counts)[:-1])
+    return cell_indices, times, cell_times
+
+
+def _add_spike_events(
+    events, filename, pop_id, indices, spike_gids, spike_times, gids, gid_cell_indices
+):
+    """
+    Add the spike times of the cells of pop_id with indices (and gids, see
+    _split_spikes) to events, and save them to filename, with a row for
+    each spike giving the index of the cell and the time
+    """
+    cell_indices, times, cell_times = _split_spikes(
+        spike_gids, spike_times, gids, gid_cell_indices
+    )
+    np.savetxt(
+        filename,
+        np.column_stack((cell_indices, times)),
+        fmt=["%i", "%s"],
+        delimiter="\t",
+    )
+    for index, index_times in zip(np.asarray(indices).tolist(), cell_times):
+        events["%s/%i/???" % (pop_id, index)] = index_times.tolist()
+
+
+def _add_signal_traces(
+    traces, filename, pop_id, indices, signal, source_ids, first_id, dt
+):
+    """
+    Add the voltage traces of the cells of pop_id with indices to traces,
+    from signal, the values (mV) every dt ms of the cells with source_ids (as
+    recorded in PyNN, where the ids of the cells of a population are
+    consecutive from first_id), in seconds and volts, and save them to
+    filename, with a column for the times followed by one for each cell
+    """
+    # The column of the signal for each cell index
+    signal_indices = np.asarray(source_ids).astype(int) - int(first_id)
+    order = np.argsort(signal_indices)
+    columns = order[np.searchsorted(signal_indices[order], indices)]
+
+    vm_si = np.asarray(signal)[:, columns] / 1000.0
+    tt = np.arange(len(vm_si)) * dt / 1000.0
+
+    if not "t" in traces:
+        traces["t"] = tt
+    for i, index in enumerate(indices):
+        traces["%s/%i/???/v" % (pop_id, index)] = vm_si[:, i]
+
+    np.savetxt(filename, np.column_stack((tt, vm_si)), delimiter="\t", fmt="%s")
+
+
+def _get_batch_inputs(network, pop_sizes, input_cells, num_steps, dt, batch_size):
+    """
+    The inputs to the populations (with sizes pop_sizes) in each trial of a
+    batched BindsNET simulation of num_steps steps of dt ms, as arrays of
+    shape (time, trial, cell):
+
+        - Populations of SpikeSourcePoisson cells get spikes drawn
+          independently for each trial, at the cell's rate (Hz) from start
+          for duration (ms), so the trials differ.
+        - Inputs from DCSource input sources add their amplitude (times the
+          weight of each input) between start and stop (ms) in every trial.
+          input_cells gives the cell ids and weights of each input.
+
+    Other cells and input sources aren't supported and are ignored
+    """
+    table = get_parameter_table(network)
+    _, seed = _get_rng_for_network(network)
+    times = np.arange(num_steps) * dt
+    inputs = {}
+
+    def get_parameters(element, defaults):
+        parameters = dict(defaults)
+        if element.parameters:
+            for name in element.parameters:
+                parameters[name] = table.evaluate(element.parameters[name])
+        return parameters
+
+    for p in network.populations:
+        cell = network.get_child(p.component, "cells")
+        if cell is None or cell.pynn_cell != "SpikeSourcePoisson":
+            continue
+        params = get_parameters(cell, {"rate": 1.0, "start": 0, "duration": 1e10})
+        active = (times >= params["start"]) & (
+            times < params["start"] + params["duration"]
+        )
+        rng = _get_rng_for_element(seed, "trials", p.id)
+        draws = rng.random((num_steps, batch_size, pop_sizes[p.id]))
+        spikes = draws < params["rate"] * dt / 1000.0
+        inputs[p.id] = (spikes & active[:, None, None]).astype(np.float32)
+
+    for input in network.inputs:
+        source = network.get_child(input.input_source, "input_sources")
+        if source.pynn_input != "DCSource":
+            print_v(
+                "Input source %s (%s) is not supported in BindsNET"
+                % (source.id, source.pynn_input)
+            )
+            continue
+        params = get_parameters(source, {"amplitude": 1.0, "start": 0, "stop": 1e10})
+        active = (times >= params["start"]) & (times < params["stop"])
+        cell_ids, weights = input_cells[input.id]
+        current = np.zeros(pop_sizes[input.population])
+        np.add.at(current, cell_ids, params["amplitude"] * np.asarray(weights))
+
+        if not input.population in inputs:
+            inputs[input.population] = np.zeros(
+                (num_steps, batch_size, pop_sizes[input.population]), dtype=np.float32
+            )
+        inputs[input.population] += (active[:, None] * current)[:, None, :]
+
+    return inputs
+
+
+def _add_batch_traces(traces, pop, vs, batch_size):
+    """
+    Add the voltage traces of the cells of pop from vs, an array of shape
+    (time, trial, cell) as recorded in BindsNET, to traces. The traces of
+    trial i (if batch_size > 1) are stored with the prefix "trial<i>/"
+    """
+    for trial in range(vs.shape[1]):
+        prefix = "trial%i/" % trial if batch_size > 1 else ""
+        for index in range(vs.shape[2]):
+            ref = "%s%s[%i]" % (prefix, pop, index)
+            traces[ref] = vs[:, trial, index].tolist()
+
+
+def _add_batch_events(events, pop, ss, dt, batch_size):
+    """
+    Add the spike times (in seconds) of the cells of pop from ss, an array
+    of spikes with shape (time, trial, cell) recorded every dt ms in
+    BindsNET, to events, with the prefix "trial<i>/" as in _add_batch_traces
+    """
+    # Group the spike times by trial and cell, in order of time
+    steps, trials, indices = np.nonzero(ss)
+    keys = trials * ss.shape[2] + indices
+    order = np.argsort(keys, kind="stable")
+    counts = np.bincount(keys, minlength=ss.shape[1] * ss.shape[2])
+    cell_times = np.split(steps[order] * dt / 1000.0, np.cumsum(counts)[:-1])
+    for trial in range(ss.shape[1]):
+        prefix = "trial%i/" % trial if batch_size > 1 else ""
+        for index in range(ss.shape[2]):
+            ref = "%s%s/%i/???" % (prefix, pop, index)
+            events[ref] = cell_times[trial * ss.shape[2] + index].tolist()
+
+
 def _print_result_info(traces, events):
     """
     Print a summary of the returned (voltage) traces and spike times
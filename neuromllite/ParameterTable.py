@@ -0,0 +1,221 @@
+#
+#
+#   A table of the values of the parameters of a network, which can refer to
+#   each other (e.g. {"N": 100, "N_exc": "0.8 * N"}), evaluated once in order
+#   of their dependencies and only re-evaluated when a parameter they depend
+#   on changes
+#
+#
+
+from neuromllite.ExpressionCompiler import RANDOM_FUNCTIONS
+
+from modelspec.utils import evaluate
+
+import ast
+import copy
+import weakref
+
+
+def _get_names(value):
+    """
+    The names used in value, if it's an expression, and whether it calls
+    any of the functions which draw random numbers
+    """
+    if not isinstance(value, str):
+        return set(), False
+    try:
+        tree = ast.parse(value.strip(), mode="eval")
+    except SyntaxError:
+        return set(), False
+
+    names = set()
+    is_random = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            is_random = is_random or node.func.id in RANDOM_FUNCTIONS
+    return names, is_random
+
+
+def _same(a, b):
+    try:
+        return type(a) == type(b) and bool(a == b)
+    except Exception:  # e.g. numpy arrays
+        return False
+
+
+class ParameterTable:
+    """
+    The values of a dict of network parameters, where string values are
+    expressions which can use the other parameters. Each value is evaluated
+    once, after those it uses, and update() or set() only re-evaluates the
+    parameters which changed and those which depend on them.
+
+    Parameters which draw random numbers (e.g. "normal(1, 0.1)"), and those
+    which use them, are kept as expressions, to be evaluated for each use.
+    """
+
+    def __init__(self, parameters=None):
+        self.parameters = {}
+        self.values = {}
+        self.depends_on = {}
+        self.random = set()
+        self.order = []
+        self.num_evaluations = 0
+
+        self.update(parameters)
+
+    def _get_dependents(self, names):
+        """
+        The given parameters and all the parameters which depend on them
+        """
+        dependents = set(names)
+        to_check = list(names)
+        while to_check:
+            name = to_check.pop()
+            for other, used in self.depends_on.items():
+                if name in used and other not in dependents:
+                    dependents.add(other)
+                    to_check.append(other)
+        return dependents
+
+    def _sort(self):
+        """
+        Order the parameters so that each comes after those it uses
+        """
+        order = []
+        state = {}
+
+        def visit(name, path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise Exception(
+                    "Parameters refer to each other in a cycle: %s"
+                    % " -> ".join(path + [name])
+                )
+            state[name] = "visiting"
+            for used in sorted(self.depends_on[name]):
+                visit(used, path + [name])
+            state[name] = "done"
+            order.append(name)
+
+        for name in sorted(self.parameters):
+            visit(name, [])
+        self.order = order
+
+    def update(self, parameters):
+        """
+        Update the table to the given dict of parameters, re-evaluating only
+        those which are new or have changed and those which depend on them
+        """
+        parameters = parameters if parameters else {}
+
+        changed = set(
+            name
+            for name in parameters
+            if name not in self.parameters
+            or not _same(parameters[name], self.parameters[name])
+        )
+        removed = set(self.parameters) - set(parameters)
+        if not changed and not removed:
+            return
+
+        # Parameters which use a name which has been added or removed now
+        # depend on something else
+        affected = self._get_dependents(removed)
+        for name in set(parameters) - set(self.parameters):
+            for other, used in self.depends_on.items():
+                if name in self._get_names(other)[0]:
+                    affected.add(other)
+
+        for name in removed:
+            del self.parameters[name]
+            del self.values[name]
+            del self.depends_on[name]
+            self.random.discard(name)
+
+        for name in changed:
+            self.parameters[name] = copy.deepcopy(parameters[name])
+        for name in changed | (affected - removed):
+            names = self._get_names(name)[0]
+            self.depends_on[name] = set(
+                n for n in names if n in self.parameters and n != name
+            )
+
+        self._sort()
+        to_evaluate = self._get_dependents(changed | (affected - removed))
+        for name in self.order:
+            if name in to_evaluate:
+                self._evaluate_parameter(name)
+
+    def _get_names(self, name):
+        return _get_names(self.parameters[name])
+
+    def _evaluate_parameter(self, name):
+        value = self.parameters[name]
+        is_random = self._get_names(name)[1] or bool(
+            self.depends_on[name] & self.random
+        )
+        if is_random:
+            self.random.add(name)
+        else:
+            self.random.discard(name)
+            if isinstance(value, str):
+                self.num_evaluations += 1
+                value = evaluate(value, dict(self.values))
+        self.values[name] = value
+
+    def set(self, name, value, parameters=None):
+        """
+        Change the value of one parameter, re-evaluating those which use it.
+        The change is also made to parameters (e.g. the network's parameters
+        dict), if given
+        """
+        if parameters is not None:
+            parameters[name] = value
+        new_parameters = dict(self.parameters)
+        new_parameters[name] = value
+        self.update(new_parameters)
+
+    def get_values(self):
+        """
+        A copy of the dict of evaluated parameters, e.g. for an ExpressionCache
+        """
+        return dict(self.values)
+
+    def evaluate(self, expr, rng=None):
+        """
+        Evaluate an expression (e.g. a size or weight) using the evaluated
+        parameters. evaluate() adds names like rng to the dict it's given, so
+        it's passed a copy of the values
+        """
+        return evaluate(expr, dict(self.values), rng)
+
+
+# The table for each network, which is updated if the network's parameters
+# are changed
+_tables = {}
+
+
+def get_parameter_table(network):
+    """
+    Get the ParameterTable for the parameters of the network, reusing the
+    one from a previous call for the same network object, after updating it
+    for any of the network's parameters which have changed since then
+    """
+    key = id(network)
+    entry = _tables.get(key)
+    if entry is not None and entry[0]() is network:
+        table = entry[1]
+        table.update(network.parameters)
+        return table
+
+    def remove(ref, key=key):
+        if key in _tables and _tables[key][0] is ref:
+            del _tables[key]
+
+    table = ParameterTable(network.parameters)
+    _tables[key] = (weakref.ref(network, remove), table)
+    return table
@@ -6,6 +6,8 @@
 
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
 from neuromllite.utils import print_v
+from neuromllite.ParameterTable import get_parameter_table
+from neuromllite.CompiledNetwork import CompiledNetwork
 from neuromllite.utils import save_to_json_file
 from neuromllite.utils import locate_file
 from neuromllite.utils import evaluate
@@ -24,6 +26,7 @@ class PsyNeuLinkHandler(DefaultNetworkHandler):
     def __init__(self, nl_network):
         print_v("Initiating PsyNeuLink handler")
         self.nl_network = nl_network
+        self.compiled_network = CompiledNetwork(nl_network)
 
     def handle_document_start(self, id, notes):
 
@@ -97,7 +100,7 @@ class PsyNeuLinkHandler(DefaultNetworkHandler):
                 node["name"] = node_id
                 # node['type']['NeuroML'] = component
 
-                comp = self.nl_network.get_child(component, "cells")
+                comp = self.compiled_network.get_cell(component)
                 base_dir = "./"  # for now...
                 fname = locate_file(comp.lems_source_file, base_dir)
                 model = lems.Model()
@@ -147,9 +150,9 @@ class PsyNeuLinkHandler(DefaultNetworkHandler):
                     func_info["args"][p]["source"] = "%s.input_ports.%s" % (node_id, p)
 
                     if comp.parameters is not None and p in comp.parameters:
-                        func_info["args"][p]["value"] = evaluate(
-                            comp.parameters[p], self.nl_network.parameters
-                        )
+                        func_info["args"][p]["value"] = get_parameter_table(
+                            self.nl_network
+                        ).evaluate(comp.parameters[p])
                     else:
                         func_info["args"][p]["value"] = evaluate(
                             lems_comp.parameters[p]
@@ -5,13 +5,15 @@
 #
 
 from neuromllite.utils import print_v
-from neuromllite.utils import evaluate
+from neuromllite.ParameterTable import get_parameter_table
 from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
 
 from pyneuroml.pynml import convert_to_units
 
 from importlib import import_module
 
+import numpy as np
+
 
 class PyNNHandler(DefaultNetworkHandler):
 
@@ -20,6 +22,11 @@ class PyNNHandler(DefaultNetworkHandler):
     input_sources = {}
     input_info = {}
 
+    # Connections of each projection as arrays of pre cell indices, post
+    # cell indices, weights and delays; these are collected in chunks while
+    # the projection is being generated
+    proj_conn_chunks = {}
+
     def __init__(self, simulator, dt, reference):
         print_v("Initiating PyNN with simulator %s" % simulator)
         if simulator == "nest":
@@ -40,7 +47,7 @@ class PyNNHandler(DefaultNetworkHandler):
         input_params = input_source.parameters if input_source.parameters else {}
 
         for ip in input_params:
-            input_params[ip] = evaluate(input_params[ip], network.parameters)
+            input_params[ip] = get_parameter_table(network).evaluate(input_params[ip])
 
         """ This is a quick hack to support noisyCurrentSource before that type is integrated into the 
             core of NeuroML...
@@ -67,15 +74,12 @@ class PyNNHandler(DefaultNetworkHandler):
                         % (p, input_params[p], input_source.id)
                     )
 
-            exec(
-                'self.input_sources["%s"] = self.sim.NoisyCurrentSource(**pynn_input_params)'
-                % (input_source.id)
+            self.input_sources[input_source.id] = self.sim.NoisyCurrentSource(
+                **pynn_input_params
             )
         else:
-            exec(
-                'self.input_sources["%s"] = self.sim.%s(**input_params)'
-                % (input_source.id, input_source.pynn_input)
-            )
+            input_class = getattr(self.sim, input_source.pynn_input)
+            self.input_sources[input_source.id] = input_class(**input_params)
 
         # print(['%s (%s): %s'%(i, type(self.input_sources[i]),self.input_sources[i].simple_parameters()) for i in self.input_sources])
 
@@ -112,12 +116,9 @@ class PyNNHandler(DefaultNetworkHandler):
             + sizeInfo
         )
 
-        exec(
-            'self.POP_%s = self.sim.Population(%s, self.cells["%s"], label="%s")'
-            % (population_id, size, component, population_id)
+        self.populations[population_id] = self.sim.Population(
+            size, self.cells[component], label=population_id
         )
-        # exec('print_v(self.POP_%s)'%(population_id))
-        exec('self.populations["%s"] = self.POP_%s' % (population_id, population_id))
 
     #
     #  Should be overridden to create specific cell instance
@@ -125,9 +126,14 @@ class PyNNHandler(DefaultNetworkHandler):
     def handle_location(self, id, population_id, component, x, y, z):
         # self.printLocationInformation(id, population_id, component, x, y, z)
 
-        exec("self.POP_%s.positions[0][%s] = %s" % (population_id, id, x))
-        exec("self.POP_%s.positions[1][%s] = %s" % (population_id, id, y))
-        exec("self.POP_%s.positions[2][%s] = %s" % (population_id, id, z))
+        self.handle_locations(population_id, component, [(x, y, z)], start_id=id)
+
+    def handle_locations(self, population_id, component, positions, start_id=0):
+
+        positions = np.asarray(positions, dtype=float)
+        pynn_pop = self.populations[population_id]
+        # The positions of the population have shape (3, size)
+        pynn_pop.positions[:, start_id : start_id + len(positions)] = positions.T
 
     def handle_projection(
         self,
@@ -163,7 +169,7 @@ class PyNNHandler(DefaultNetworkHandler):
             + synInfo
         )
 
-        exec("self.projection__%s_conns = []" % (projName))
+        self.proj_conn_chunks[projName] = []
 
     #
     #  Should be overridden to handle network connection
@@ -188,9 +194,35 @@ class PyNNHandler(DefaultNetworkHandler):
         # self.print_connection_information(projName, id, prePop, postPop, synapseType, preCellId, postCellId, weight)
         # print_v("Src cell: %d, seg: %f, fract: %f -> Tgt cell %d, seg: %f, fract: %f; weight %s, delay: %s ms" % (preCellId,preSegId,preFract,postCellId,postSegId,postFract, weight, delay))
 
-        exec(
-            "self.projection__%s_conns.append((%s,%s,float(%s),float(%s)))"
-            % (projName, preCellId, postCellId, weight, delay)
+        self.proj_conn_chunks[projName].append(
+            ([preCellId], [postCellId], [weight], [delay])
+        )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+
+        num = len(preCellIds)
+        self.proj_conn_chunks[projName].append(
+            (
+                preCellIds,
+                postCellIds,
+                np.broadcast_to(weights, (num,)),
+                np.broadcast_to(delays, (num,)),
+            )
         )
 
     #
@@ -210,22 +242,32 @@ class PyNNHandler(DefaultNetworkHandler):
             + " completed"
         )
 
-        # exec('print(self.projection__%s_conns)'%projName)
-        exec(
-            'self.projection__%s_connector = self.sim.FromListConnector(self.projection__%s_conns, column_names=["weight", "delay"])'
-            % (projName, projName)
-        )
+        # One row (pre index, post index, weight, delay) for each connection
+        chunks = self.proj_conn_chunks.pop(projName)
+        conn_list = np.zeros((0, 4))
+        if chunks:
+            conn_list = np.column_stack(
+                [
+                    np.concatenate(
+                        [np.asarray(chunk[i], dtype=float) for chunk in chunks]
+                    )
+                    for i in range(4)
+                ]
+            )
 
-        exec(
-            'self.projections["%s"] = self.sim.Projection(self.populations["%s"],self.populations["%s"], '
-            % (projName, prePop, postPop)
-            + "connector=self.projection__%s_connector, " % projName
-            + "synapse_type=self.sim.StaticSynapse(weight=%s, delay=%s), " % (1, 5)
-            + 'receptor_type="%s", ' % (self.receptor_types[synapse])
-            + 'label="%s")' % projName
+        connector = self.sim.FromListConnector(
+            conn_list, column_names=["weight", "delay"]
+        )
+        self.projections[projName] = self.sim.Projection(
+            self.populations[prePop],
+            self.populations[postPop],
+            connector=connector,
+            synapse_type=self.sim.StaticSynapse(weight=1, delay=5),
+            receptor_type=self.receptor_types[synapse],
+            label=projName,
         )
 
-        # exec('print(self.projections["%s"].describe())'%projName)
+        # print(self.projections[projName].describe())
 
     #
     #  Should be overridden to create input source array
@@ -253,20 +295,20 @@ class PyNNHandler(DefaultNetworkHandler):
 
         # print_v("Input: %s[%s], cellId: %i, seg: %i, fract: %f, weight: %f" % (inputListId,id,cellId,segId,fract,weight))
 
-        population_id, component = self.input_info[inputListId]
+        self.handle_inputs(inputListId, id, [cellId])
 
-        # exec('print  self.POP_%s'%(population_id))
-        # exec('print  self.POP_%s[%s]'%(population_id,cellId))
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
 
-        exec(
-            "self.POP_%s[%s].inject(self.input_sources[component]) "
-            % (population_id, cellId)
-        )
-        # exec('self.input_sources[component].inject_into(self.populations["%s"])'%(population_id))
+        population_id, component = self.input_info[inputListId]
+        pynn_pop = self.populations[population_id]
 
-        # exec('pulse = self.sim.DCSource(amplitude=0.9, start=19, stop=89)')
-        # pulse.inject_into(pop_pre)
-        # exec('self.populations["pop0"][0].inject(pulse)')
+        # The source is injected into a PopulationView of the cells, once for
+        # each input on a cell, so cells with n inputs get n injections
+        cells, counts = np.unique(np.asarray(cellIds, dtype=int), return_counts=True)
+        for num in range(1, counts.max(initial=0) + 1):
+            pynn_pop[cells[counts >= num]].inject(self.input_sources[component])
 
     #
     #  Should be overridden to to connect each input to the target cell
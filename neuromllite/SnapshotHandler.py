@@ -0,0 +1,302 @@
+#
+#
+#   A handler which records a fully generated network (populations with the
+#   locations of their cells, projections with all of their connections,
+#   weights and delays, and inputs) in a single snapshot file, which can be
+#   replayed into any other handler with SnapshotReader
+#
+#
+
+from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.utils import print_v
+
+import numpy as np
+
+import json
+import struct
+
+# Start of every snapshot file
+SNAPSHOT_MAGIC = b"NeuroMLliteSnap\n"
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Arrays are aligned to this many bytes in the file, so they can be memory
+# mapped efficiently
+_ALIGNMENT = 64
+
+
+class SnapshotHandler(DefaultNetworkHandler):
+    """
+    Writes the network passed to it to filename, with the layout:
+
+        SNAPSHOT_MAGIC
+        the (aligned) raw data of each array of locations, connections, etc.
+        a JSON description of the network, giving the offset, dtype and shape
+          of each of the arrays
+        the length of the JSON description, as a little-endian 8 byte integer
+
+    Arrays are written as they arrive, so only the JSON description is held
+    in memory. If network is given (the NeuroMLlite Network which is being
+    generated), its specification is stored too, so that the reader can
+    recreate the NeuroML2 objects for its cells and synapses (relative to
+    base_dir).
+    """
+
+    def __init__(self, filename, network=None, base_dir=None):
+        print_v("Initiating SnapshotHandler, writing to %s" % filename)
+
+        self.filename = filename
+        self.snapshot = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "network_spec": json.loads(network.to_json()) if network else None,
+            "base_dir": base_dir,
+            "elements": [],
+        }
+        self.elements = {}
+        self.pending = []
+
+        self.file = open(filename, "wb")
+        self.file.write(SNAPSHOT_MAGIC)
+
+    def _write_array(self, array):
+        array = np.ascontiguousarray(array)
+        if array.dtype == object:
+            array = array.astype(float)
+
+        self.file.write(b"\0" * (-self.file.tell() % _ALIGNMENT))
+        offset = self.file.tell()
+        self.file.write(array.tobytes())
+
+        return {"offset": offset, "dtype": array.dtype.str, "shape": array.shape}
+
+    def _encode(self, value):
+        """
+        Single values are stored in the JSON description, arrays in the file
+        """
+        if np.ndim(value) == 0:
+            return value.item() if isinstance(value, np.generic) else value
+        return self._write_array(value)
+
+    def _add_element(self, type, id, **info):
+        element = dict(type=type, id=id, blocks=[], **info)
+        self.snapshot["elements"].append(element)
+        self.elements[(type, id)] = element
+
+    def _add_block(self, type, id, **fields):
+        self.elements[(type, id)]["blocks"].append(
+            {name: self._encode(value) for name, value in fields.items()}
+        )
+
+    def _flush(self):
+        """
+        Write out any locations, connections or inputs which were passed one
+        at a time (e.g. by a reader without the bulk methods) as one block
+        """
+        if not self.pending:
+            return
+
+        method, args = self.pending[0][0], self.pending[0][1]
+        values = [np.array(v) for v in zip(*[p[2] for p in self.pending])]
+        start_id = int(values[0][0])
+        self.pending = []
+
+        if method == "locations":
+            positions = np.transpose(values[1:])
+            SnapshotHandler.handle_locations(
+                self, args[0], args[1], positions, start_id=start_id
+            )
+        elif method == "connections":
+            projName, prePop, postPop, synapseType = args
+            SnapshotHandler.handle_connections(
+                self, projName, start_id, prePop, postPop, synapseType, *values[1:]
+            )
+        elif method == "inputs":
+            SnapshotHandler.handle_inputs(self, args[0], start_id, *values[1:])
+
+    def _add_pending(self, method, args, values):
+        if self.pending and self.pending[-1][:2] != (method, args):
+            self._flush()
+        # Ids passed one at a time are assumed to be consecutive in a block
+        if self.pending and values[0] != self.pending[-1][2][0] + 1:
+            self._flush()
+        self.pending.append((method, args, values))
+
+    def handle_document_start(self, id, notes):
+        self.snapshot["document"] = {"id": id, "notes": notes}
+
+    def handle_network(self, network_id, notes, temperature=None):
+        self.snapshot["network"] = {
+            "network_id": network_id,
+            "notes": notes,
+            "temperature": temperature,
+        }
+
+    def handle_population(
+        self,
+        population_id,
+        component,
+        size=-1,
+        component_obj=None,
+        properties={},
+        notes=None,
+    ):
+        self._flush()
+        self._add_element(
+            "population",
+            population_id,
+            component=component,
+            size=self._encode(size),
+            properties=dict(properties) if properties else {},
+            notes=notes,
+        )
+
+    def handle_location(self, id, population_id, component, x, y, z):
+        self._add_pending("locations", (population_id, component), (id, x, y, z))
+
+    def handle_locations(self, population_id, component, positions, start_id=0):
+        self._flush()
+        self._add_block(
+            "population",
+            population_id,
+            start_id=start_id,
+            positions=np.reshape(positions, (-1, 3)),
+        )
+
+    def finalise_population(self, population_id):
+        self._flush()
+
+    def handle_projection(
+        self,
+        projName,
+        prePop,
+        postPop,
+        synapse,
+        hasWeights=False,
+        hasDelays=False,
+        type="projection",
+        synapse_obj=None,
+        pre_synapse_obj=None,
+    ):
+        self._flush()
+        self._add_element(
+            "projection",
+            projName,
+            prePop=prePop,
+            postPop=postPop,
+            synapse=synapse,
+            hasWeights=hasWeights,
+            hasDelays=hasDelays,
+            projection_type=type,
+        )
+
+    def handle_connection(
+        self,
+        projName,
+        id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellId,
+        postCellId,
+        preSegId=0,
+        preFract=0.5,
+        postSegId=0,
+        postFract=0.5,
+        delay=0,
+        weight=1,
+    ):
+        self._add_pending(
+            "connections",
+            (projName, prePop, postPop, synapseType),
+            (
+                id,
+                preCellId,
+                postCellId,
+                preSegId,
+                preFract,
+                postSegId,
+                postFract,
+                delay,
+                weight,
+            ),
+        )
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+        self._flush()
+        self._add_block(
+            "projection",
+            projName,
+            start_id=start_id,
+            preCellIds=preCellIds,
+            postCellIds=postCellIds,
+            preSegIds=preSegIds,
+            preFracts=preFracts,
+            postSegIds=postSegIds,
+            postFracts=postFracts,
+            delays=delays,
+            weights=weights,
+        )
+
+    def finalise_projection(
+        self, projName, prePop, postPop, synapse=None, type="projection"
+    ):
+        self._flush()
+
+    def handle_input_list(
+        self, inputListId, population_id, component, size, input_comp_obj=None
+    ):
+        self._flush()
+        self._add_element(
+            "input_list",
+            inputListId,
+            population_id=population_id,
+            component=component,
+            size=self._encode(size),
+        )
+
+    def handle_single_input(
+        self, inputListId, id, cellId, segId=0, fract=0.5, weight=1
+    ):
+        self._add_pending("inputs", (inputListId,), (id, cellId, segId, fract, weight))
+
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+        self._flush()
+        self._add_block(
+            "input_list",
+            inputListId,
+            start_id=start_id,
+            cellIds=cellIds,
+            segIds=segIds,
+            fracts=fracts,
+            weights=weights,
+        )
+
+    def finalise_input_source(self, inputName):
+        self._flush()
+
+    def finalise_document(self):
+        self._flush()
+
+        description = json.dumps(self.snapshot, default=str).encode()
+        self.file.write(description)
+        self.file.write(struct.pack("<Q", len(description)))
+        self.file.close()
+
+        print_v("Written network snapshot to %s" % self.filename)
@@ -0,0 +1,204 @@
+#
+#
+#   A reader for the network snapshot files written by SnapshotHandler,
+#   replaying the populations, connections and inputs in them into a handler
+#
+#
+
+from neuromllite import NetworkReaderX
+from neuromllite import Network
+from neuromllite.CompiledNetwork import CompiledNetwork
+from neuromllite.SnapshotHandler import SNAPSHOT_MAGIC
+from neuromllite.SnapshotHandler import SNAPSHOT_FORMAT_VERSION
+from neuromllite.utils import print_v
+
+from modelspec.utils import _parse_element
+
+import numpy as np
+
+import json
+import os
+import struct
+
+
+def load_snapshot(filename):
+    """
+    Read the JSON description of a network snapshot file
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise Exception("%s is not a NeuroMLlite network snapshot" % filename)
+
+        f.seek(-8, os.SEEK_END)
+        length = struct.unpack("<Q", f.read(8))[0]
+        f.seek(-8 - length, os.SEEK_END)
+        snapshot = json.loads(f.read(length).decode())
+
+    if snapshot["format_version"] > SNAPSHOT_FORMAT_VERSION:
+        raise Exception(
+            "%s is in snapshot format %s, but only versions up to %s are supported"
+            % (filename, snapshot["format_version"], SNAPSHOT_FORMAT_VERSION)
+        )
+    return snapshot
+
+
+class SnapshotReader(NetworkReaderX):
+    """
+    Replays a network snapshot (parameter filename) into a handler. Arrays of
+    locations, connections, etc. are memory mapped from the file and passed
+    to the handler's handle_locations, handle_connections and handle_inputs
+    methods, in the blocks they were recorded in.
+
+    If the snapshot includes the NeuroMLlite specification of the network,
+    the NeuroML2 objects for its cells and synapses are recreated (unless
+    parameter include_component_objects is False), using parameter base_dir
+    or, by default, the base_dir given when the snapshot was written.
+    """
+
+    def __init__(self, **parameters):
+
+        print_v("Creating SnapshotReader with %s..." % parameters)
+        self.parameters = parameters
+        self.pop_locations = {}
+
+    def _decode(self, value):
+        if not isinstance(value, dict):
+            return value
+
+        dtype = np.dtype(value["dtype"])
+        shape = tuple(value["shape"])
+        offset = value["offset"]
+        size = int(np.prod(shape)) * dtype.itemsize
+        return self.data[offset : offset + size].view(dtype).reshape(shape)
+
+    def _decode_block(self, block):
+        return {name: self._decode(value) for name, value in block.items()}
+
+    def parse(self, handler):
+
+        from neuromllite.NetworkGenerator import _handle_projection
+        from neuromllite.NetworkGenerator import _handle_locations
+        from neuromllite.NetworkGenerator import _handle_connections
+        from neuromllite.NetworkGenerator import _handle_inputs
+
+        filename = os.path.abspath(self.parameters["filename"])
+        snapshot = load_snapshot(filename)
+        self.data = np.memmap(filename, dtype=np.uint8, mode="r")
+
+        network = None
+        cell_objects = {}
+        synapse_objects = {}
+        if snapshot["network_spec"] and self.parameters.get(
+            "include_component_objects", True
+        ):
+            network = CompiledNetwork(
+                _parse_element(snapshot["network_spec"], Network()),
+                self.parameters.get("base_dir", snapshot["base_dir"]),
+            )
+            cell_objects = network.cell_objects
+            synapse_objects = network.synapse_objects
+
+        document = snapshot["document"]
+        handler.handle_document_start(document["id"], document["notes"])
+        info = snapshot["network"]
+        handler.handle_network(
+            info["network_id"], info["notes"], temperature=info["temperature"]
+        )
+
+        for element in snapshot["elements"]:
+            id = element["id"]
+
+            if element["type"] == "population":
+                kwargs = {"notes": element["notes"]} if element["notes"] else {}
+                handler.handle_population(
+                    id,
+                    element["component"],
+                    element["size"],
+                    cell_objects.get(element["component"]),
+                    properties=element["properties"],
+                    **kwargs
+                )
+                locations = []
+                for block in element["blocks"]:
+                    block = self._decode_block(block)
+                    _handle_locations(
+                        handler,
+                        id,
+                        element["component"],
+                        block["positions"],
+                        start_id=block["start_id"],
+                    )
+                    locations.append(block["positions"])
+                if locations:
+                    self.pop_locations[id] = np.concatenate(locations)
+                if hasattr(handler, "finalise_population"):
+                    handler.finalise_population(id)
+
+            elif element["type"] == "projection":
+                proj = network.get_projection(id) if network else None
+                if proj:
+                    _handle_projection(handler, proj, synapse_objects)
+                else:
+                    handler.handle_projection(
+                        id,
+                        element["prePop"],
+                        element["postPop"],
+                        element["synapse"],
+                        hasWeights=element["hasWeights"],
+                        hasDelays=element["hasDelays"],
+                        type=element["projection_type"],
+                    )
+                for block in element["blocks"]:
+                    block = self._decode_block(block)
+                    _handle_connections(
+                        handler,
+                        id,
+                        block["start_id"],
+                        element["prePop"],
+                        element["postPop"],
+                        element["synapse"],
+                        block["preCellIds"],
+                        block["postCellIds"],
+                        preSegIds=block["preSegIds"],
+                        preFracts=block["preFracts"],
+                        postSegIds=block["postSegIds"],
+                        postFracts=block["postFracts"],
+                        delays=block["delays"],
+                        weights=block["weights"],
+                    )
+                handler.finalise_projection(
+                    id, element["prePop"], element["postPop"], element["synapse"]
+                )
+
+            elif element["type"] == "input_list":
+                handler.handle_input_list(
+                    id,
+                    element["population_id"],
+                    element["component"],
+                    size=element["size"],
+                    input_comp_obj=None,
+                )
+                for block in element["blocks"]:
+                    block = self._decode_block(block)
+                    _handle_inputs(
+                        handler,
+                        id,
+                        block["start_id"],
+                        block["cellIds"],
+                        segIds=block["segIds"],
+                        fracts=block["fracts"],
+                        weights=block["weights"],
+                    )
+                handler.finalise_input_source(id)
+
+
+def replay_snapshot(filename, handler, **parameters):
+    """
+    Pass the whole network in a snapshot file to the handler, as
+    generate_network would have done
+    """
+    reader = SnapshotReader(filename=filename, **parameters)
+    reader.parse(handler)
+    handler.finalise_document()
+
+    return reader
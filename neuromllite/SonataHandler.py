@@ -171,6 +171,20 @@ class SonataHandler(DefaultNetworkHandler):
                 (self.pop_indices[population_id], [id])
             )
 
+    def handle_locations(self, population_id, component, positions, start_id=0):
+
+        indices = np.arange(start_id, start_id + len(positions))
+        if not population_id in self.positions:
+            self.positions[population_id] = np.array(positions, dtype=float)
+            self.pop_indices[population_id] = indices
+        else:
+            self.positions[population_id] = np.concatenate(
+                (self.positions[population_id], positions)
+            )
+            self.pop_indices[population_id] = np.concatenate(
+                (self.pop_indices[population_id], indices)
+            )
+
     def finalise_population(self, population_id):
 
         self.sonata_nodes.create_dataset(
@@ -196,6 +210,39 @@ class SonataHandler(DefaultNetworkHandler):
             ],
         )
 
+    #
+    #  The connections aren't written as Sonata edges yet, so only the
+    #  batches of them are logged, rather than each connection
+    #
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+
+        print_v(
+            "Connections %i to %i of: %s (%s -> %s, syn: %s)"
+            % (
+                start_id,
+                start_id + len(preCellIds) - 1,
+                projName,
+                prePop,
+                postPop,
+                synapseType,
+            )
+        )
+
     #
     #  Should be overridden to create input source array
     #
@@ -227,6 +274,17 @@ class SonataHandler(DefaultNetworkHandler):
 
         self.input_info[inputListId][2].append(cellId)
 
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+
+        print_v(
+            "Inputs: %s[%i:%i], %i inputs"
+            % (inputListId, start_id, start_id + len(cellIds), len(cellIds))
+        )
+
+        self.input_info[inputListId][2].extend(np.asarray(cellIds).tolist())
+
     #
     #  Should be overridden to to connect each input to the target cell
     #
@@ -317,6 +317,14 @@ class Projection(BaseWithId):
                     "convergent_connectivity",
                     ("Use ConvergentConnectivity", ConvergentConnectivity),
                 ),
+                (
+                    "divergent_connectivity",
+                    ("Use DivergentConnectivity", DivergentConnectivity),
+                ),
+                (
+                    "total_number_connectivity",
+                    ("Use TotalNumberConnectivity", TotalNumberConnectivity),
+                ),
                 (
                     "one_to_one_connector",
                     (
@@ -324,6 +332,13 @@ class Projection(BaseWithId):
                         OneToOneConnector,
                     ),
                 ),
+                (
+                    "distance_dependent_connectivity",
+                    (
+                        "Connect _Cell_s within a cutoff distance of each other, with a probability which can depend on the distance",
+                        DistanceDependentConnectivity,
+                    ),
+                ),
             ]
         )
 
@@ -372,17 +387,110 @@ class OneToOneConnector(Base):
         super(OneToOneConnector, self).__init__(**kwargs)
 
 
+class DistanceDependentConnectivity(Base):
+    def __init__(self, **kwargs):
+
+        self.allowed_fields = collections.OrderedDict(
+            [
+                (
+                    "cutoff",
+                    (
+                        "Maximum distance between connected _Cell_s",
+                        EvaluableExpression,
+                    ),
+                ),
+                (
+                    "probability",
+                    (
+                        "Probability of connection, which can depend on the distance r between the _Cell_s, e.g. math.exp(-r/100) (default: 1). r can also be used in the weight and delay of the _Projection_",
+                        EvaluableExpression,
+                    ),
+                ),
+            ]
+        )
+
+        super(DistanceDependentConnectivity, self).__init__(**kwargs)
+
+
 # Temp! to redefine more generally!
 class ConvergentConnectivity(Base):
     def __init__(self, **kwargs):
 
         self.allowed_fields = collections.OrderedDict(
-            [("num_per_post", ("Number per post synaptic neuron", float))]
+            [
+                ("num_per_post", ("Number per post synaptic neuron", float)),
+                (
+                    "with_replacement",
+                    (
+                        "Whether the same pair of _Cell_s can be connected more than once (default: True)",
+                        bool,
+                    ),
+                ),
+                (
+                    "allow_self_connections",
+                    (
+                        "Whether a _Cell_ can connect to itself in a _Projection_ from a _Population_ to itself (default: False)",
+                        bool,
+                    ),
+                ),
+            ]
         )
 
         super(ConvergentConnectivity, self).__init__(**kwargs)
 
 
+class DivergentConnectivity(Base):
+    def __init__(self, **kwargs):
+
+        self.allowed_fields = collections.OrderedDict(
+            [
+                ("num_per_pre", ("Number per pre synaptic neuron", float)),
+                (
+                    "with_replacement",
+                    (
+                        "Whether the same pair of _Cell_s can be connected more than once (default: True)",
+                        bool,
+                    ),
+                ),
+                (
+                    "allow_self_connections",
+                    (
+                        "Whether a _Cell_ can connect to itself in a _Projection_ from a _Population_ to itself (default: False)",
+                        bool,
+                    ),
+                ),
+            ]
+        )
+
+        super(DivergentConnectivity, self).__init__(**kwargs)
+
+
+class TotalNumberConnectivity(Base):
+    def __init__(self, **kwargs):
+
+        self.allowed_fields = collections.OrderedDict(
+            [
+                ("number", ("Total number of connections", float)),
+                (
+                    "with_replacement",
+                    (
+                        "Whether the same pair of _Cell_s can be connected more than once (default: True)",
+                        bool,
+                    ),
+                ),
+                (
+                    "allow_self_connections",
+                    (
+                        "Whether a _Cell_ can connect to itself in a _Projection_ from a _Population_ to itself (default: False)",
+                        bool,
+                    ),
+                ),
+            ]
+        )
+
+        super(TotalNumberConnectivity, self).__init__(**kwargs)
+
+
 class NetworkReader(Base):
     def __init__(self, **kwargs):
 
@@ -418,6 +526,20 @@ class Simulation(BaseWithId):
                 ("recordVariables", ("Record named variables?", dict)),
                 ("plots2D", ("Work in progress...", dict)),
                 ("plots3D", ("Work in progress...", dict)),
+                (
+                    "num_threads",
+                    (
+                        "Number of threads to run the simulation on, for simulators which support it (currently Arbor)",
+                        int,
+                    ),
+                ),
+                (
+                    "batch_size",
+                    (
+                        "Number of trials (with independent Poisson spike inputs) to run together in one simulation, for simulators which support it (currently BindsNET)",
+                        int,
+                    ),
+                ),
             ]
         )
 
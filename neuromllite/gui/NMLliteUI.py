@@ -16,6 +16,7 @@ from neuromllite.utils import load_simulation_json
 from neuromllite.utils import evaluate
 from neuromllite.utils import print_v, print_
 from neuromllite.utils import is_spiking_input_population
+from neuromllite.ParameterTable import get_parameter_table
 from pyneuroml.pynml import get_next_hex_color
 
 from functools import partial
@@ -793,7 +794,8 @@ class NMLliteUI(QWidget):
             elif p == "temperature":
                 self.network.temperature = v
             else:
-                self.network.parameters[p] = v
+                # Only the parameters which depend on p are re-evaluated
+                get_parameter_table(self.network).set(p, v, self.network.parameters)
 
         print_("All params: %s" % self.network.parameters, self.verbose)
 
@@ -844,7 +846,7 @@ class NMLliteUI(QWidget):
 
     def _get_pop_size(self, pop_id):
         pop = self.network.get_child(pop_id, "populations")
-        return evaluate(pop.size, self.network.parameters)
+        return get_parameter_table(self.network).evaluate(pop.size)
 
     def _get_pop_id_cell_id(self, quantity):
 
@@ -8,6 +8,7 @@ from pyelectro import analysis
 from collections import OrderedDict
 
 from neuromllite.utils import print_v
+from neuromllite.ParameterTable import get_parameter_table
 
 from matplotlib import pyplot as plt
 import numpy as np
@@ -592,11 +593,12 @@ class NeuroMLliteRunner:
             "_%s" % kwargs["reference"] if "reference" in kwargs else "",
         )
         network = load_network_json(self.base_dir + "/" + sim.network)
+        parameter_table = get_parameter_table(network)
 
         for a in kwargs:
             if a in network.parameters:
                 print_v("  Setting %s to %s in network..." % (a, kwargs[a]))
-                network.parameters[a] = kwargs[a]
+                parameter_table.set(a, kwargs[a], network.parameters)
             elif a in sim.fields:
                 print_v("  Setting %s to %s in simulator..." % (a, kwargs[a]))
                 setattr(sim, a, kwargs[a])
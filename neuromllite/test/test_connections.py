@@ -0,0 +1,799 @@
+from neuromllite import *
+from neuromllite.utils import *
+from neuromllite.NetworkGenerator import *
+from neuromllite.ConnectionGenerator import *
+from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+
+import numpy as np
+import json
+import os
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class ConnectionRecorder(DefaultNetworkHandler):
+    def __init__(self):
+        self.connections = []
+        self.locations = {}
+        self.inputs = []
+
+    def handle_location(self, id, population_id, component, x, y, z):
+        self.locations[(population_id, id)] = np.array([x, y, z])
+
+    def handle_connection(
+        self,
+        projName,
+        id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellId,
+        postCellId,
+        preSegId=0,
+        preFract=0.5,
+        postSegId=0,
+        postFract=0.5,
+        delay=0,
+        weight=1,
+    ):
+        self.connections.append((projName, id, preCellId, postCellId, delay, weight))
+
+    def handle_single_input(
+        self, inputListId, id, cellId, segId=0, fract=0.5, weight=1
+    ):
+        self.inputs.append((inputListId, id, cellId, segId, weight))
+
+
+class BulkConnectionRecorder(ConnectionRecorder):
+    def __init__(self):
+        super().__init__()
+        self.batches = 0
+
+    def handle_connections(
+        self,
+        projName,
+        start_id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellIds,
+        postCellIds,
+        preSegIds=0,
+        preFracts=0.5,
+        postSegIds=0,
+        postFracts=0.5,
+        delays=0,
+        weights=1,
+    ):
+        self.batches += 1
+        num = len(preCellIds)
+        for i in range(num):
+            self.connections.append(
+                (
+                    projName,
+                    start_id + i,
+                    int(preCellIds[i]),
+                    int(postCellIds[i]),
+                    np.broadcast_to(delays, (num,))[i],
+                    np.broadcast_to(weights, (num,))[i],
+                )
+            )
+
+    def handle_inputs(
+        self, inputListId, start_id, cellIds, segIds=0, fracts=0.5, weights=1
+    ):
+        num = len(cellIds)
+        for i in range(num):
+            self.inputs.append(
+                (
+                    inputListId,
+                    start_id + i,
+                    int(cellIds[i]),
+                    np.broadcast_to(segIds, (num,))[i],
+                    np.broadcast_to(weights, (num,))[i],
+                )
+            )
+
+
+class ItemRecorder:
+    """
+    Without handle_connections or handle_inputs (not being a
+    DefaultNetworkHandler), so these are passed to it one at a time
+    """
+
+    def __init__(self):
+        self.connections = []
+        self.inputs = []
+
+    handle_connection = ConnectionRecorder.handle_connection
+    handle_single_input = ConnectionRecorder.handle_single_input
+
+
+class TotalsRecorder(ConnectionRecorder):
+    def __init__(self):
+        super().__init__()
+        self.totals = {}
+
+    def needs_individual_connections(self):
+        return False
+
+    def handle_connection_totals(
+        self, projName, prePop, postPop, synapseType, num_connections, total_weight
+    ):
+        self.totals[projName] = (num_connections, total_weight)
+
+
+class TestConnections(unittest.TestCase):
+    def get_random_network(self, probability=0.3):
+
+        net = Network(id="RandNet", seed=1234)
+        net.cells.append(Cell(id="cellA", pynn_cell="IF_cond_alpha"))
+        net.synapses.append(
+            Synapse(
+                id="syn",
+                pynn_synapse_type="cond_alpha",
+                pynn_receptor_type="excitatory",
+                parameters={"e_rev": 0, "tau_syn": 2},
+            )
+        )
+        net.populations.append(Population(id="pre", size=40, component="cellA"))
+        net.populations.append(Population(id="post", size=25, component="cellA"))
+        net.projections.append(
+            Projection(
+                id="proj",
+                presynaptic="pre",
+                postsynaptic="post",
+                synapse="syn",
+                delay=2,
+                weight=0.5,
+                random_connectivity=RandomConnectivity(probability=probability),
+            )
+        )
+        return net
+
+    def get_distance_network(self, cutoff=40, probability="math.exp(-r/50)"):
+
+        net = self.get_random_network()
+        net.regions.append(
+            RectangularRegion(id="box", x=0, y=0, z=0, width=200, height=100, depth=50)
+        )
+        for pop in net.populations:
+            pop.random_layout = RandomLayout(region="box")
+        net.projections.append(
+            Projection(
+                id="proj_r",
+                presynaptic="pre",
+                postsynaptic="pre",
+                synapse="syn",
+                delay="1 + r/10",
+                weight="0.01 * normal(1, 0.1)",
+                distance_dependent_connectivity=DistanceDependentConnectivity(
+                    cutoff=cutoff, probability=probability
+                ),
+            )
+        )
+        return net
+
+    def get_connections(self, net, **kwargs):
+        handler = ConnectionRecorder()
+        generate_network(net, handler, **kwargs)
+        return handler.connections
+
+    def test_random_connectivity_blocks(self):
+
+        for block_size in [1, 7, 25, 100, 10000]:
+            rng = np.random.default_rng(42)
+            blocks = list(random_connectivity_blocks(rng, 30, 20, 0.2, block_size))
+            pre = np.concatenate([b[0] for b in blocks])
+            post = np.concatenate([b[1] for b in blocks])
+            if block_size == 1:
+                ref_pre, ref_post = pre, post
+            else:
+                self.assertTrue(np.array_equal(pre, ref_pre))
+                self.assertTrue(np.array_equal(post, ref_post))
+
+        rng = np.random.default_rng(42)
+        pre, post = np.nonzero(rng.random((30, 20)) < 0.2)
+        self.assertTrue(np.array_equal(pre, ref_pre))
+        self.assertTrue(np.array_equal(post, ref_post))
+
+    def test_distance_dependent_connectivity_blocks(self):
+
+        rng = np.random.default_rng(7)
+        pre_positions = rng.uniform(0, 100, (50, 3))
+        post_positions = rng.uniform(-20, 80, (60, 3))
+        distances = np.linalg.norm(
+            pre_positions[:, None, :] - post_positions[None, :, :], axis=2
+        )
+        ref_pre, ref_post = np.nonzero(distances <= 30)
+
+        for block_size in [1, 10, 100, 10000]:
+            blocks = list(
+                distance_dependent_connectivity_blocks(
+                    np.random.default_rng(42),
+                    pre_positions,
+                    post_positions,
+                    30,
+                    lambda r: np.exp(-r / 20),
+                    block_size=block_size,
+                )
+            )
+            pre = np.concatenate([b[0] for b in blocks])
+            post = np.concatenate([b[1] for b in blocks])
+            r = np.concatenate([b[2] for b in blocks])
+            if block_size == 1:
+                first_pre, first_post = pre, post
+            else:
+                self.assertTrue(np.array_equal(pre, first_pre))
+                self.assertTrue(np.array_equal(post, first_post))
+            self.assertTrue(np.allclose(r, distances[pre, post]))
+
+        # With probability 1, all pairs within the cutoff are connected
+        blocks = distance_dependent_connectivity_blocks(
+            np.random.default_rng(42), pre_positions, post_positions, 30
+        )
+        pre, post, r = [np.concatenate(f) for f in zip(*blocks)]
+        self.assertTrue(np.array_equal(pre, ref_pre))
+        self.assertTrue(np.array_equal(post, ref_post))
+
+    def test_fixed_number_connectivity_blocks(self):
+
+        rng = np.random.default_rng(42)
+        for with_replacement in [True, False]:
+            for num in [0, 1, 5, 19]:
+                blocks = convergent_connectivity_blocks(
+                    rng, 20, 30, num, True, with_replacement, block_size=7
+                )
+                pre, post = [np.concatenate(f) for f in zip(*blocks)]
+                self.assertEqual(len(pre), 30 * num)
+                self.assertEqual(np.bincount(post, minlength=30).tolist(), [num] * 30)
+                self.assertFalse(np.any(pre == post))
+                self.assertTrue(np.all((pre >= 0) & (pre < 20)))
+                if not with_replacement:
+                    self.assertEqual(len(set(zip(pre, post))), len(pre))
+
+                blocks = divergent_connectivity_blocks(
+                    rng, 30, 20, num, True, with_replacement, block_size=7
+                )
+                pre, post = [np.concatenate(f) for f in zip(*blocks)]
+                self.assertEqual(np.bincount(pre, minlength=30).tolist(), [num] * 30)
+                self.assertFalse(np.any(pre == post))
+                if not with_replacement:
+                    self.assertEqual(len(set(zip(pre, post))), len(pre))
+
+            blocks = total_number_connectivity_blocks(
+                rng, 20, 20, 380, True, with_replacement, block_size=7
+            )
+            pre, post = [np.concatenate(f) for f in zip(*blocks)]
+            self.assertEqual(len(pre), 380)
+            self.assertFalse(np.any(pre == post))
+            self.assertTrue(np.all(np.diff(pre * 20 + post) >= 0))
+            if not with_replacement:
+                self.assertEqual(len(set(zip(pre, post))), 380)
+
+        # The same rng state gives the same connections for any block_size
+        for blocks in [convergent_connectivity_blocks, divergent_connectivity_blocks]:
+            for with_replacement in [True, False]:
+                conns = []
+                for block_size in [1, 7, 1000]:
+                    rng = np.random.default_rng(7)
+                    pre, post = [
+                        np.concatenate(f).tolist()
+                        for f in zip(
+                            *blocks(rng, 50, 40, 9, True, with_replacement, block_size)
+                        )
+                    ]
+                    conns.append((pre, post))
+                self.assertEqual(conns[1], conns[0])
+                self.assertEqual(conns[2], conns[0])
+
+        with self.assertRaises(Exception):
+            list(convergent_connectivity_blocks(rng, 20, 20, 20, True, False))
+        with self.assertRaises(Exception):
+            list(total_number_connectivity_blocks(rng, 20, 20, 381, True, False))
+
+    def test_rechunk_connections(self):
+
+        blocks = [
+            (np.arange(5), np.arange(5), 2, np.ones(5)),
+            ([], [], 2, []),
+            (np.arange(12), np.arange(12), np.arange(12), 0.5),
+        ]
+        chunks = list(rechunk_connections(blocks, 4))
+        self.assertEqual([len(c[0]) for c in chunks], [4, 4, 4, 4, 1])
+        for i in range(4):
+            self.assertEqual(len(set(len(f) for f in chunks[i])), 1)
+
+        pre = np.concatenate([c[0] for c in chunks])
+        self.assertEqual(pre.tolist(), list(range(5)) + list(range(12)))
+        weights = np.concatenate([c[3] for c in chunks])
+        self.assertEqual(weights.tolist(), [1] * 5 + [0.5] * 12)
+
+    def test_random_connectivity(self):
+
+        net = self.get_random_network()
+        conns = self.get_connections(net)
+        self.assertEqual(conns, self.get_connections(net, block_size=13))
+        self.assertEqual([c[1] for c in conns], list(range(len(conns))))
+        self.assertTrue(0 < len(conns) < 40 * 25)
+        for c in conns:
+            self.assertEqual(c[4:], (2, 0.5))
+
+        self.assertEqual(len(self.get_connections(self.get_random_network(1))), 40 * 25)
+        self.assertEqual(len(self.get_connections(self.get_random_network(0))), 0)
+
+        legacy = self.get_connections(net, legacy_generation=True)
+        self.assertEqual(legacy, self.get_connections(net, legacy_generation=True))
+        self.assertTrue(0 < len(legacy) < 40 * 25)
+
+        # Random weights, delays and probabilities are drawn from their own
+        # streams, so don't change the connectivity or depend on block_size
+        net.projections[0].weight = "uniform(0.1, 1)"
+        random_conns = self.get_connections(net)
+        self.assertEqual([c[2:4] for c in random_conns], [c[2:4] for c in conns])
+        net.projections[0].delay = "normal(2, 0.1)"
+        net.projections[0].random_connectivity.probability = "uniform(0.2, 0.4)"
+        random_conns = self.get_connections(net)
+        self.assertEqual(len(set(c[5] for c in random_conns)), len(random_conns))
+        for block_size in [1, 13, 300]:
+            self.assertEqual(
+                self.get_connections(net, block_size=block_size), random_conns
+            )
+
+    def test_distance_dependent_connectivity(self):
+
+        net = self.get_distance_network()
+        handler = ConnectionRecorder()
+        generate_network(net, handler)
+        conns = [c for c in handler.connections if c[0] == "proj_r"]
+        self.assertTrue(len(conns) > 0)
+
+        for c in conns:
+            r = np.linalg.norm(
+                handler.locations[("pre", c[2])] - handler.locations[("pre", c[3])]
+            )
+            self.assertTrue(r <= 40)
+            self.assertNotEqual(c[2], c[3])
+            self.assertAlmostEqual(c[4], 1 + r / 10)
+
+        self.assertEqual(self.get_connections(net, num_workers=2), handler.connections)
+
+        # Random weights, delays and probabilities are drawn from their own
+        # streams, so the connections don't depend on block_size
+        conns = handler.connections
+        for block_size in [1, 5, 1000]:
+            self.assertEqual(self.get_connections(net, block_size=block_size), conns)
+        net.projections[-1].delay = "uniform(1, 2)"
+        net.projections[
+            -1
+        ].distance_dependent_connectivity.probability = (
+            "uniform(0.5, 1) * math.exp(-r/50)"
+        )
+        random_conns = self.get_connections(net)
+        self.assertEqual(self.get_connections(net, block_size=5), random_conns)
+        self.assertEqual(self.get_connections(net, num_workers=2), random_conns)
+
+        net.projections[-1].weight = "0.01 * r"
+        net.projections[
+            -1
+        ].distance_dependent_connectivity.probability = "math.exp(-r/50)"
+        conns = self.get_connections(net)
+        self.assertEqual([c[2:4] for c in conns], [c[2:4] for c in handler.connections])
+
+        all_conns = self.get_connections(self.get_distance_network(probability=1))
+        self.assertTrue(
+            len([c for c in all_conns if c[0] == "proj_r"])
+            > len([c for c in conns if c[0] == "proj_r"])
+        )
+
+        with self.assertRaises(Exception):
+            self.get_connections(net, legacy_generation=True)
+
+    def test_fixed_number_connectivity(self):
+
+        net = self.get_random_network()
+        del net.projections[:]
+        net.projections.extend(
+            [
+                Projection(
+                    id="conv",
+                    presynaptic="pre",
+                    postsynaptic="pre",
+                    synapse="syn",
+                    convergent_connectivity=ConvergentConnectivity(
+                        num_per_post=39, with_replacement=False
+                    ),
+                ),
+                Projection(
+                    id="div",
+                    presynaptic="pre",
+                    postsynaptic="post",
+                    synapse="syn",
+                    divergent_connectivity=DivergentConnectivity(num_per_pre=4),
+                ),
+                Projection(
+                    id="total",
+                    presynaptic="post",
+                    postsynaptic="post",
+                    synapse="syn",
+                    weight=0.5,
+                    total_number_connectivity=TotalNumberConnectivity(
+                        number=100, allow_self_connections=True
+                    ),
+                ),
+            ]
+        )
+        conns = self.get_connections(net)
+        conv = [c[2:4] for c in conns if c[0] == "conv"]
+        self.assertEqual(
+            sorted(conv), [(i, j) for i in range(40) for j in range(40) if i != j]
+        )
+        self.assertEqual(len([c for c in conns if c[0] == "div"]), 40 * 4)
+        self.assertEqual(len([c for c in conns if c[0] == "total"]), 100)
+        self.assertEqual(self.get_connections(net, num_workers=2), conns)
+
+        # The cells are sampled from the projection's connectivity stream, so
+        # don't depend on block_size or on random weights and delays
+        for proj in net.projections:
+            proj.weight = "uniform(0.1, 1)"
+            proj.delay = "normal(2, 0.1)"
+        random_conns = self.get_connections(net)
+        self.assertEqual([c[:4] for c in random_conns], [c[:4] for c in conns])
+        for block_size in [1, 7, 100]:
+            self.assertEqual(
+                self.get_connections(net, block_size=block_size), random_conns
+            )
+
+        with self.assertRaises(Exception):
+            self.get_connections(net, legacy_generation=True)
+
+    def test_cache_dir(self):
+
+        net = self.get_distance_network()
+        conns = self.get_connections(net)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(self.get_connections(net, cache_dir=cache_dir), conns)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            handler = ConnectionRecorder()
+            generate_network(net, handler, cache_dir=cache_dir)
+            self.assertEqual(handler.connections, conns)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            # Only the edited projection is regenerated
+            net.projections[-1].weight = "0.02 * r"
+            edited = self.get_connections(net)
+            self.assertEqual(self.get_connections(net, cache_dir=cache_dir), edited)
+            self.assertEqual(len(os.listdir(cache_dir)), 5)
+
+            # As is any projection using a changed parameter
+            net.parameters = {"w": 0.5}
+            net.projections[0].weight = "w"
+            self.get_connections(net, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 6)
+            net.parameters["w"] = 0.25
+            self.assertEqual(
+                self.get_connections(net, cache_dir=cache_dir),
+                self.get_connections(net),
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 7)
+
+    def test_connection_totals(self):
+
+        net = self.get_distance_network()
+        net.projections.append(
+            Projection(
+                id="proj_c",
+                presynaptic="post",
+                postsynaptic="post",
+                synapse="syn",
+                weight="uniform(0, 1)",
+                convergent_connectivity=ConvergentConnectivity(
+                    num_per_post=4, with_replacement=False
+                ),
+            )
+        )
+        conns = self.get_connections(net)
+
+        handler = TotalsRecorder()
+        generate_network(net, handler)
+        self.assertEqual(handler.connections, [])
+        totals = handler.totals
+
+        # Totals of fixed numbers of connections are exact, as are those of
+        # projections whose connections have to be generated
+        for proj_id in ["proj_r", "proj_c"]:
+            proj_conns = [c for c in conns if c[0] == proj_id]
+            self.assertEqual(totals[proj_id][0], len(proj_conns))
+            self.assertAlmostEqual(
+                totals[proj_id][1], sum(c[5] for c in proj_conns), places=9
+            )
+
+        num, total_weight = totals["proj"]
+        self.assertTrue(0.2 * 40 * 25 < num < 0.4 * 40 * 25)
+        self.assertEqual(total_weight, 0.5 * num)
+
+        # Totals for 10^10 possible connections are drawn at once
+        net.populations[0].size = 100000
+        net.populations[1].size = 100000
+        net.projections[0].random_connectivity.probability = 0.1
+        del net.projections[1:]
+        handler = TotalsRecorder()
+        generate_network(net, handler)
+        num, total_weight = handler.totals["proj"]
+        self.assertTrue(abs(num - 1e9) < 1e6)
+
+    def test_profiler(self):
+
+        from neuromllite.GenerationProfiler import GenerationProfiler
+
+        net = self.get_random_network()
+        conns = self.get_connections(net, chunk_size=50)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_file = os.path.join(tmp_dir, "profile.json")
+            profiler = GenerationProfiler(report_file=report_file)
+            handler = BulkConnectionRecorder()
+            generate_network(net, handler, chunk_size=50, profiler=profiler)
+            self.assertEqual(handler.connections, conns)
+
+            with open(report_file) as f:
+                report = json.load(f)
+
+        self.assertEqual(report["network"], "RandNet")
+        self.assertEqual(report["handler"], "BulkConnectionRecorder")
+        phases = [(p["kind"], p["id"]) for p in report["phases"]]
+        self.assertEqual(
+            phases,
+            [
+                ("setup", None),
+                ("population", "pre"),
+                ("population", "post"),
+                ("projection_setup", None),
+                ("projection", "proj"),
+                ("finalise", None),
+            ],
+        )
+        proj = report["phases"][4]
+        self.assertEqual(
+            proj["handler_calls"],
+            {
+                "handle_projection": 1,
+                "handle_connections": (len(conns) + 49) // 50,
+                "finalise_projection": 1,
+            },
+        )
+        for phase in report["phases"]:
+            self.assertTrue(phase["handler_time"] <= phase["wall_time"])
+            self.assertTrue(phase["peak_memory"] > 0)
+
+    def test_inputs(self):
+
+        net = self.get_random_network()
+        net.input_sources.append(InputSource(id="i_clamp", pynn_input="DCSource"))
+        net.inputs.append(
+            Input(
+                id="stim",
+                input_source="i_clamp",
+                population="pre",
+                percentage=50,
+                number_per_cell=3,
+                weight="uniform(1, 2)",
+            )
+        )
+        handler = ConnectionRecorder()
+        generate_network(net, handler)
+        inputs = handler.inputs
+
+        self.assertEqual([i[1] for i in inputs], list(range(len(inputs))))
+        self.assertTrue(0 < len(inputs) < 40 * 3)
+        cell_ids = [i[2] for i in inputs]
+        for c in set(cell_ids):
+            self.assertEqual(cell_ids.count(c), 3)
+        self.assertEqual([i[3] for i in inputs], [0] * len(inputs))
+        weights = [i[4] for i in inputs]
+        self.assertTrue(all(1 <= w < 2 for w in weights))
+        self.assertEqual(len(set(weights)), len(inputs))
+
+        handler = ConnectionRecorder()
+        generate_network(net, handler, chunk_size=7)
+        self.assertEqual(handler.inputs, inputs)
+
+    def test_handle_connections(self):
+
+        net = self.get_random_network()
+        conns = self.get_connections(net, block_size=100)
+
+        handler = BulkConnectionRecorder()
+        generate_network(net, handler, block_size=100)
+        self.assertEqual(handler.connections, conns)
+        self.assertEqual(handler.batches, 10)
+
+    def get_chunks(self):
+        """
+        Batches of connections and of inputs, with the other arguments given
+        as single values or arrays
+        """
+        pops = ("pre", "post", "syn")
+        conn_chunks = [
+            (("proj", 0) + pops + (np.array([0, 1, 2]), np.array([3, 3, 4])), {}),
+            (
+                ("proj", 3) + pops + ([5], [6]),
+                {"delays": 2.5, "weights": np.array([0.25])},
+            ),
+            (
+                ("proj", 4) + pops + (np.array([7, 8]), np.array([0, 1])),
+                {"delays": np.array([1.0, 2.0]), "weights": 0.5, "preSegIds": 1},
+            ),
+            (("proj", 6) + pops + (np.zeros(0, dtype=int), np.zeros(0, dtype=int)), {}),
+        ]
+        input_chunks = [
+            (("stim", 0, np.array([2, 2, 5])), {"weights": np.array([1.0, 2.0, 3.0])}),
+            (("stim", 3, [7]), {"segIds": 2, "fracts": 0.1}),
+            (("stim", 4, np.zeros(0, dtype=int)), {}),
+        ]
+        return conn_chunks, input_chunks
+
+    def test_handle_items(self):
+
+        from neuromllite.NetworkGenerator import _handle_connections
+        from neuromllite.NetworkGenerator import _handle_inputs
+
+        conn_chunks, input_chunks = self.get_chunks()
+        handlers = [BulkConnectionRecorder(), ItemRecorder()]
+        for handler in handlers:
+            for args, kwargs in conn_chunks:
+                _handle_connections(handler, *args, **kwargs)
+            for args, kwargs in input_chunks:
+                _handle_inputs(handler, *args, **kwargs)
+
+        bulk, items = handlers
+        self.assertEqual(bulk.batches, 4)
+        self.assertEqual(bulk.connections, items.connections)
+        self.assertEqual(bulk.inputs, items.inputs)
+        self.assertEqual(
+            items.connections,
+            [
+                ("proj", 0, 0, 3, 0, 1),
+                ("proj", 1, 1, 3, 0, 1),
+                ("proj", 2, 2, 4, 0, 1),
+                ("proj", 3, 5, 6, 2.5, 0.25),
+                ("proj", 4, 7, 0, 1.0, 0.5),
+                ("proj", 5, 8, 1, 2.0, 0.5),
+            ],
+        )
+        self.assertEqual(
+            items.inputs,
+            [
+                ("stim", 0, 2, 0, 1.0),
+                ("stim", 1, 2, 0, 2.0),
+                ("stim", 2, 5, 0, 3.0),
+                ("stim", 3, 7, 2, 1),
+            ],
+        )
+
+    def test_mdf_handle_connections(self):
+
+        try:
+            from neuromllite.MDFHandler import MDFHandler
+        except ImportError:
+            self.skipTest("The dependencies of MDFHandler are not installed")
+        from neuromllite.NetworkGenerator import _handle_connections
+
+        class ItemMDFHandler(MDFHandler):
+            handle_connections = DefaultNetworkHandler.handle_connections
+
+        conn_chunks = self.get_chunks()[0]
+        edges = []
+        net = self.get_random_network()
+        for handler in [MDFHandler(net), ItemMDFHandler(net)]:
+            handler.handle_document_start("doc", None)
+            handler.handle_network("net", None)
+            for args, kwargs in conn_chunks:
+                _handle_connections(handler, *args, **kwargs)
+            edges.append(handler.mdf_graph["edges"])
+
+        self.assertEqual(edges[0], edges[1])
+        self.assertEqual(len(edges[0]), 6)
+        self.assertEqual(edges[0]["Edge pre_5 to post_6"]["weight"], 0.25)
+
+    def test_independent_streams(self):
+
+        net = self.get_random_network()
+        conns = self.get_connections(net)
+
+        net.projections.insert(
+            0,
+            Projection(
+                id="proj0",
+                presynaptic="post",
+                postsynaptic="pre",
+                synapse="syn",
+                random_connectivity=RandomConnectivity(probability=0.5),
+            ),
+        )
+        all_conns = self.get_connections(net)
+        self.assertEqual([c for c in all_conns if c[0] == "proj"], conns)
+
+        net.projections.reverse()
+        self.assertEqual(sorted(self.get_connections(net)), sorted(all_conns))
+
+        net.seed = 4321
+        self.assertNotEqual(
+            [c for c in self.get_connections(net) if c[0] == "proj"], conns
+        )
+
+    def test_num_workers(self):
+
+        net = self.get_random_network()
+        net.projections.append(
+            Projection(
+                id="proj2",
+                presynaptic="post",
+                postsynaptic="post",
+                synapse="syn",
+                weight="random()",
+                convergent_connectivity=ConvergentConnectivity(num_per_post=3),
+            )
+        )
+        conns = self.get_connections(net)
+        self.assertEqual(self.get_connections(net, num_workers=2), conns)
+
+    def test_iter_connections(self):
+
+        net = self.get_random_network()
+        conns = self.get_connections(net)
+
+        handler = BulkConnectionRecorder()
+        generate_network(net, handler, chunk_size=64)
+        self.assertEqual(handler.connections, conns)
+        self.assertEqual(handler.batches, (len(conns) + 63) // 64)
+
+        streamed = []
+        for proj_id, start_id, pre, post, delays, weights in iter_connections(
+            net, chunk_size=50
+        ):
+            self.assertTrue(len(pre) <= 50)
+            for i in range(len(pre)):
+                streamed.append(
+                    (proj_id, start_id + i, pre[i], post[i], delays[i], weights[i])
+                )
+        self.assertEqual(streamed, conns)
+
+    def test_sparse_connectivity(self):
+
+        from neuromllite.ConnectivityHandler import SparseConnectivity
+
+        connectivity = SparseConnectivity(4, 3)
+        connectivity.add(2, 1, 0.5, 1.0, 3)
+        connectivity.add([0, 2, 3, 2], [2, 1, 0, 1], [1, 2, 3, 4], [2, 4, 6, 8], 1.5)
+        connectivity.add([], [], 1, 1, 0)
+
+        self.assertEqual(connectivity.num_pairs, 3)
+        self.assertEqual(connectivity.pre_cell_ids.tolist(), [0, 2, 3])
+        self.assertEqual(connectivity.post_cell_ids.tolist(), [2, 1, 0])
+        self.assertEqual(connectivity.indptr.tolist(), [0, 1, 1, 2, 3])
+        self.assertEqual(connectivity.weights.tolist(), [1, 6.5, 3])
+        self.assertEqual(connectivity.scaled_weights.tolist(), [2, 13, 6])
+        self.assertEqual(connectivity.conn_numbers.tolist(), [1, 3, 1])
+        self.assertEqual(connectivity.delays.tolist(), [1.5, 1.5, 1.5])
+        self.assertEqual(connectivity.density, 0.25)
+
+        dense = np.zeros((4, 3))
+        dense[0, 2], dense[2, 1], dense[3, 0] = 1, 6.5, 3
+        self.assertTrue(np.array_equal(connectivity.to_dense(), dense))
+        self.assertRaises(Exception, connectivity.to_dense, "positions")
+
+        connectivity.add(1, 0, 1, 1, 2)
+        self.assertEqual(connectivity.indptr.tolist(), [0, 1, 2, 3, 4])
+        self.assertEqual(SparseConnectivity(2, 2).num_pairs, 0)
+        self.assertEqual(SparseConnectivity(0, 2).density, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+from neuromllite.ExpressionCompiler import *
+
+from modelspec.utils import evaluate
+
+import numpy as np
+import random
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class TestExpressions(unittest.TestCase):
+
+    parameters = {"weight": 0.5, "size": "2*3", "noisy_weight": "weight*random()"}
+
+    def test_classify(self):
+
+        cache = ExpressionCache(self.parameters)
+        self.assertEqual(cache.get(3).kind, CONSTANT)
+        self.assertEqual(cache.get("3*0.5").kind, CONSTANT)
+        self.assertEqual(cache.get("weight").kind, PARAMETER)
+        self.assertEqual(cache.get("2*weight").kind, PARAMETER)
+        self.assertEqual(cache.get("math.exp(weight)").kind, PARAMETER)
+        self.assertEqual(cache.get("weight*random()").kind, RANDOM)
+        self.assertEqual(cache.get("noisy_weight").kind, RANDOM)
+        self.assertEqual(cache.get("normal(weight, 0.1)").kind, RANDOM)
+
+        self.assertIs(cache.get("2*weight"), cache.get("2*weight"))
+
+        for expr in [3, "3*0.5", "weight", "2*weight", "size", "math.exp(weight)"]:
+            self.assertEqual(
+                cache.evaluate(expr), evaluate(expr, dict(self.parameters))
+            )
+
+    def test_evaluate_random(self):
+
+        cache = ExpressionCache(self.parameters)
+        for expr in ["weight*random()", "noisy_weight", "math.exp(random())"]:
+            rng = np.random.default_rng(11)
+            values = cache.evaluate_array(expr, rng, 20)
+            rng = np.random.default_rng(11)
+            self.assertTrue(
+                np.allclose(values, [cache.evaluate(expr, rng) for i in range(20)])
+            )
+            rng = np.random.default_rng(11)
+            self.assertTrue(
+                np.allclose(
+                    values,
+                    [evaluate(expr, dict(self.parameters), rng) for i in range(20)],
+                )
+            )
+
+        # int() can't be applied to an array, so each value is evaluated in turn
+        values = cache.evaluate_array("int(random()*5)", np.random.default_rng(1), 50)
+        self.assertEqual(len(values), 50)
+        self.assertTrue(set(values).issubset(range(5)))
+
+        # random.Random is only used by evaluate()
+        self.assertEqual(
+            cache.evaluate("weight*random()", random.Random(3)),
+            evaluate("weight*random()", dict(self.parameters), random.Random(3)),
+        )
+
+    def test_distributions(self):
+
+        cache = ExpressionCache(self.parameters)
+        rng = np.random.default_rng(5)
+        normal = cache.evaluate_array("normal(weight, 0.1)", rng, 20000)
+        self.assertAlmostEqual(normal.mean(), 0.5, places=2)
+        self.assertAlmostEqual(normal.std(), 0.1, places=2)
+
+        uniform = cache.evaluate_array("uniform(-1, 2)", rng, 20000)
+        self.assertTrue(uniform.min() >= -1 and uniform.max() < 2)
+
+        lognormal = cache.evaluate_array("lognormal(0, 0.5)", rng, 20000)
+        self.assertTrue(lognormal.min() > 0)
+        self.assertAlmostEqual(np.log(lognormal).mean(), 0, places=1)
+
+        self.assertTrue(isinstance(cache.evaluate("normal(2, 1)", rng), float))
+
+
+if __name__ == "__main__":
+    unittest.main()
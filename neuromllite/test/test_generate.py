@@ -1,6 +1,9 @@
 from neuromllite import *
 from neuromllite.utils import *
 from neuromllite.NetworkGenerator import *
+from neuromllite.DefaultNetworkHandler import DefaultNetworkHandler
+from neuromllite.SnapshotHandler import SnapshotHandler
+from neuromllite.SnapshotReader import replay_snapshot
 
 from modelspec.utils import _parse_element
 
@@ -11,6 +14,66 @@ except ImportError:
     import unittest
 
 
+class EventRecorder(DefaultNetworkHandler):
+    def __init__(self):
+        self.events = []
+
+    def handle_population(
+        self,
+        population_id,
+        component,
+        size=-1,
+        component_obj=None,
+        properties={},
+        notes=None,
+    ):
+        self.events.append(
+            ("population", population_id, component, size, type(component_obj))
+        )
+
+    def handle_location(self, id, population_id, component, x, y, z):
+        self.events.append(("location", id, population_id, x, y, z))
+
+    def handle_projection(
+        self,
+        projName,
+        prePop,
+        postPop,
+        synapse,
+        hasWeights=False,
+        hasDelays=False,
+        type="projection",
+        synapse_obj=None,
+        pre_synapse_obj=None,
+    ):
+        self.events.append(("projection", projName, prePop, postPop, synapse, type))
+
+    def handle_connection(
+        self,
+        projName,
+        id,
+        prePop,
+        postPop,
+        synapseType,
+        preCellId,
+        postCellId,
+        preSegId=0,
+        preFract=0.5,
+        postSegId=0,
+        postFract=0.5,
+        delay=0,
+        weight=1,
+    ):
+        self.events.append(
+            ("connection", projName, id, preCellId, postCellId, delay, weight)
+        )
+
+    def handle_single_input(
+        self, inputListId, id, cellId, segId=0, fract=0.5, weight=1
+    ):
+        self.events.append(("input", inputListId, id, cellId, segId, fract, weight))
+
+
 class TestGenerate(unittest.TestCase):
     def get_example_simulation(self):
 
@@ -39,6 +102,770 @@ class TestGenerate(unittest.TestCase):
             target_dir=gen_dir,
         )
 
+    def test_snapshot(self):
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+
+        recorder = EventRecorder()
+        generate_network(network, recorder, base_dir=base_dir)
+
+        snapshot = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "temp/%s.snapshot" % network.id
+        )
+        generate_network(
+            network, SnapshotHandler(snapshot, network, base_dir), base_dir=base_dir
+        )
+
+        replayed = EventRecorder()
+        replay_snapshot(snapshot, replayed)
+        self.assertEqual(replayed.events, recorder.events)
+
+        # Locations, connections and inputs can also be passed one at a time
+        class ItemSnapshotHandler(SnapshotHandler):
+            handle_locations = DefaultNetworkHandler.handle_locations
+            handle_connections = DefaultNetworkHandler.handle_connections
+            handle_inputs = DefaultNetworkHandler.handle_inputs
+
+        item_snapshot = snapshot.replace(".snapshot", "_items.snapshot")
+        generate_network(network, ItemSnapshotHandler(item_snapshot), base_dir=base_dir)
+        replayed = EventRecorder()
+        replay_snapshot(item_snapshot, replayed)
+        self.assertEqual(
+            [e[:4] for e in replayed.events], [e[:4] for e in recorder.events]
+        )
+
+        # As a network_reader
+        net = Network(id="replay")
+        net.network_reader = NetworkReader(
+            type="SnapshotReader", parameters={"filename": snapshot}
+        )
+        replayed = EventRecorder()
+        generate_network(net, replayed)
+        self.assertEqual(replayed.events, recorder.events)
+
+    def test_composite_handler(self):
+
+        from neuromllite.CompositeHandler import CompositeHandler
+        from neuroml.hdf5.NetworkBuilder import NetworkBuilder
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+        gen_dir = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "temp/composite"
+        )
+        if not os.path.isdir(gen_dir):
+            os.mkdir(gen_dir)
+
+        recorder = EventRecorder()
+        generate_network(network, recorder, base_dir=base_dir)
+        nml_file, nml_doc = generate_neuroml2_from_network(
+            network, base_dir=base_dir, target_dir=gen_dir
+        )
+        with open(nml_file) as f:
+            nml = f.read()
+
+        recorders = [EventRecorder(), EventRecorder()]
+        builder = NetworkBuilder()
+        handler = CompositeHandler([recorders[0], builder, recorders[1]])
+        self.assertTrue(handler.needs_individual_connections())
+        generate_network(network, handler, base_dir=base_dir)
+        for r in recorders:
+            self.assertEqual(r.events, recorder.events)
+
+        generate_neuroml2_from_network(
+            network, base_dir=base_dir, target_dir=gen_dir, neuroml_handler=builder
+        )
+        with open(nml_file) as f:
+            self.assertEqual(f.read(), nml)
+
+    def test_save_matrices(self):
+
+        from neuromllite.MatrixHandler import MatrixHandler, load_matrix
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+        gen_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "temp")
+
+        for format in ["npz", "h5"]:
+            filename = os.path.join(gen_dir, "%s_matrices.%s" % (network.id, format))
+            handler = MatrixHandler(
+                -1,
+                nl_network=network,
+                save_to=filename,
+                groups={"pops01": ["pop0", "pop1"]},
+                show=False,
+            )
+            generate_network(network, handler, base_dir=base_dir)
+
+            name = "Chemical conns (total weight between cell pair)"
+            matrix = handler.weight_arrays_to_show[name]
+            cells, labels = load_matrix(filename, name)
+            self.assertTrue(np.array_equal(cells, matrix))
+            self.assertEqual(labels[0], "pop0_0")
+
+            pops, labels = load_matrix(filename, name, "populations")
+            self.assertEqual(labels, ["pop0", "pop1", "pop2"])
+            self.assertEqual(pops.shape, (3, 3))
+            self.assertAlmostEqual(pops.sum(), matrix.sum())
+            groups, labels = load_matrix(filename, name, "groups")
+            self.assertEqual(labels, ["pops01", "pop2"])
+            self.assertAlmostEqual(groups[0, 0], pops[:2, :2].sum())
+            self.assertAlmostEqual(groups.sum(), matrix.sum())
+
+    def test_matrix_bins(self):
+
+        from neuromllite.MatrixHandler import MatrixHandler
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        network.populations[0].size = 40
+        network.populations[1].size = 25
+        network.populations.pop(2)
+        network.projections[1].presynaptic = "pop1"
+        network.projections[1].postsynaptic = "pop0"
+        for p in network.projections:
+            p.random_connectivity.probability = 0.3
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+        name = "Chemical conns (total weight between cell pair)"
+
+        handler = MatrixHandler(-1, nl_network=network, show=False)
+        generate_network(network, handler, base_dir=base_dir)
+        cells = handler.weight_arrays_to_show[name]
+        self.assertEqual(cells.shape, (65, 65))
+        self.assertGreater(cells.sum(), 0)
+
+        handler = MatrixHandler(-1, nl_network=network, bin_size=7, show=False)
+        generate_network(network, handler, base_dir=base_dir)
+        binned = handler.weight_arrays_to_show[name]
+        labels = handler._get_entries(["pop0", "pop1"])[0]
+
+        # 6 bins of the 40 cells of pop0 and 4 of the 25 of pop1
+        self.assertEqual(binned.shape, (10, 10))
+        self.assertEqual(labels[:2], ["pop0_00-6", "pop0_07-13"])
+        self.assertEqual(labels[5:7], ["pop0_35-39", "pop1_00-6"])
+        self.assertEqual(labels[-1], "pop1_21-24")
+        self.assertAlmostEqual(binned.sum(), cells.sum())
+        starts = [0, 7, 14, 21, 28, 35, 40, 47, 54, 61]
+        summed = np.add.reduceat(np.add.reduceat(cells, starts, axis=0), starts, axis=1)
+        self.assertTrue(np.allclose(binned, summed))
+
+    def test_graph_cell_edges(self):
+
+        from neuromllite.GraphVizHandler import GraphVizHandler
+
+        class EdgesGraphVizHandler(GraphVizHandler):
+            """Builds the graph without rendering it, which needs dot"""
+
+            def finalise_document(self):
+                # The connections from pop0 to pop2 have weights summing to 0
+                connectivity = self.proj_cell_connectivity["proj1"]
+                connectivity.add(
+                    connectivity.pre_cell_ids,
+                    connectivity.post_cell_ids,
+                    -connectivity.weights,
+                    -connectivity.scaled_weights,
+                    0,
+                )
+                self.graph.render = lambda *args, **kwargs: None
+                GraphVizHandler.finalise_document(self)
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+
+        # pop0 and pop1 (2 cells each) are collapsed, pop2 (1 cell) isn't
+        handler = EdgesGraphVizHandler(
+            -1, nl_network=network, view_on_render=False, collapse_pop_size=1
+        )
+        generate_network(network, handler, base_dir=base_dir)
+
+        connectivity = handler.proj_cell_connectivity["proj0"]
+        edges = handler._get_cell_edges("proj0")
+        self.assertEqual(
+            (edges["pre_nodes"], edges["post_nodes"]), (["pop0"], ["pop1"])
+        )
+        self.assertEqual(edges["conn_numbers"].tolist(), [4])
+        self.assertEqual(edges["conn_numbers"].dtype.kind, "i")
+        self.assertAlmostEqual(edges["weights"][0], connectivity.weights.sum())
+        self.assertAlmostEqual(
+            edges["scaled_weights"][0], connectivity.scaled_weights.sum()
+        )
+        self.assertIsNone(edges["delays"])
+
+        edges = handler._get_cell_edges("proj1")
+        self.assertEqual(
+            (edges["pre_nodes"], edges["post_nodes"]), (["pop0"], ["pop2_0"])
+        )
+        # The 2 connections, and the 2 cancelling them
+        self.assertEqual(edges["conn_numbers"].tolist(), [4])
+        self.assertEqual(edges["scaled_weights"].tolist(), [0])
+
+        # Only the edge with non-zero weight is in the graph
+        conns = [line for line in handler.graph.body if " -> " in line]
+        self.assertEqual(
+            len([c for c in conns if c.strip().startswith("pop0 -> pop1")]), 1
+        )
+        self.assertFalse([c for c in conns if "pop2_0" in c])
+
+        # By default, only populations of more than 100 cells are collapsed
+        network.get_child("pop0", "populations").size = 101
+        handler = EdgesGraphVizHandler(-1, nl_network=network, view_on_render=False)
+        generate_network(network, handler, base_dir=base_dir)
+        edges = handler._get_cell_edges("proj0")
+        self.assertEqual(set(edges["pre_nodes"]), {"pop0"})
+        self.assertEqual(set(edges["post_nodes"]), {"pop1_0", "pop1_1"})
+
+    def test_generate_exports(self):
+
+        import neuromllite.NetworkGenerator as NetworkGenerator
+        from neuromllite.MatrixHandler import load_matrix
+
+        sim = self.get_example_simulation()
+        network = load_network_json(sim.network)
+        # A population without positions, whose properties NeuroML2 leaves out
+        network.populations[2].random_layout = None
+        base_dir = os.path.abspath(os.path.dirname(sim.network))
+        gen_dir = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), "temp/exports"
+        )
+        if not os.path.isdir(gen_dir):
+            os.mkdir(gen_dir)
+
+        calls = []
+        generate_network = NetworkGenerator.generate_network
+
+        def counting_generate_network(*args, **kwargs):
+            calls.append(kwargs.get("always_include_props"))
+            return generate_network(*args, **kwargs)
+
+        cwd = os.getcwd()
+        os.chdir(gen_dir)
+        NetworkGenerator.generate_network = counting_generate_network
+        try:
+            generate_exports(
+                sim,
+                ["nml", "matrix1npz"],
+                network=network,
+                base_dir=base_dir,
+                target_dir=gen_dir,
+            )
+        finally:
+            NetworkGenerator.generate_network = generate_network
+            os.chdir(cwd)
+
+        # The network is generated once, with the properties for the matrix
+        self.assertEqual(calls, [True])
+        name = "Chemical conns (number of conns)"
+        matrix, labels = load_matrix(
+            os.path.join(gen_dir, "%s_matrices.npz" % network.id), name, "populations"
+        )
+        self.assertEqual(labels, ["pop0", "pop1", "pop2"])
+
+        nml_file = os.path.join(gen_dir, "%s.net.nml" % network.id)
+        with open(nml_file) as f:
+            nml = f.read()
+        generate_neuroml2_from_network(
+            network, base_dir=base_dir, target_dir=gen_dir, simulation=sim
+        )
+        with open(nml_file) as f:
+            self.assertEqual(f.read(), nml)
+        self.assertEqual(nml.count('<property tag="color"'), 2)
+
+    def test_batch_results(self):
+
+        from neuromllite.NetworkGenerator import _add_batch_traces, _add_batch_events
+
+        # Results of 4 time steps (dt = 0.5 ms) of 2 trials of 3 cells
+        vs = np.arange(24.0).reshape(4, 2, 3)
+        ss = np.zeros((4, 2, 3), dtype=bool)
+        ss[1, 0, 2] = ss[3, 0, 2] = ss[2, 1, 0] = True
+
+        # With batch_size 1, only the results of the second trial
+        for batch_size, prefix in [(1, ""), (2, "trial1/")]:
+            traces = {}
+            events = {}
+            trials = slice(2 - batch_size, 2)
+            _add_batch_traces(traces, "pop", vs[:, trials], batch_size)
+            _add_batch_events(events, "pop", ss[:, trials], 0.5, batch_size)
+
+            self.assertEqual(len(traces), 3 * batch_size)
+            self.assertEqual(traces["%spop[2]" % prefix], [5, 11, 17, 23])
+            self.assertEqual(len(events), 3 * batch_size)
+            self.assertEqual(events["%spop/0/???" % prefix], [0.001])
+            self.assertEqual(events["%spop/1/???" % prefix], [])
+
+        self.assertEqual(events["trial0/pop/2/???"], [0.0005, 0.0015])
+
+    def test_batch_inputs(self):
+
+        from neuromllite.NetworkGenerator import _get_batch_inputs
+
+        network = Network(id="net", parameters={"rate": 200})
+        network.cells.append(
+            Cell(
+                id="poisson",
+                pynn_cell="SpikeSourcePoisson",
+                parameters={"rate": "rate", "start": 10, "duration": 50},
+            )
+        )
+        network.cells.append(Cell(id="lif", bindsnet_node="LIFNodes"))
+        network.input_sources.append(
+            InputSource(
+                id="dc",
+                pynn_input="DCSource",
+                parameters={"amplitude": 0.5, "start": 20, "stop": 40},
+            )
+        )
+        network.populations.append(Population(id="pre", size=20, component="poisson"))
+        network.populations.append(Population(id="post", size=4, component="lif"))
+        network.inputs.append(
+            Input(id="stim", input_source="dc", population="post", percentage=50)
+        )
+
+        input_cells = {"stim": (np.array([1, 3, 3]), np.array([2.0, 1.0, 1.0]))}
+        inputs = _get_batch_inputs(
+            network, {"pre": 20, "post": 4}, input_cells, 100, 0.5, 3
+        )
+        self.assertEqual(inputs["pre"].shape, (100, 3, 20))
+        self.assertEqual(inputs["post"].shape, (100, 3, 4))
+
+        # Poisson spikes (p = 0.1 per step) from 10 to 60 ms, different in
+        # each trial but the same each time the inputs are built
+        spikes = inputs["pre"]
+        self.assertFalse(spikes[:20].any() or spikes[120:].any())
+        self.assertTrue(100 < spikes[:, 0].sum() < 300)
+        self.assertFalse(np.array_equal(spikes[:, 0], spikes[:, 1]))
+        self.assertFalse(np.array_equal(spikes[:, 1], spikes[:, 2]))
+        again = _get_batch_inputs(
+            network, {"pre": 20, "post": 4}, input_cells, 100, 0.5, 3
+        )
+        self.assertTrue(np.array_equal(again["pre"], spikes))
+
+        # The DC input from 20 to 40 ms is the same in each trial
+        current = np.zeros((100, 4))
+        current[40:80, 1] = current[40:80, 3] = 1
+        for trial in range(3):
+            self.assertTrue(np.array_equal(inputs["post"][:, trial], current))
+
+    def test_bindsnet_weights(self):
+
+        try:
+            import torch
+            from neuromllite.BindsNETHandler import BindsNETHandler
+        except ImportError:
+            self.skipTest("BindsNET (with torch) is not installed")
+
+        network = Network(id="net")
+        for dense_fraction, is_sparse in [(0.1, True), (0.05, False)]:
+            handler = BindsNETHandler(
+                network, batch_size=3, dense_fraction=dense_fraction
+            )
+            self.assertEqual(handler.bn_network.batch_size, 3)
+
+            handler.handle_population("pre", "comp", 20)
+            handler.handle_locations("pre", "comp", np.zeros((20, 3)))
+            handler.handle_population("post", "comp", 10)
+            handler.handle_locations("post", "comp", np.zeros((10, 3)))
+            handler.handle_projection("proj", "pre", "post", "syn")
+            # 15 of the 200 pairs of cells, one connected twice
+            pre = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 14]
+            post = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 1, 2, 3, 4, 4]
+            handler.handle_connections("proj", 0, "pre", "post", "syn", pre, post)
+            handler.finalise_projection("proj", "pre", "post")
+
+            w = handler.get_weight_tensor("proj")
+            self.assertEqual(w.is_sparse, is_sparse)
+            self.assertEqual(tuple(w.shape), (20, 10))
+            dense = w.to_dense().numpy()
+            self.assertEqual(np.count_nonzero(dense), 15)
+            self.assertEqual(dense[14, 4], 2)
+            self.assertEqual(dense.sum(), 16)
+
+        # The cells of the inputs, given singly or in bulk, for _get_batch_inputs
+        handler.handle_input_list("stim", "post", "dc", 3)
+        handler.handle_single_input("stim", 0, 4, weight=2)
+        handler.handle_inputs("stim", 1, [1, 3])
+        cell_ids, weights = handler.get_input_cells()["stim"]
+        self.assertEqual(cell_ids.tolist(), [4, 1, 3])
+        self.assertEqual(weights.tolist(), [2, 1, 1])
+
+    def get_gid_network(self):
+        """
+        A network of 2 populations with 3 projections, the connections of
+        which are given in chunks, singly or in bulk, to (Arbor) handlers
+        """
+        network = Network(id="gids")
+        network.populations.append(Population(id="pop0", size=4, component="c"))
+        network.populations.append(Population(id="pop1", size=3, component="c"))
+        for id, pre, post in [
+            ("a", "pop0", "pop1"),
+            ("b", "pop1", "pop0"),
+            ("c", "pop0", "pop0"),
+        ]:
+            network.projections.append(
+                Projection(id=id, presynaptic=pre, postsynaptic=post, synapse="s")
+            )
+
+        rng = np.random.default_rng(1)
+        chunks = {}
+        for p in network.projections:
+            num_pre = 4 if p.presynaptic == "pop0" else 3
+            num_post = 4 if p.postsynaptic == "pop0" else 3
+            chunks[p.id] = [(rng.integers(num_pre), rng.integers(num_post), 0.5, 1.0)]
+            for num in [5, 7]:
+                chunks[p.id].append(
+                    (
+                        rng.integers(num_pre, size=num),
+                        rng.integers(num_post, size=num),
+                        rng.choice([-1, 0, 0.25, 1], size=num),
+                        rng.uniform(1, 5, size=num),
+                    )
+                )
+        return network, chunks
+
+    def check_incoming_connections(self, network, chunks, pop_gids, incoming):
+        # Compare with the connections onto each gid found one at a time
+        indptr, sources, weights, delays = incoming
+        num_cells = sum(len(g) for g in pop_gids.values())
+        self.assertEqual(len(indptr), num_cells + 1)
+        for gid in range(num_cells):
+            expected = []
+            for p in network.projections:
+                for pre, post, w, d in chunks[p.id]:
+                    for i in range(np.size(pre)):
+                        if (
+                            pop_gids[p.postsynaptic][np.atleast_1d(post)[i]] == gid
+                            and np.atleast_1d(w)[i] > 0
+                        ):
+                            expected.append(
+                                (
+                                    pop_gids[p.presynaptic][np.atleast_1d(pre)[i]],
+                                    np.atleast_1d(w)[i],
+                                    np.atleast_1d(d)[i],
+                                )
+                            )
+            start, end = indptr[gid], indptr[gid + 1]
+            self.assertEqual(
+                list(zip(sources[start:end], weights[start:end], delays[start:end])),
+                expected,
+            )
+
+    def test_incoming_connections(self):
+
+        from neuromllite.NetworkGenerator import _get_gid_arrays
+        from neuromllite.NetworkGenerator import _get_incoming_connections
+
+        network, chunks = self.get_gid_network()
+
+        # The cells of pop1 are handled first
+        pop_indices_vs_gids = {
+            "pop0": {0: 3, 1: 4, 2: 5, 3: 6},
+            "pop1": {0: 0, 1: 1, 2: 2},
+        }
+        pop_ids, gid_pop_indices, gid_cell_indices, pop_gids = _get_gid_arrays(
+            pop_indices_vs_gids, 7
+        )
+        self.assertEqual(pop_ids, ["pop0", "pop1"])
+        self.assertEqual(gid_pop_indices.tolist(), [1, 1, 1, 0, 0, 0, 0])
+        self.assertEqual(gid_cell_indices.tolist(), [0, 1, 2, 0, 1, 2, 3])
+        self.assertEqual(pop_gids["pop0"].tolist(), [3, 4, 5, 6])
+        self.assertEqual(pop_gids["pop1"].tolist(), [0, 1, 2])
+
+        # The connections of each projection, as collected by ArborHandler
+        proj_pops = {p.id: (p.presynaptic, p.postsynaptic) for p in network.projections}
+        proj_connections = {}
+        for p in network.projections:
+            proj_connections[p.id] = tuple(
+                np.concatenate(
+                    [
+                        np.broadcast_to(c[i], np.shape(c[0]) or (1,))
+                        for c in chunks[p.id]
+                    ]
+                )
+                for i in range(4)
+            )
+        incoming = _get_incoming_connections(
+            network, proj_pops, proj_connections, pop_gids, 7
+        )
+        self.check_incoming_connections(network, chunks, pop_gids, incoming)
+        self.assertGreater(len(incoming[1]), 0)
+
+        # Projections without connections (e.g. with weight 0) aren't handled
+        del proj_connections["b"]
+        chunks["b"] = []
+        incoming = _get_incoming_connections(
+            network, proj_pops, proj_connections, pop_gids, 7
+        )
+        self.check_incoming_connections(network, chunks, pop_gids, incoming)
+
+    def test_gid_results(self):
+
+        from neuromllite.NetworkGenerator import _get_gid_arrays
+        from neuromllite.NetworkGenerator import _get_cpu_group_size
+        from neuromllite.NetworkGenerator import _get_recorded_gids
+        from neuromllite.NetworkGenerator import _add_sample_trace
+        from neuromllite.NetworkGenerator import _split_spikes
+
+        self.assertEqual(_get_cpu_group_size(7, 1), None)
+        self.assertEqual(_get_cpu_group_size(7, 2), 4)
+        self.assertEqual(_get_cpu_group_size(8, 4), 2)
+        self.assertEqual(_get_cpu_group_size(2, 4), 1)
+
+        pop_indices_vs_gids = {
+            "pop0": {0: 3, 1: 4, 2: 5, 3: 6},
+            "pop1": {0: 0, 1: 1, 2: 2},
+        }
+        gid_cell_indices, pop_gids = _get_gid_arrays(pop_indices_vs_gids, 7)[2:]
+
+        # Only the cells recorded get samplers
+        recorded = _get_recorded_gids({"pop0": {3: [0], 1: [0]}, "pop1": {}}, pop_gids)
+        self.assertEqual(recorded, {("pop0", 1): 4, ("pop0", 3): 6})
+
+        traces = {}
+        samples = np.array([[0, -70, 1], [0.5, -65, 1]])
+        _add_sample_trace(traces, "pop0[1]", samples)
+        self.assertEqual(traces, {"pop0[1]": [-0.07, -0.065], "t": [0, 0.0005]})
+
+        rng = np.random.default_rng(2)
+        spike_gids = rng.integers(7, size=50)
+        spike_times = np.sort(rng.uniform(0, 1, size=50))
+        gids = pop_gids["pop0"][[0, 2, 3]]
+        cell_indices, times, cell_times = _split_spikes(
+            spike_gids, spike_times, gids, gid_cell_indices
+        )
+        expected = [(g - 3, t) for g, t in zip(spike_gids, spike_times) if g in gids]
+        self.assertEqual(list(zip(cell_indices, times)), expected)
+        self.assertEqual(len(cell_times), 3)
+        for index, index_times in zip([0, 2, 3], cell_times):
+            self.assertEqual(
+                index_times.tolist(), [t for i, t in expected if i == index]
+            )
+        self.assertGreater(len(cell_times[0]), 0)
+
+        # No spikes
+        cell_indices, times, cell_times = _split_spikes([], [], gids, gid_cell_indices)
+        self.assertEqual((len(cell_indices), len(times)), (0, 0))
+        self.assertEqual([len(t) for t in cell_times], [0, 0, 0])
+
+    def test_saved_results(self):
+
+        from neuromllite.NetworkGenerator import _add_signal_traces
+        from neuromllite.NetworkGenerator import _add_spike_events
+
+        gen_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "temp")
+
+        # The signals of cells 4, 1 and 2 of a population with ids from 100
+        traces = {}
+        signal = np.array([[-70, -60, -50], [-69, -59, -49]], dtype=float)
+        filename = os.path.join(gen_dir, "pop.v.dat")
+        _add_signal_traces(
+            traces, filename, "pop", [1, 2, 4], signal, [104, 101, 102], 100, 0.5
+        )
+        self.assertEqual(traces["t"].tolist(), [0, 0.0005])
+        self.assertEqual(traces["pop/1/???/v"].tolist(), [-0.06, -0.059])
+        self.assertEqual(traces["pop/2/???/v"].tolist(), [-0.05, -0.049])
+        self.assertEqual(traces["pop/4/???/v"].tolist(), [-0.07, -0.069])
+        saved = np.loadtxt(filename)
+        self.assertEqual(saved.shape, (2, 4))
+        self.assertEqual(saved[1].tolist(), [0.0005, -0.059, -0.049, -0.069])
+
+        # The spikes of all the cells of a population, cell by cell as from
+        # the spike trains in PyNN, with cells 1 and 3 recorded
+        events = {}
+        spike_indices = np.array([0, 1, 1, 1, 2, 3])
+        spike_times = np.array([0.01, 0.002, 0.005, 0.02, 0.003, 0.004])
+        filename = os.path.join(gen_dir, "pop.spikes")
+        indices = np.array([1, 3])
+        _add_spike_events(
+            events,
+            filename,
+            "pop",
+            indices,
+            spike_indices,
+            spike_times,
+            indices,
+            np.arange(4),
+        )
+        self.assertEqual(
+            events, {"pop/1/???": [0.002, 0.005, 0.02], "pop/3/???": [0.004]}
+        )
+        saved = np.loadtxt(filename)
+        self.assertEqual(saved[:, 0].tolist(), [1, 1, 1, 3])
+        self.assertEqual(saved[:, 1].tolist(), [0.002, 0.005, 0.02, 0.004])
+
+        # No spikes
+        events = {}
+        _add_spike_events(
+            events, filename, "pop", indices, [], [], indices, np.arange(4)
+        )
+        self.assertEqual(events, {"pop/1/???": [], "pop/3/???": []})
+        self.assertEqual(os.path.getsize(filename), 0)
+
+    def test_arbor_incoming_connections(self):
+
+        try:
+            from neuromllite.ArborHandler import ArborHandler
+        except ImportError:
+            self.skipTest("Arbor is not installed")
+        from neuromllite.NetworkGenerator import _get_gid_arrays
+        from neuromllite.NetworkGenerator import _get_incoming_connections
+
+        network, chunks = self.get_gid_network()
+        handler = ArborHandler(network)
+        handler.handle_population("pop1", "c", 3)
+        handler.handle_locations("pop1", "c", np.zeros((3, 3)))
+        handler.handle_population("pop0", "c", 4)
+        for i in range(4):
+            handler.handle_location(i, "pop0", "c", 0, 0, 0)
+
+        for p in network.projections:
+            handler.handle_projection(p.id, p.presynaptic, p.postsynaptic, "s")
+            start_id = 0
+            for pre, post, w, d in chunks[p.id]:
+                if np.ndim(pre) == 0:
+                    handler.handle_connection(
+                        p.id,
+                        start_id,
+                        p.presynaptic,
+                        p.postsynaptic,
+                        "s",
+                        pre,
+                        post,
+                        delay=d,
+                        weight=w,
+                    )
+                else:
+                    handler.handle_connections(
+                        p.id,
+                        start_id,
+                        p.presynaptic,
+                        p.postsynaptic,
+                        "s",
+                        pre,
+                        post,
+                        delays=d,
+                        weights=w,
+                    )
+                start_id += np.size(pre)
+            handler.finalise_projection(p.id, p.presynaptic, p.postsynaptic)
+
+        pop_gids = _get_gid_arrays(handler.pop_indices_vs_gids, handler.curr_gid)[3]
+        self.assertEqual(pop_gids["pop0"].tolist(), [3, 4, 5, 6])
+        incoming = _get_incoming_connections(
+            network, handler.proj_pops, handler.proj_connections, pop_gids, 7
+        )
+        self.check_incoming_connections(network, chunks, pop_gids, incoming)
+
+    def get_pynn_handler(self):
+
+        try:
+            import pyNN.mock
+        except ImportError:
+            self.skipTest("PyNN is not installed")
+        from neuromllite.PyNNHandler import PyNNHandler
+
+        handler = PyNNHandler("mock", 0.1, "pynn_test")
+        handler.set_cells({"cell": handler.sim.IF_cond_alpha()})
+        handler.set_receptor_types({"syn": "excitatory"})
+        handler.handle_population("pop0", "cell", 5)
+        handler.handle_population("pop1", "cell", 3)
+        return handler
+
+    def test_pynn_handler(self):
+
+        handler = self.get_pynn_handler()
+        pop0 = handler.populations["pop0"]
+
+        # Positions are written at start_id, singly or in bulk
+        handler.handle_location(0, "pop0", "cell", 1, 2, 3)
+        handler.handle_locations("pop0", "cell", [[4, 5, 6], [7, 8, 9]], start_id=2)
+        self.assertEqual(pop0.positions.shape, (3, 5))
+        self.assertEqual(pop0.positions[:, 0].tolist(), [1, 2, 3])
+        self.assertEqual(pop0.positions[:, 2].tolist(), [4, 5, 6])
+        self.assertEqual(pop0.positions[:, 3].tolist(), [7, 8, 9])
+
+        # Count the cells each input source is injected into
+        class RecordingSource(object):
+            def __init__(self):
+                self.counts = np.zeros(pop0.size, dtype=int)
+
+            def inject_into(self, cells):
+                indices = np.array(cells.all_cells, dtype=int) - int(pop0.first_id)
+                np.add.at(self.counts, indices, 1)
+
+        source = RecordingSource()
+        handler.input_sources["source"] = source
+        handler.handle_input_list("inputs", "pop0", "source", 7)
+        handler.handle_single_input("inputs", 0, 4)
+        handler.handle_inputs("inputs", 1, [1, 3, 1, 1, 3, 0])
+        handler.handle_inputs("inputs", 7, [])
+        handler.finalise_input_source("inputs")
+        self.assertEqual(source.counts.tolist(), [1, 3, 0, 2, 1])
+
+    def test_pynn_handler_connections(self):
+
+        handler = self.get_pynn_handler()
+        if not hasattr(np, "in1d"):
+            self.skipTest("This version of PyNN needs numpy.in1d (numpy < 2.4)")
+
+        handler.handle_projection("proj", "pop0", "pop1", "syn")
+        handler.handle_connection(
+            "proj", 0, "pop0", "pop1", "syn", 4, 2, delay=1.5, weight=0.5
+        )
+        handler.handle_connections(
+            "proj",
+            1,
+            "pop0",
+            "pop1",
+            "syn",
+            [0, 1, 3],
+            [1, 0, 2],
+            delays=2,
+            weights=0.25,
+        )
+        handler.handle_connection(
+            "proj", 4, "pop0", "pop1", "syn", 2, 2, delay=3, weight=1
+        )
+        handler.handle_connections(
+            "proj",
+            5,
+            "pop0",
+            "pop1",
+            "syn",
+            np.array([1]),
+            np.array([1]),
+            delays=np.array([4.0]),
+            weights=np.array([0.75]),
+        )
+        handler.finalise_projection("proj", "pop0", "pop1", synapse="syn")
+
+        # One (pre, post, weight, delay) row for each connection, in order
+        connections = handler.projections["proj"].get(
+            ["weight", "delay"], format="list"
+        )
+        self.assertEqual(
+            sorted([list(map(float, c)) for c in connections]),
+            sorted(
+                [
+                    [4, 2, 0.5, 1.5],
+                    [0, 1, 0.25, 2],
+                    [1, 0, 0.25, 2],
+                    [3, 2, 0.25, 2],
+                    [2, 2, 1, 3],
+                    [1, 1, 0.75, 4],
+                ]
+            ),
+        )
+
+        # A projection without connections
+        handler.handle_projection("empty", "pop1", "pop0", "syn")
+        handler.finalise_projection("empty", "pop1", "pop0", synapse="syn")
+        self.assertEqual(len(handler.projections["empty"]), 0)
+
     def test_generate_jnml(self):
         sim = self.get_example_simulation()
 
@@ -77,6 +77,93 @@ class TestUtils(unittest.TestCase):
 
         return True
 
+    def test_compiled_network(self):
+
+        from neuromllite.CompiledNetwork import CompiledNetwork
+
+        network = get_example_network()
+        network.parameters["size"] = "int * 2"
+        network.populations.insert(1, Population(id="empty", size=0, component="iaf"))
+        network.populations.append(Population(id="pop2", size="size", component="iaf"))
+        network.regions.append(RectangularRegion(id="box", width=10))
+
+        compiled = CompiledNetwork(network)
+        self.assertEqual(compiled.population_sizes.tolist(), [5, 0, 10, 6])
+        self.assertEqual(compiled.population_offsets.tolist(), [0, 5, 5, 15])
+        self.assertEqual(compiled.num_cells, 21)
+        self.assertFalse(compiled.population_sizes.flags.writeable)
+
+        for pop in network.populations:
+            self.assertIs(compiled.get_population(pop.id), pop)
+        self.assertIs(compiled.get_projection("proj0"), network.projections[0])
+        self.assertIs(compiled.get_region("box"), network.regions[0])
+        self.assertIsNone(compiled.get_population("pop3"))
+        self.assertIsNone(compiled.get_cell("iaf"))
+        self.assertEqual(compiled.get_population_size("pop2"), 6)
+
+        self.assertEqual(compiled.get_gid("pop1", 3), 8)
+        for gid, (pop_id, index) in enumerate(
+            [("pop0", i) for i in range(5)]
+            + [("pop1", i) for i in range(10)]
+            + [("pop2", i) for i in range(6)]
+        ):
+            self.assertEqual(compiled.get_population_and_index(gid), (pop_id, index))
+            self.assertEqual(compiled.get_gid(pop_id, index), gid)
+
+    def test_parameter_table(self):
+
+        from neuromllite.ParameterTable import ParameterTable
+        from neuromllite.ParameterTable import get_parameter_table
+        import random
+
+        parameters = {
+            "N_inh": "N - N_exc",
+            "N_exc": "int(0.8 * N)",
+            "N": 100,
+            "tau": 20,
+            "w": "normal(1, 0.1)",
+            "w_inh": "-2 * w",
+            "label": "exc",
+            "rates": [1, 2],
+        }
+        table = ParameterTable(parameters)
+        self.assertEqual(table.values["N_exc"], 80)
+        self.assertEqual(table.values["N_inh"], 20)
+        self.assertEqual(table.evaluate("N_inh * 2"), 40)
+        # The names evaluate() adds (e.g. rng) aren't kept for later uses
+        self.assertLess(table.evaluate("N * random()", random.Random(1)), 100)
+        self.assertEqual(table.evaluate("rng"), "rng")
+        self.assertEqual(set(table.values), set(parameters))
+        self.assertLess(table.order.index("N"), table.order.index("N_exc"))
+        # Random parameters, and those which use them, are evaluated for each use
+        self.assertEqual(table.values["w"], "normal(1, 0.1)")
+        self.assertEqual(table.values["w_inh"], "-2 * w")
+        self.assertEqual(table.values["label"], "exc")
+        self.assertEqual(table.values["rates"], [1, 2])
+
+        # Only N and the parameters which use it are re-evaluated
+        evaluations = table.num_evaluations
+        table.set("N", 50, parameters)
+        self.assertEqual(parameters["N"], 50)
+        self.assertEqual((table.values["N_exc"], table.values["N_inh"]), (40, 10))
+        self.assertEqual(table.num_evaluations - evaluations, 2)
+
+        evaluations = table.num_evaluations
+        table.update(parameters)
+        table.set("tau", 10)
+        self.assertEqual(table.num_evaluations, evaluations)
+        self.assertEqual(table.values["tau"], 10)
+
+        self.assertRaises(Exception, ParameterTable, {"a": "b + 1", "b": "2 * a"})
+
+        network = get_example_network()
+        network.parameters["size"] = "int * 2"
+        table = get_parameter_table(network)
+        self.assertIs(get_parameter_table(network), table)
+        self.assertEqual(table.values["size"], 6)
+        network.parameters["int"] = 4
+        self.assertEqual(get_parameter_table(network).values["size"], 8)
+
 
 if __name__ == "__main__":
     tu = TestUtils()
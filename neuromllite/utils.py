@@ -13,6 +13,7 @@ from modelspec.utils import (
     _parse_element,
     ascii_encode_dict,
 )
+from neuromllite.ParameterTable import get_parameter_table
 
 
 verbose = False
@@ -132,7 +133,7 @@ def _generate_cell_indices_seg_ids(pop_id, indices_segids, network):
         seg_ids = l
 
     if indices == "*":
-        size = evaluate(pop.size, network.parameters)
+        size = get_parameter_table(network).evaluate(pop.size)
         for index in range(size):
             a[index] = seg_ids
     else: